@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+# Measures how long modbus4mqtt takes to get from a fresh interpreter to being ready
+# to connect, with and without the compiled config cache.
+#
+# Usage: python benchmarks/bench_startup.py [config.yaml] [runs]
+
+import os
+import subprocess
+import sys
+import tempfile
+from statistics import median
+
+STARTUP_SCRIPT = """
+import sys
+from time import perf_counter
+start = perf_counter()
+from modbus4mqtt.modbus4mqtt import mqtt_interface
+imported = perf_counter()
+mqtt_interface("localhost", 1883, "", "", sys.argv[1], "bench", config_cache=sys.argv[2] or None)
+ready = perf_counter()
+print(imported - start, ready - imported)
+"""
+
+
+def run(config: str, cache: str) -> tuple[float, float]:
+    output = subprocess.run(
+        [sys.executable, "-c", STARTUP_SCRIPT, config, cache],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    import_s, load_s = output.split()
+    return float(import_s), float(load_s)
+
+
+def report(name: str, results: list[tuple[float, float]]):
+    import_ms = median(result[0] for result in results) * 1000
+    load_ms = median(result[1] for result in results) * 1000
+    print(
+        "{:<12} import: {:7.1f} ms  config: {:7.1f} ms  total: {:7.1f} ms".format(
+            name, import_ms, load_ms, import_ms + load_ms
+        )
+    )
+
+
+def main():
+    config = sys.argv[1] if len(sys.argv) > 1 else "modbus4mqtt/config/SG8K-D.yaml"
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    report("No cache", [run(config, "") for _ in range(runs)])
+    with tempfile.TemporaryDirectory() as cache:
+        # Prime the cache once, then measure warm starts.
+        run(config, cache)
+        assert os.listdir(cache), "The config cache wasn't written."
+        report("Warm cache", [run(config, cache) for _ in range(runs)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+# Estimates the MQTT bytes on the wire per poll for a config under different
+# publishing modes. Every register value changes on every poll, which is the worst
+# case. Nothing is connected to: modbus reads are skipped and PUBLISH packets are
+# sized instead of sent.
+#
+# Usage: python benchmarks/bench_wire_bytes.py [config.yaml] [polls] [topic aliases]
+
+import os
+import random
+import sys
+import tempfile
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from ruamel.yaml import YAML
+
+from modbus4mqtt.modbus4mqtt import mqtt_interface
+
+
+def varint_length(value: int) -> int:
+    length = 1
+    while value >= 128:
+        value //= 128
+        length += 1
+    return length
+
+
+class RecordingClient:
+    # Stands in for the paho client and adds up the size of each PUBLISH packet.
+    def __init__(self, mqtt_version: str, status_prefix: str):
+        self.mqtt_version = mqtt_version
+        self.status_prefix = status_prefix
+        self.bytes = 0
+        self.packets = 0
+
+    def is_connected(self):
+        return True
+
+    def subscribe(self, topic, qos=0):
+        return mqtt.MQTT_ERR_SUCCESS, 1
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        if topic.startswith(self.status_prefix):
+            return mqtt.MQTTMessageInfo(0)
+        if not isinstance(payload, bytes):
+            payload = str(payload).encode("utf-8")
+        remaining = 2 + len(topic.encode("utf-8")) + len(payload)
+        if qos:
+            remaining += 2
+        if self.mqtt_version == "5":
+            remaining += len(properties.pack()) if properties is not None else 1
+        self.packets += 1
+        self.bytes += 1 + varint_length(remaining) + remaining
+        return mqtt.MQTTMessageInfo(0)
+
+
+def measure(config: dict, mqtt_version: str, polls: int, aliases: int):
+    with tempfile.TemporaryDirectory() as directory:
+        config_file = os.path.join(directory, "config.yaml")
+        with open(config_file, "w") as f:
+            YAML().dump(config, f)
+        i = mqtt_interface(
+            "localhost",
+            1883,
+            "",
+            "",
+            config_file,
+            "modbus4mqtt",
+            mqtt_version=mqtt_version,
+        )
+    client = RecordingClient(mqtt_version, i.prefix + "modbus4mqtt")
+    i._mqtt_client = client
+    i._mb.poll = lambda: None
+    properties = Properties(PacketTypes.CONNACK)
+    properties.TopicAliasMaximum = aliases
+    i._on_connect(client, None, None, 0, properties)
+    rng = random.Random(1)
+    results = []
+    for _ in range(polls):
+        for table in i._mb.get_tables().values():
+            for addr in list(table._registers):
+                table.set_value(addr, rng.randrange(0x10000))
+        client.bytes = client.packets = 0
+        i.poll()
+        results.append((client.bytes, client.packets))
+    return results
+
+
+def main():
+    config_file = (
+        sys.argv[1] if len(sys.argv) > 1 else "modbus4mqtt/config/Sungrow_SH5k_20.yaml"
+    )
+    polls = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    # Mosquitto allows 10 topic aliases per client by default.
+    aliases = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    base = YAML(typ="safe").load(open(config_file).read())
+    base.pop("metrics_interval", None)
+    modes = [
+        ("MQTT 3.1.1", {}, "3.1.1"),
+        ("MQTT 5, aliases", {}, "5"),
+        ("MQTT 5, aliases, expiry", {"message_expiry": 60}, "5"),
+        ("Snapshot", {"snapshot_topic": "snapshot"}, "3.1.1"),
+        (
+            "Snapshot, zlib",
+            {"snapshot_topic": "snapshot", "snapshot_compression": "zlib"},
+            "3.1.1",
+        ),
+        ("MessagePack", {"payload_codec": "msgpack"}, "3.1.1"),
+        (
+            "Snapshot, CBOR",
+            {"snapshot_topic": "snapshot", "payload_codec": "cbor"},
+            "3.1.1",
+        ),
+    ]
+    print("{} polls, {} topic aliases".format(polls, aliases))
+    print(
+        "{:<26} {:>12} {:>14} {:>10}".format(
+            "Mode", "First poll", "Later polls", "Packets"
+        )
+    )
+    for name, overrides, mqtt_version in modes:
+        config = dict(base, **overrides)
+        try:
+            results = measure(config, mqtt_version, polls, aliases)
+        except ValueError as e:
+            # Most likely an optional codec that isn't installed.
+            print("{:<26} skipped: {}".format(name, e))
+            continue
+        later = results[1:] or results
+        print(
+            "{:<26} {:>10} B {:>12.0f} B {:>10}".format(
+                name,
+                results[0][0],
+                sum(result[0] for result in later) / len(later),
+                results[-1][1],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import math
+import os
+import socketserver
+import stat
+import threading
+from time import monotonic
+from typing import Any
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# Long polls are answered after this many seconds at most, changed or not.
+MAX_WAIT_S = 60
+
+
+class ValueStore:
+    # The latest decoded value of every published register, for local readers.
+    # Each change gets the next sequence number, so a reader can ask for whatever
+    # changed since the last sequence number it saw, waiting for it if need be.
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self.sequence = 0
+        # Keyed by (pub_topic, json_key). json_key is None for plain registers.
+        self._entries: dict[tuple[str, str | None], dict[str, Any]] = {}
+        self._changed_at: dict[tuple[str, str | None], int] = {}
+        self.registers: list[dict] = []
+        self._closed = False
+
+    def update(self, values: list[tuple[str, str | None, Any, float | None]]):
+        # Takes (pub_topic, json_key, value, read_time) for each register.
+        with self._condition:
+            changed = False
+            for topic, json_key, value, read_time in values:
+                key = (topic, json_key)
+                entry = self._entries.get(key)
+                if entry is not None and entry["value"] == value:
+                    entry["timestamp"] = read_time
+                    continue
+                self.sequence += 1
+                changed = True
+                self._entries[key] = {
+                    "topic": topic,
+                    "json_key": json_key,
+                    "value": value,
+                    "timestamp": read_time,
+                }
+                self._changed_at[key] = self.sequence
+            if changed:
+                self._condition.notify_all()
+
+    def set_registers(self, registers: list[dict]):
+        # The register definitions, as metadata for readers. Values of registers
+        # that are no longer defined, after a reload, are forgotten.
+        with self._condition:
+            self.registers = [
+                {key: value for key, value in register.items() if key != "value"}
+                for register in registers
+            ]
+            keys = {
+                (register["pub_topic"], register.get("json_key"))
+                for register in registers
+            }
+            for key in list(self._entries):
+                if key not in keys:
+                    del self._entries[key]
+                    del self._changed_at[key]
+
+    def get(
+        self,
+        topics: list[str] | None = None,
+        since: int = 0,
+        wait: float = 0,
+    ) -> dict:
+        # Returns the entries for these topics, or all of them, that changed after
+        # since. With wait, blocks for up to that many seconds until there are some.
+        deadline = monotonic() + min(wait, MAX_WAIT_S)
+        with self._condition:
+            while True:
+                entries = [
+                    dict(entry)
+                    for key, entry in self._entries.items()
+                    if self._changed_at[key] > since
+                    and (topics is None or key[0] in topics)
+                ]
+                remaining = deadline - monotonic()
+                if entries or remaining <= 0 or self._closed:
+                    return {"sequence": self.sequence, "values": entries}
+                self._condition.wait(remaining)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # GET /values            Every value.
+    # GET /values/<topic>    The value, or JSON values, published on one topic.
+    # GET /registers         The register definitions.
+    # /values takes topic=<topic>, repeated, to pick several topics, and since=<n>
+    # to only return values that changed after sequence number n. With wait=<s> it
+    # waits up to s seconds for one to.
+    store: ValueStore
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        try:
+            since = int(query.get("since", ["0"])[0])
+            wait = float(query.get("wait", ["0"])[0])
+        except ValueError:
+            self._reply(400, {"error": "since and wait must be numbers."})
+            return
+        if not math.isfinite(wait):
+            self._reply(400, {"error": "wait must be a finite number."})
+            return
+        if url.path == "/registers":
+            self._reply(200, {"registers": self.store.registers})
+        elif url.path == "/values":
+            self._reply(200, self.store.get(query.get("topic"), since, wait))
+        elif url.path.startswith("/values/"):
+            topic = unquote(url.path[len("/values/") :])
+            result = self.store.get([topic], since, wait)
+            if not result["values"] and since == 0:
+                self._reply(404, {"error": "No value for {}.".format(topic)})
+            else:
+                self._reply(200, result)
+        else:
+            self._reply(404, {"error": "Unknown path {}.".format(url.path)})
+
+    def _reply(self, status: int, body: dict):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self) -> str:
+        # Unix socket clients don't have an address.
+        return str(self.client_address[0]) if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        logging.debug("Local API: " + format % args)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class LocalApi:
+    # Serves the value store as JSON over HTTP, on a Unix socket and/or a port on
+    # localhost, so co-located services can read values without going through the
+    # MQTT broker. Each server runs on its own background thread.
+
+    def __init__(self, socket_path: str | None = None, port: int | None = None):
+        self.store = ValueStore()
+        handler = type("Handler", (_Handler,), {"store": self.store})
+        self._socket_path = socket_path
+        self._servers: list[socketserver.BaseServer] = []
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                    raise ValueError(
+                        "{} already exists and isn't a socket.".format(socket_path)
+                    )
+                # Left over from a previous run.
+                os.unlink(socket_path)
+            self._servers.append(_UnixHTTPServer(socket_path, handler))
+        if port is not None:
+            server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+            server.daemon_threads = True
+            self._servers.append(server)
+        self._threads: list[threading.Thread] = []
+
+    def start(self):
+        for server in self._servers:
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self.store.close()
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        if self._socket_path is not None and os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
@@ -1,20 +1,98 @@
 #!/usr/bin/python3
 
+from collections import OrderedDict, deque
 from enum import StrEnum
-from time import sleep, monotonic
+from time import monotonic, sleep, time
 from datetime import datetime
+import hashlib
 import json
 import logging
-from ruamel.yaml import YAML
+import marshal
+import os
+import signal
+import sys
+import threading
+from typing import Any
 import click
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
 from . import modbus_interface
+from . import payloads
+from . import plan
+from . import probe
+from . import shared_image
+from . import spool
 import importlib.metadata
 
 _version = importlib.metadata.version("modbus4mqtt")
 
 MAX_DECIMAL_POINTS = 8
+SET_TOPIC_SUBSCRIPTION_MODES = ["individual", "combined", "wildcard"]
+MQTT_VERSIONS = {"3.1.1": mqtt.MQTTv311, "5": mqtt.MQTTv5}
+SNAPSHOT_MODES = ["changed", "all"]
+RELOAD_TOPIC = "modbus4mqtt/reload"
+WRITE_EVENT_TOPIC = "modbus4mqtt/writes"
+# Takes a JSON list of pub_topics to read now, like <prefix>/<pub_topic>/get does.
+GET_TOPIC = "modbus4mqtt/get"
+GET_TOPIC_SUFFIX = "/get"
+# Get requests that arrive within this many seconds of each other share their reads.
+DEFAULT_GET_WINDOW_S = 0.05
+# These settings are baked into the modbus connection, so a reload can't change them.
+RESTART_REQUIRED_SETTINGS = [
+    "ip",
+    "port",
+    "device_address",
+    "variant",
+    "write_mode",
+    "word_order",
+    "read_batching",
+    "scan_batching",
+    "write_batching",
+    "state_file",
+    "auto_batching",
+    "min_read_batching",
+    "target_read_latency",
+    "spool_dir",
+    "spool_max_bytes",
+    "max_inflight",
+    "max_queued",
+    "mask_write",
+    "read_write_multiple",
+    "reconnect_interval",
+    "reconnect_max_interval",
+    "circuit_breaker_failures",
+    "circuit_breaker_interval",
+    "timeout",
+    "retries",
+    "read_gap",
+    "write_gap",
+    "write_block_interval",
+    "tcp_keepalive",
+    "baudrate",
+    "bytesize",
+    "parity",
+    "stopbits",
+    "proxy_port",
+    "proxy_host",
+    "proxy_max_age",
+    "api_socket",
+    "api_port",
+    "shared_image",
+]
+DEFAULT_SPOOL_REPLAY_RATE = 50
+# How often the main loop wakes to replay spooled messages while there's a backlog.
+SPOOL_REPLAY_INTERVAL_S = 0.1
+QOS_LEVELS = [0, 1, 2]
+PUBLISH_OVERLOAD_POLICIES = ["drop_stale", "block"]
+DEFAULT_MAX_QUEUED = 1000
+DEFAULT_SEED_TIMEOUT_S = 2
+# Brokers send retained messages straight after the SUBACK. Once they've been quiet
+# for this long, topics that haven't had one aren't going to get one.
+SEED_SETTLE_S = 0.25
+# How often a blocked poll checks whether the broker has caught up.
+PUBLISH_BLOCK_INTERVAL_S = 0.1
 
 
 # Modbus connection status enum
@@ -31,6 +109,16 @@ class MqttConnectionStatus(StrEnum):
     Subscribing = "subscribing"
 
 
+def _format_read_time(read_time: float | None) -> str | None:
+    # The same format as the status timestamps, with milliseconds.
+    if read_time is None:
+        return None
+    moment = datetime.fromtimestamp(read_time).astimezone()
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.{:03d}%z").format(
+        moment.microsecond // 1000
+    )
+
+
 class mqtt_interface:
     def __init__(
         self,
@@ -45,12 +133,30 @@ class mqtt_interface:
         cafile=None,
         cert=None,
         key=None,
+        config_cache=None,
+        mqtt_version="3.1.1",
     ):
         self._running = True
         self.hostname = hostname
         self._port = port
         self.username = username
         self.password = password
+        self.config_cache = config_cache
+        if mqtt_version not in MQTT_VERSIONS:
+            raise ValueError(
+                "Unsupported MQTT version {}. Please only use: {}".format(
+                    mqtt_version, list(MQTT_VERSIONS)
+                )
+            )
+        self.mqtt_version = mqtt_version
+        # MQTT 5 topic aliases, per connection. Topics get an alias the second time
+        # they're published, up to the maximum the broker allows.
+        self._alias_lock = threading.Lock()
+        self._topic_aliases: dict[str, int] = {}
+        self._topics_seen: set[str] = set()
+        self._topic_alias_maximum = 0
+        self._publishes_rejected = 0
+        self.config_file = config_file
         self.config = self._load_modbus_config(config_file)
         self.use_tls = use_tls
         self.insecure = insecure
@@ -60,25 +166,382 @@ class mqtt_interface:
         if not mqtt_topic_prefix.endswith("/"):
             mqtt_topic_prefix = mqtt_topic_prefix + "/"
         self.prefix = mqtt_topic_prefix
-        self.address_offset = self.config.get("address_offset", 0)
-        self.registers = self.config["registers"]
-        for register in self.registers:
-            register["address"] += self.address_offset
         self.modbus_connect_retries = -1  # Retry forever by default
-        self.modbus_reconnect_sleep_interval = (
-            5  # Wait this many seconds between modbus connection attempts
+        # Wait at least this many seconds between modbus connection attempts
+        self.modbus_reconnect_sleep_interval = self.config.get(
+            "reconnect_interval", modbus_interface.DEFAULT_RECONNECT_INTERVAL_S
+        )
+        self._reconnect = modbus_interface.ReconnectBackoff(
+            self.modbus_reconnect_sleep_interval,
+            self.config.get(
+                "reconnect_max_interval",
+                modbus_interface.DEFAULT_RECONNECT_MAX_INTERVAL_S,
+            ),
+            self.config.get(
+                "circuit_breaker_failures",
+                modbus_interface.DEFAULT_CIRCUIT_BREAKER_FAILURES,
+            ),
+            self.config.get(
+                "circuit_breaker_interval",
+                modbus_interface.DEFAULT_CIRCUIT_BREAKER_INTERVAL_S,
+            ),
         )
         self.modbus_connection_status: ModbusConnectionStatus = (
             ModbusConnectionStatus.Offline
         )
         self._subscription_mids: dict[int, str] = {}
+        self._apply_settings(self.config)
+        self._metrics_published_at: float | None = None
+        # Set from signal handlers and MQTT callbacks to wake the main loop.
+        self._wake = threading.Event()
+        self._reload_requested = False
+        # Values published while MQTT is offline are caught here, if configured.
+        self._spool: spool.Spool | None = None
+        if self.config.get("spool_dir", None) is not None:
+            self._spool = spool.Spool(
+                self.config["spool_dir"],
+                self.config.get("spool_max_bytes", spool.DEFAULT_SPOOL_MAX_BYTES),
+            )
+        self._replay_allowance = 0.0
+        self._replayed_at = monotonic()
+        # Serves the register image to local Modbus TCP clients, if configured.
+        self._proxy: Any = None
+        # Serves decoded values to local services over HTTP, if configured.
+        self._api: Any = None
+        # Mirrors the raw register tables into a memory-mapped file, if configured.
+        self._shared_image: shared_image.SharedImage | None = None
+        if self.config.get("shared_image", None) is not None:
+            self._shared_image = shared_image.SharedImage(self.config["shared_image"])
+        # The publish window. When max_inflight is set, no more than that many
+        # messages are handed to paho at once, and the rest wait here, up to
+        # max_queued of them.
+        self.max_inflight: int | None = self.config.get("max_inflight", None)
+        self.max_queued: int = self.config.get("max_queued", DEFAULT_MAX_QUEUED)
+        for key, limit in [
+            ("max_inflight", self.max_inflight),
+            ("max_queued", self.max_queued),
+        ]:
+            if limit is not None and (not isinstance(limit, int) or limit < 1):
+                raise ValueError(
+                    "Bad YAML configuration. {} must be a positive integer.".format(key)
+                )
+        # Keyed by topic with the drop_stale policy, so a newer value replaces an
+        # older one that hasn't been sent yet. With the block policy every message
+        # gets its own key.
+        self._publish_queue: OrderedDict[Any, tuple[str, Any, bool, int]] = (
+            OrderedDict()
+        )
+        self._queue_sequence = 0
+        # Guards _in_flight, which the MQTT thread clears on reconnect.
+        self._queue_lock = threading.Lock()
+        self._in_flight: list[mqtt.MQTTMessageInfo] = []
+        self._queue_dropped = 0
+        self._queue_blocked_s = 0.0
+        # Seeding the last published values from the broker's retained messages.
+        self.seed_from_retained = self.config.get("seed_from_retained", False)
+        self.seed_timeout = self.config.get("seed_timeout", DEFAULT_SEED_TIMEOUT_S)
+        # Messages per second for the first poll after starting. None means no limit.
+        self.startup_publish_rate: float | None = self.config.get(
+            "startup_publish_rate", None
+        )
+        self._first_publish = True
+        self._seed_topics: set[str] = set()
+        # Not None while seeding. Filled in by the MQTT thread.
+        self._seed_payloads: dict[str, bytes] | None = None
+        self._seed_mid: int | None = None
+        self._seed_last_message: float | None = None
+        self._seed_update = threading.Event()
+        # Written registers waiting to be read back, as (register, raw value).
+        self._read_backs: deque[tuple[dict, int]] = deque()
+        # Registers asked for on the get topics, keyed by id() so each is read once,
+        # and when the first of them was asked for. The MQTT thread adds to these.
+        self._get_lock = threading.Lock()
+        self._get_requests: dict[int, dict] = {}
+        self._get_requested_at: float | None = None
         self.mqtt_connection_status: MqttConnectionStatus = MqttConnectionStatus.Offline
         self.setup_modbus()
 
+    def _apply_settings(self, config: dict):
+        # Applies the settings that can change without a restart. Raises ValueError
+        # before changing anything if they're invalid.
+        set_topic_subscription = config.get(
+            "set_topic_subscription", "individual"
+        ).lower()
+        if set_topic_subscription not in SET_TOPIC_SUBSCRIPTION_MODES:
+            raise ValueError(
+                "Bad YAML configuration. set_topic_subscription must be one of {}.".format(
+                    SET_TOPIC_SUBSCRIPTION_MODES
+                )
+            )
+        snapshot_mode = config.get("snapshot_mode", "changed").lower()
+        if snapshot_mode not in SNAPSHOT_MODES:
+            raise ValueError(
+                "Bad YAML configuration. snapshot_mode must be one of {}.".format(
+                    SNAPSHOT_MODES
+                )
+            )
+        snapshot_compression = config.get("snapshot_compression", "none").lower()
+        if snapshot_compression not in payloads.PAYLOAD_COMPRESSIONS:
+            raise ValueError(
+                "Bad YAML configuration. snapshot_compression must be one of {}.".format(
+                    payloads.PAYLOAD_COMPRESSIONS
+                )
+            )
+        qos = config.get("qos", 0)
+        if qos not in QOS_LEVELS:
+            raise ValueError(
+                "Bad YAML configuration. qos must be one of {}.".format(QOS_LEVELS)
+            )
+        publish_overload = config.get("publish_overload", "drop_stale").lower()
+        if publish_overload not in PUBLISH_OVERLOAD_POLICIES:
+            raise ValueError(
+                "Bad YAML configuration. publish_overload must be one of {}.".format(
+                    PUBLISH_OVERLOAD_POLICIES
+                )
+            )
+        payload_codecs = self._compile_payload_codecs(config)
+        # Snapshots are binary if the default codec is, and compact JSON otherwise.
+        default_codec = config.get("payload_codec", "text").lower()
+        snapshot_codec = payloads.PayloadCodec(
+            default_codec if default_codec in ["cbor", "msgpack"] else "json",
+            snapshot_compression,
+        )
+        self.config = config
+        self.address_offset = config.get("address_offset", 0)
+        self.registers = config["registers"]
+        for register in self.registers:
+            register["address"] += self.address_offset
+        self.set_topic_subscription = set_topic_subscription
+        self.set_topic_wildcard = config.get("set_topic_wildcard", "#")
+        self.remote_reload = config.get("remote_reload", False)
+        self._set_topic_index = self._build_set_topic_index()
+        # Subscribing to <pub_topic>/get, and to the batch get topic, for reads on
+        # demand rather than at the next poll.
+        self.get_topics = config.get("get_topics", False)
+        self.get_window: float = config.get("get_window", DEFAULT_GET_WINDOW_S)
+        self._get_topic_index = self._build_get_topic_index()
+        # Seconds between publications of the metrics topic. None disables it.
+        self.metrics_interval: float | None = config.get("metrics_interval", None)
+        # Seconds the modbus link may sit unused before it's checked with a
+        # single register read. None only checks it when polling.
+        self.idle_probe_interval: float | None = config.get("idle_probe_interval", None)
+        self.publish_timestamps = config.get("publish_timestamps", False)
+        # Seconds the broker may hold telemetry for before discarding it. MQTT 5 only.
+        self.message_expiry: int | None = config.get("message_expiry", None)
+        # When set, each poll is published as one document on this topic instead of
+        # one message per topic.
+        self.snapshot_topic: str | None = config.get("snapshot_topic", None)
+        self.snapshot_mode = snapshot_mode
+        self._payload_codecs = payload_codecs
+        self._snapshot_codec = snapshot_codec
+        self.snapshot_retain = config.get("snapshot_retain", False)
+        # Publishes pending, confirmed and mismatch events for set_topic writes.
+        self.write_feedback = config.get("write_feedback", False)
+        self.write_event_topic = config.get("write_event_topic", WRITE_EVENT_TOPIC)
+        # The default QoS for telemetry. Registers can override it.
+        self.qos = qos
+        self.publish_overload = publish_overload
+        # Spooled messages replayed per second once MQTT is back.
+        self.spool_replay_rate = config.get(
+            "spool_replay_rate", DEFAULT_SPOOL_REPLAY_RATE
+        )
+
+    @staticmethod
+    def _compile_payload_codecs(config: dict) -> dict[str, payloads.PayloadCodec]:
+        # Picks the codec for each pub_topic up front, so poll() doesn't have to.
+        default_codec = config.get("payload_codec", "text").lower()
+        default_compression = config.get("group_compression", "none").lower()
+        shared: dict[tuple[str, str], payloads.PayloadCodec] = {}
+        codecs = {}
+        for register in config["registers"]:
+            if "pub_topic" not in register:
+                continue
+            if register["pub_topic"] in codecs and not (
+                "payload_codec" in register or "group_compression" in register
+            ):
+                # Registers sharing a pub_topic take the settings of any that have them.
+                continue
+            codec = register.get("payload_codec", default_codec).lower()
+            compression = "none"
+            if "json_key" in register:
+                compression = register.get(
+                    "group_compression", default_compression
+                ).lower()
+            if (codec, compression) not in shared:
+                shared[(codec, compression)] = payloads.PayloadCodec(codec, compression)
+            codecs[register["pub_topic"]] = shared[(codec, compression)]
+        return codecs
+
     def connect(self):
         # Connects to modbus and MQTT.
         self.connect_mqtt()
+        if self.seed_from_retained:
+            self._seed_from_retained()
         self.connect_modbus()
+        if self.config.get("proxy_port", None) is not None and self._proxy is None:
+            self._start_proxy()
+        if self._api is None and (
+            self.config.get("api_socket", None) is not None
+            or self.config.get("api_port", None) is not None
+        ):
+            self._start_api()
+
+    def _start_api(self):
+        from . import api
+
+        self._api = api.LocalApi(
+            self.config.get("api_socket", None), self.config.get("api_port", None)
+        )
+        self._api.store.set_registers(self._get_registers_with("pub_topic"))
+        self._api.start()
+
+    def _update_api(self, registers: list[dict]):
+        values = []
+        for register in registers:
+            if register["value"] is None:
+                continue
+            values.append(
+                (
+                    register["pub_topic"],
+                    register.get("json_key", None),
+                    self._map_value(register, register["value"]),
+                    self._mb.get_read_time(
+                        register.get("table", "holding"),
+                        register["address"],
+                        register.get("type", "uint16"),
+                        **self._unit(register),
+                    ),
+                )
+            )
+        self._api.store.update(values)
+
+    def _start_proxy(self):
+        # Imported on demand, because pymodbus's server is only needed for this.
+        from . import proxy
+
+        units = None
+        if isinstance(self._mb, modbus_interface.ModbusBus):
+            units = self._mb.get_units()
+        self._proxy = proxy.ProxyServer(
+            self._mb,
+            self.config["proxy_port"],
+            self.config.get("proxy_max_age", self.config["update_rate"]),
+            self.config.get("proxy_host", proxy.DEFAULT_PROXY_HOST),
+            units,
+        )
+        self._proxy.start()
+
+    def _get_retained_topics(self) -> list[str]:
+        # Returns the topics we publish with the retain bit set.
+        if self.snapshot_topic is not None:
+            return [self.snapshot_topic] if self.snapshot_retain else []
+        topics = []
+        for register in self._get_registers_with("pub_topic"):
+            if register.get("retain", False) and register["pub_topic"] not in topics:
+                topics.append(register["pub_topic"])
+        return topics
+
+    def _wait_for_seed(self, condition, deadline: float) -> bool:
+        while not condition():
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return False
+            self._seed_update.wait(min(remaining, SEED_SETTLE_S / 5))
+            self._seed_update.clear()
+        return True
+
+    def _seed_from_retained(self):
+        # Briefly subscribes to our own retained topics and takes the values the
+        # broker holds as the last ones published. The first poll then only
+        # publishes values that have changed since, rather than all of them.
+        topics = self._get_retained_topics()
+        if not topics:
+            return
+        start = monotonic()
+        deadline = start + self.seed_timeout
+        self._seed_topics = set(topics)
+        self._seed_last_message = None
+        self._seed_payloads = {}
+        try:
+            if not self._wait_for_seed(self._mqtt_client.is_connected, deadline):
+                logging.warning(
+                    "Couldn't connect to MQTT in time to seed values from retained messages."
+                )
+                return
+            filters = [self.prefix + topic for topic in topics]
+            try:
+                result, self._seed_mid = self._mqtt_client.subscribe(
+                    [(topic_filter, 0) for topic_filter in filters]
+                )
+            except ValueError:
+                result = None
+            if result != mqtt.MQTT_ERR_SUCCESS:
+                logging.warning(
+                    "Failed to subscribe to retained topics: {}".format(result)
+                )
+                return
+
+            def settled():
+                if len(self._seed_payloads or {}) == len(topics):
+                    return True
+                return (
+                    self._seed_last_message is not None
+                    and monotonic() - self._seed_last_message >= SEED_SETTLE_S
+                )
+
+            self._wait_for_seed(settled, deadline)
+            self._mqtt_client.unsubscribe(filters)
+        finally:
+            seeds = self._seed_payloads or {}
+            self._seed_payloads = None
+            self._seed_mid = None
+        seeded = self._apply_seeds(seeds)
+        logging.info(
+            "Seeded {} values from {} retained messages in {:.0f} ms.".format(
+                seeded, len(seeds), (monotonic() - start) * 1000
+            )
+        )
+
+    def _apply_seeds(self, seeds: dict[str, bytes]) -> int:
+        # Sets the last published value of each register from the retained message
+        # on its topic. Returns the number of registers seeded.
+        messages: dict[str, Any] = {}
+        for topic, payload in seeds.items():
+            if topic == self.snapshot_topic:
+                codec = self._snapshot_codec
+            else:
+                codec = self._payload_codecs[topic]
+            try:
+                messages[topic] = codec.decode(payload)
+            except ValueError as e:
+                logging.debug("Couldn't seed from {}: {}".format(topic, e))
+        if self.snapshot_topic is not None:
+            document = messages.get(self.snapshot_topic, None)
+            messages = {}
+            if isinstance(document, dict) and isinstance(document.get("values"), dict):
+                messages = document["values"]
+        seeded = 0
+        for register in self._get_registers_with("pub_topic"):
+            if register["pub_topic"] not in messages:
+                continue
+            message = messages[register["pub_topic"]]
+            if "json_key" in register:
+                if not isinstance(message, dict) or register["json_key"] not in message:
+                    continue
+                value = message[register["json_key"]]
+            elif isinstance(message, dict):
+                # Published with publish_timestamps.
+                value = message.get("value", None)
+            else:
+                value = message
+            # Map from the human-readable form back to the raw number.
+            if isinstance(value, str) and value in register.get("value_map", {}):
+                value = register["value_map"][value]
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            register["value"] = value
+            seeded += 1
+        return seeded
 
     def setup_modbus(self):
         if self.config.get("word_order", "highlow").lower() == "lowhigh":
@@ -91,7 +554,12 @@ class mqtt_interface:
         else:
             write_mode = modbus_interface.WriteMode.Single
 
-        self._mb = modbus_interface.modbus_interface(
+        # Registers with their own device_address are on a multi-drop bus.
+        if any("device_address" in register for register in self.registers):
+            interface = modbus_interface.ModbusBus
+        else:
+            interface = modbus_interface.modbus_interface
+        self._mb = interface(
             ip=self.config["ip"],
             port=self.config.get("port", 502),
             device_address=self.config.get("device_address", 0x01),
@@ -103,6 +571,34 @@ class mqtt_interface:
             ),
             write_batching=self.config.get("write_batching", None),
             word_order=word_order,
+            state_file=self.config.get("state_file", None),
+            auto_batching=self.config.get("auto_batching", False),
+            min_read_batching=self.config.get(
+                "min_read_batching", modbus_interface.MIN_BATCHING
+            ),
+            target_read_latency=self.config.get(
+                "target_read_latency", modbus_interface.DEFAULT_TARGET_READ_LATENCY_S
+            ),
+            mask_write=self.config.get("mask_write", False),
+            read_write_multiple=self.config.get("read_write_multiple", False),
+            timeout=self.config.get(
+                "timeout", modbus_interface.DEFAULT_REQUEST_TIMEOUT_S
+            ),
+            retries=self.config.get(
+                "retries", modbus_interface.DEFAULT_REQUEST_RETRIES
+            ),
+            read_gap=self.config.get("read_gap", modbus_interface.DEFAULT_READ_SLEEP_S),
+            write_gap=self.config.get(
+                "write_gap", modbus_interface.DEFAULT_WRITE_SLEEP_S
+            ),
+            write_block_interval=self.config.get(
+                "write_block_interval", modbus_interface.DEFAULT_WRITE_BLOCK_INTERVAL_S
+            ),
+            tcp_keepalive=self.config.get("tcp_keepalive", None),
+            baudrate=self.config.get("baudrate", modbus_interface.DEFAULT_BAUDRATE),
+            bytesize=self.config.get("bytesize", modbus_interface.DEFAULT_BYTESIZE),
+            parity=self.config.get("parity", modbus_interface.DEFAULT_PARITY),
+            stopbits=self.config.get("stopbits", modbus_interface.DEFAULT_STOPBITS),
         )
         # Tells the modbus interface about the registers we consider interesting.
         for register in self.registers:
@@ -110,17 +606,19 @@ class mqtt_interface:
                 register.get("table", "holding"),
                 register["address"],
                 register.get("type", "uint16"),
+                **self._unit(register),
             )
             register["value"] = None
 
-    def connect_modbus(self):
+    def connect_modbus(self) -> bool:
         self.set_modbus_connection_status(ModbusConnectionStatus.Connecting)
         logging.info("Connecting to Modbus...")
         if self._mb.connect():
             logging.info("Connected to Modbus.")
             self.set_modbus_connection_status(ModbusConnectionStatus.Online)
-        else:
-            self.set_modbus_connection_status(ModbusConnectionStatus.Offline)
+            return True
+        self.set_modbus_connection_status(ModbusConnectionStatus.Offline)
+        return False
 
     def set_modbus_connection_status(self, status: ModbusConnectionStatus):
         if status == self.modbus_connection_status:
@@ -145,12 +643,23 @@ class mqtt_interface:
         exit(1)
 
     def connect_mqtt(self):
-        self._mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        if self.mqtt_version == "5":
+            self._mqtt_client = mqtt.Client(
+                mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5
+            )
+        else:
+            self._mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
         self._mqtt_client.username_pw_set(self.username, self.password)
         self._mqtt_client._on_connect = self._on_connect
         self._mqtt_client._on_disconnect = self._on_disconnect
         self._mqtt_client._on_message = self._on_message
         self._mqtt_client._on_subscribe = self._on_subscribe
+        self._mqtt_client._on_publish = self._on_publish
+        if self.max_inflight is not None:
+            # paho's own limits only apply to QoS 1 and 2. Our window covers QoS 0
+            # too, so these should never be reached.
+            self._mqtt_client.max_inflight_messages_set(self.max_inflight)
+            self._mqtt_client.max_queued_messages_set(self.max_queued)
         if self.use_tls:
             self._mqtt_client.tls_set(
                 ca_certs=self.cafile, certfile=self.cert, keyfile=self.key
@@ -171,33 +680,116 @@ class mqtt_interface:
         self._mqtt_client.connect(self.hostname, self._port, 60)
         self._mqtt_client.loop_start()
 
+    def _build_set_topic_index(self) -> dict[str, list[dict]]:
+        # Maps each set topic to the registers written by messages on it.
+        index: dict[str, list[dict]] = {}
+        for register in self._get_registers_with("set_topic"):
+            index.setdefault(register["set_topic"], []).append(register)
+        return index
+
+    def _build_get_topic_index(self) -> dict[str, list[dict]]:
+        # Maps each pub_topic to the registers published on it.
+        index: dict[str, list[dict]] = {}
+        for register in self._get_registers_with("pub_topic"):
+            index.setdefault(register["pub_topic"], []).append(register)
+        return index
+
     def _get_registers_with(self, required_key):
         # Returns the registers containing the required_key
         return [register for register in self.registers if required_key in register]
 
     def poll(self):
+        now = monotonic()
+        if not self._reconnect.ready(now):
+            # Backing off from a failing device. Don't tie up the loop with it.
+            self._publish_metrics()
+            return
+        if self._reconnect.failures and not self.connect_modbus():
+            # No point waiting out a request timeout on a link known to be down.
+            self._modbus_failed(ConnectionError("Couldn't reconnect."))
+            self._publish_metrics()
+            return
         try:
             self._mb.poll()
             self.set_modbus_connection_status(ModbusConnectionStatus.Online)
         except Exception as e:
+            self._modbus_failed(e)
+            self._publish_metrics()
+            return
+        if self._reconnect.failures:
+            logging.info("Modbus device is back.")
+            self._reconnect.success()
+        if self._shared_image is not None:
+            self._shared_image.update(self._get_image_tables(), time())
+
+        # This poll has just read anything asked for on the get topics.
+        with self._get_lock:
+            requested = set(self._get_requests)
+            self._get_requests.clear()
+            self._get_requested_at = None
+        self._publish_values(self._get_registers_with("pub_topic"), requested)
+        self._first_publish = False
+        self._publish_metrics()
+
+    def _get_image_tables(self) -> dict:
+        # The tables of devices on a shared bus are named <table>@<device_address>.
+        if not isinstance(self._mb, modbus_interface.ModbusBus):
+            return self._mb.get_tables()
+        tables = {}
+        for unit in self._mb.get_units():
+            for name, table in self._mb.get_tables(unit).items():
+                tables["{}@{}".format(name, unit)] = table
+        return tables
+
+    def _modbus_failed(self, e: Exception):
+        delay = self._reconnect.failure(monotonic())
+        if self._reconnect.state == "open":
             logging.error(
-                "Failed to poll modbus device, attempting to reconnect: {}".format(e)
+                "Failed to poll modbus device {} times in a row, pausing for {:.0f} s: {}".format(
+                    self._reconnect.failures, delay, e
+                )
+            )
+        else:
+            logging.error(
+                "Failed to poll modbus device, reconnecting in {:.1f} s: {}".format(
+                    delay, e
+                )
             )
-            self.set_modbus_connection_status(ModbusConnectionStatus.Offline)
-            self.connect_modbus()
+        self.set_modbus_connection_status(ModbusConnectionStatus.Offline)
+
+    def _check_modbus_link(self):
+        # Between polls, finds a link that's died quietly, so it's reconnected
+        # before the next poll rather than failing it.
+        if self.idle_probe_interval is None or self._reconnect.failures:
             return
+        try:
+            self._mb.check_link(self.idle_probe_interval)
+        except Exception as e:
+            self._modbus_failed(e)
 
-        # This is used to store values that are published as JSON messages rather than individual values
-        json_messages = {}
-        json_messages_retain = {}
+    def _publish_values(self, registers: list[dict], requested: set[int] | None = None):
+        # Publishes the values of these registers that need publishing. Registers
+        # whose id() is in requested were asked for, so are published regardless.
+        requested = requested or set()
+        poll_time = time()
+        # The messages to publish this poll, keyed by topic. Registers with a
+        # json_key share a dict. Everything else is a single value.
+        messages: dict[str, Any] = {}
+        messages_retain: dict[str, bool] = {}
+        messages_qos: dict[str, int] = {}
+        json_messages_read_time: dict[str, float | None] = {}
 
-        for register in self._get_registers_with("pub_topic"):
+        for register in registers:
             try:
                 value = self._mb.get_value(
                     register.get("table", "holding"),
                     register["address"],
                     register.get("type", "uint16"),
+                    **self._unit(register),
                 )
+            except modbus_interface.UnreadableAddressError:
+                # Already logged when the address was found to be unreadable.
+                continue
             except Exception:
                 logging.warning(
                     "Couldn't get value from register {} in table {}".format(
@@ -205,90 +797,598 @@ class mqtt_interface:
                     )
                 )
                 continue
-            # Filter the value through the mask, if present.
-            if "mask" in register:
-                # masks only make sense for uint
-                if register.get("type", "uint16") in ["uint16", "uint32", "uint64"]:
-                    value &= register.get("mask")
-            # Scale the value, if required.
-            value *= register.get("scale", 1)
-            # Clamp the number of decimal points
-            value = round(value, MAX_DECIMAL_POINTS)
+            value = self._scale_value(register, value)
             changed = False
             if value != register["value"]:
                 changed = True
                 register["value"] = value
-            if not changed and register.get("pub_only_on_change", True):
+            if (
+                not changed
+                and register.get("pub_only_on_change", True)
+                and not (
+                    self.snapshot_topic is not None and self.snapshot_mode == "all"
+                )
+                and id(register) not in requested
+            ):
                 continue
-            # Map from the raw number back to the human-readable form
-            if "value_map" in register:
-                if value in register["value_map"].values():
-                    # This is a bit weird...
-                    value = [
-                        human
-                        for human, raw in register["value_map"].items()
-                        if raw == value
-                    ][0]
+            value = self._map_value(register, value)
+            read_time = None
+            if self.publish_timestamps:
+                read_time = self._mb.get_read_time(
+                    register.get("table", "holding"),
+                    register["address"],
+                    register.get("type", "uint16"),
+                    **self._unit(register),
+                )
+            topic = register["pub_topic"]
             if register.get("json_key", False):
-                # This value won't get published to MQTT immediately. It gets stored and sent at the end of the poll.
-                if register["pub_topic"] not in json_messages:
-                    json_messages[register["pub_topic"]] = {}
-                    json_messages_retain[register["pub_topic"]] = False
-                json_messages[register["pub_topic"]][register["json_key"]] = value
+                if topic not in messages:
+                    messages[topic] = {}
+                    messages_retain[topic] = False
+                    messages_qos[topic] = 0
+                    json_messages_read_time[topic] = read_time
+                messages[topic][register["json_key"]] = value
                 if "retain" in register:
-                    json_messages_retain[register["pub_topic"]] = register["retain"]
+                    messages_retain[topic] = register["retain"]
+                # A JSON message goes out at the highest QoS of its values.
+                messages_qos[topic] = max(
+                    messages_qos[topic], register.get("qos", self.qos)
+                )
+                # A JSON message is timestamped with its oldest value.
+                oldest = json_messages_read_time[topic]
+                if read_time is not None and (oldest is None or read_time < oldest):
+                    json_messages_read_time[topic] = read_time
             else:
-                retain = register.get("retain", False)
-                self._mqtt_client.publish(
-                    self.prefix + register["pub_topic"], value, retain=retain
+                if self.publish_timestamps:
+                    value = {"timestamp": _format_read_time(read_time), "value": value}
+                messages[topic] = value
+                messages_retain[topic] = register.get("retain", False)
+                messages_qos[topic] = register.get("qos", self.qos)
+        if self.publish_timestamps:
+            for topic, read_time in json_messages_read_time.items():
+                messages[topic]["timestamp"] = _format_read_time(read_time)
+        if self._api is not None:
+            self._update_api(registers)
+
+        if self.snapshot_topic is not None:
+            self._publish_snapshot(self.snapshot_topic, messages, poll_time)
+        else:
+            # The first poll publishes every value, so it can be paced.
+            interval = 0.0
+            if self._first_publish and self.startup_publish_rate:
+                interval = 1 / self.startup_publish_rate
+            started_at = monotonic()
+            for index, (topic, message) in enumerate(messages.items()):
+                if interval:
+                    delay = started_at + index * interval - monotonic()
+                    if delay > 0:
+                        sleep(delay)
+                self._publish(
+                    self.prefix + topic,
+                    self._payload_codecs[topic].encode(message),
+                    messages_retain[topic],
+                    messages_qos[topic],
                 )
 
-        # Transmit the queued JSON messages.
-        for topic, message in json_messages.items():
-            m = json.dumps(message, sort_keys=True)
-            self._mqtt_client.publish(
-                self.prefix + topic, m, retain=json_messages_retain[topic]
-            )
+    @staticmethod
+    def _scale_value(register: dict, value):
+        # Filter the value through the mask, if present.
+        if "mask" in register:
+            # masks only make sense for uint
+            if register.get("type", "uint16") in ["uint16", "uint32", "uint64"]:
+                value &= register.get("mask")
+        # Scale the value, if required.
+        value *= register.get("scale", 1)
+        # Clamp the number of decimal points
+        return round(value, MAX_DECIMAL_POINTS)
 
-    def _on_connect(self, client, userdata, flags, reason_code, properties):
-        if reason_code == 0:
-            logging.info("Connected to MQTT.")
-        else:
-            logging.error("Couldn't connect to MQTT.")
-            return
-        # Subscribe to all the set topics.
-        for register in self._get_registers_with("set_topic"):
-            result = self._mqtt_client.subscribe(self.prefix + register["set_topic"])
+    @staticmethod
+    def _map_value(register: dict, value):
+        # Map from the raw number back to the human-readable form
+        if "value_map" in register:
+            if value in register["value_map"].values():
+                # This is a bit weird...
+                value = [
+                    human
+                    for human, raw in register["value_map"].items()
+                    if raw == value
+                ][0]
+        return value
 
+    def _publish_write_event(self, register: dict, state: str, value, expected=None):
+        event = {
+            "set_topic": register["set_topic"],
+            "state": state,
+            "timestamp": _format_read_time(time()),
+            "value": self._map_value(register, self._scale_value(register, value)),
+        }
+        if expected is not None:
+            event["expected"] = self._map_value(
+                register, self._scale_value(register, expected)
+            )
+        self._publish_telemetry(
+            self.prefix + self.write_event_topic,
+            json.dumps(event, sort_keys=True),
+            False,
+        )
+
+    def _process_read_backs(self):
+        # Reads back just the registers written since the last time, and publishes
+        # whether the device took the new values.
+        while self._read_backs:
+            register, written = self._read_backs.popleft()
             try:
-                success, mid = result
-            except ValueError:
-                logging.error(
-                    "Failed to subscribe to {}. Not enough return values.".format(
-                        self.prefix + register["set_topic"]
+                value = self._mb.refresh_value(
+                    register.get("table", "holding"),
+                    register["address"],
+                    register.get("type", "uint16"),
+                    **self._unit(register),
+                )
+            except Exception as e:
+                logging.warning(
+                    "Couldn't read back register {} after writing it: {}".format(
+                        register["address"], e
                     )
                 )
+                self._publish_write_event(register, "failed", written)
                 continue
-            if success != mqtt.MQTT_ERR_SUCCESS:
-                logging.error(
-                    "Failed to subscribe to {}: {}".format(
-                        self.prefix + register["set_topic"], success
+            if self._scale_value(register, value) == self._scale_value(
+                register, written
+            ):
+                self._publish_write_event(register, "confirmed", value)
+            else:
+                logging.warning(
+                    "Register {} reads back as {} after writing {}.".format(
+                        register["address"], value, written
                     )
                 )
+                self._publish_write_event(register, "mismatch", value, written)
+            if "pub_topic" in register:
+                self._publish_values([register])
+
+    def _request_get(self, registers: list[dict]):
+        # Called from the MQTT thread. The main loop reads them once the get window
+        # has passed, so requests arriving together share their reads.
+        with self._get_lock:
+            for register in registers:
+                self._get_requests[id(register)] = register
+            if self._get_requested_at is None:
+                self._get_requested_at = monotonic()
+        self._wake.set()
+
+    def _request_get_batch(self, payload: bytes):
+        try:
+            topics = json.loads(payload)
+        except ValueError:
+            topics = None
+        if not isinstance(topics, list) or not all(
+            isinstance(topic, str) for topic in topics
+        ):
+            logging.error(
+                "Get requests must be a JSON list of topics. Payload: {!r}".format(
+                    payload
+                )
+            )
+            return
+        registers = []
+        for topic in topics:
+            if topic not in self._get_topic_index:
+                logging.warning("Get request for unknown topic {}".format(topic))
                 continue
-            self._subscription_mids[mid] = self.prefix + register["set_topic"]
-            logging.info(
-                "Subscribing to {}".format(self.prefix + register["set_topic"])
+            registers += self._get_topic_index[topic]
+        if registers:
+            self._request_get(registers)
+
+    def _get_window_remaining(self) -> float | None:
+        # Seconds until the pending get requests are due to be read, if there are any.
+        with self._get_lock:
+            if self._get_requested_at is None:
+                return None
+            return max(0.0, self._get_requested_at + self.get_window - monotonic())
+
+    def _process_get_requests(self, next_poll_time: float):
+        # Reads the registers asked for on the get topics and publishes them. The
+        # words they need are merged into as few reads as possible. Requests made
+        # just before a poll are left for it to serve.
+        with self._get_lock:
+            if self._get_requested_at is None:
+                return
+            now = monotonic()
+            if now < self._get_requested_at + self.get_window:
+                return
+            if next_poll_time - now <= self.get_window:
+                return
+            registers = list(self._get_requests.values())
+            self._get_requests.clear()
+            self._get_requested_at = None
+        if self._reconnect.failures:
+            logging.warning(
+                "Dropping get requests for {} registers while the modbus device is offline.".format(
+                    len(registers)
+                )
+            )
+            return
+        ranges: dict[tuple[str, int | None], list[tuple[int, int]]] = {}
+        for register in registers:
+            ranges.setdefault(
+                (register.get("table", "holding"), register.get("device_address")), []
+            ).append(
+                (
+                    register["address"],
+                    modbus_interface.type_length(register.get("type", "uint16")),
+                )
             )
+        # The words that couldn't be read, as (table, device_address, address).
+        failed: set[tuple[str, int | None, int]] = set()
+        for (table, unit), table_ranges in ranges.items():
+            unit_kwargs = {} if unit is None else {"unit": unit}
+            # Merged no further than the table's tuned read batching, and never
+            # with addresses the device has refused, so a bad neighbour doesn't
+            # fail the whole read.
+            table_cache = self._mb.get_tables(**unit_kwargs)[table]
+            for start, length in modbus_interface.merge_ranges(
+                table_ranges,
+                table_cache.get_read_batch_size(),
+                table_cache.get_unreadable(),
+            ):
+                try:
+                    self._mb.refresh_range(table, start, length, **unit_kwargs)
+                except Exception as e:
+                    logging.warning(
+                        "Couldn't read registers {} to {} in table {} for a get request: {}".format(
+                            start, start + length - 1, table, e
+                        )
+                    )
+                    failed.update(
+                        (table, unit, addr) for addr in range(start, start + length)
+                    )
+        # Only what was just read is published.
+        registers = [
+            register
+            for register in registers
+            if not any(
+                (
+                    register.get("table", "holding"),
+                    register.get("device_address"),
+                    register["address"] + i,
+                )
+                in failed
+                for i in range(
+                    modbus_interface.type_length(register.get("type", "uint16"))
+                )
+            )
+        ]
+        self._publish_values(registers, {id(register) for register in registers})
+
+    def _publish_snapshot(self, topic: str, messages: dict[str, Any], poll_time: float):
+        # Publishes every message from this poll as a single document keyed by topic.
+        if not messages:
+            return
+        payload = self._snapshot_codec.encode(
+            {"timestamp": _format_read_time(poll_time), "values": messages}
+        )
+        self._publish(self.prefix + topic, payload, self.snapshot_retain, self.qos)
+
+    def _publish(self, topic: str, payload, retain: bool, qos: int = 0):
+        # Publishes a register value, spooling it to disk if MQTT is offline, or
+        # queueing it behind the publish window if there is one.
+        if self._spool is not None and not self._mqtt_client.is_connected():
+            self._spool_message(topic, payload, retain)
+            return
+        if self.max_inflight is None:
+            self._send(topic, payload, retain, qos)
+            return
+        self._enqueue(topic, payload, retain, qos)
+        self._pump_publish_queue()
+
+    def _send(self, topic: str, payload, retain: bool, qos: int):
+        info = self._publish_telemetry(topic, payload, retain, qos)
+        # paho keeps QoS 1 and 2 messages until it reconnects, but QoS 0 ones are lost.
+        if self._spool is not None and qos == 0 and info.rc == mqtt.MQTT_ERR_NO_CONN:
+            self._spool_message(topic, payload, retain)
+        return info
+
+    def _spool_message(self, topic: str, payload, retain: bool):
+        assert self._spool is not None
+        try:
+            if not isinstance(payload, bytes):
+                payload = str(payload).encode("utf-8")
+            self._spool.append(topic, payload, retain, time())
+        except ValueError as e:
+            logging.warning("Couldn't spool message: {}".format(e))
+
+    def _enqueue(self, topic: str, payload, retain: bool, qos: int):
+        if self.publish_overload == "drop_stale":
+            if topic in self._publish_queue:
+                # The unsent value is stale now. Replace it.
+                self._queue_dropped += 1
+                del self._publish_queue[topic]
+            elif len(self._publish_queue) >= self.max_queued:
+                self._publish_queue.popitem(last=False)
+                self._queue_dropped += 1
+            self._publish_queue[topic] = (topic, payload, retain, qos)
+            return
+        # The block policy holds up polling until the broker makes room, unless
+        # MQTT goes away, in which case waiting wouldn't help.
+        blocked_at = monotonic()
+        while len(self._publish_queue) >= self.max_queued and self._running:
+            self._pump_publish_queue()
+            if len(self._publish_queue) < self.max_queued:
+                break
+            if not self._mqtt_client.is_connected():
+                self._publish_queue.popitem(last=False)
+                self._queue_dropped += 1
+                break
+            if self._wake.wait(PUBLISH_BLOCK_INTERVAL_S):
+                self._wake.clear()
+        self._queue_blocked_s += monotonic() - blocked_at
+        self._queue_sequence += 1
+        self._publish_queue[self._queue_sequence] = (topic, payload, retain, qos)
+
+    def _pump_publish_queue(self):
+        # Hands queued messages to paho while there's room in the window.
+        with self._queue_lock:
+            self._in_flight = [
+                info
+                for info in self._in_flight
+                if info.rc == mqtt.MQTT_ERR_SUCCESS and not info.is_published()
+            ]
+            room = self.max_inflight - len(self._in_flight) if self.max_inflight else 0
+        while room > 0 and self._publish_queue:
+            _, (topic, payload, retain, qos) = self._publish_queue.popitem(last=False)
+            info = self._send(topic, payload, retain, qos)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                with self._queue_lock:
+                    self._in_flight.append(info)
+                room -= 1
+
+    def _publish_telemetry(self, topic: str, payload, retain: bool, qos: int = 0):
+        # Publishes a message, using MQTT 5 topic aliases and message expiry if
+        # enabled.
+        if self.mqtt_version != "5":
+            if qos:
+                return self._mqtt_client.publish(topic, payload, qos=qos, retain=retain)
+            return self._mqtt_client.publish(topic, payload, retain=retain)
+        properties = Properties(PacketTypes.PUBLISH)
+        if self.message_expiry is not None:
+            properties.MessageExpiryInterval = self.message_expiry
+        with self._alias_lock:
+            alias = self._topic_aliases.get(topic)
+            if qos:
+                # paho resends QoS 1 and 2 messages after a reconnect, when the
+                # alias no longer means anything, so they always carry the topic.
+                alias = None
+            if alias is not None:
+                # The broker already knows this alias, so the topic can be left out.
+                properties.TopicAlias = alias
+                topic = ""
+            elif qos:
+                pass
+            elif topic not in self._topics_seen:
+                self._topics_seen.add(topic)
+            elif len(self._topic_aliases) < self._topic_alias_maximum:
+                # This topic is published repeatedly. Send it once more alongside
+                # a new alias, and use just the alias after that.
+                alias = len(self._topic_aliases) + 1
+                self._topic_aliases[topic] = alias
+                properties.TopicAlias = alias
+        if qos:
+            return self._mqtt_client.publish(
+                topic, payload, qos=qos, retain=retain, properties=properties
+            )
+        return self._mqtt_client.publish(
+            topic, payload, retain=retain, properties=properties
+        )
+
+    def _replay_spool(self):
+        # Replays spooled messages, oldest first, at no more than spool_replay_rate
+        # per second. They're never retained, as newer values may already have been
+        # published, and they carry the time they were captured.
+        now = monotonic()
+        self._replay_allowance = min(
+            max(1.0, self.spool_replay_rate * SPOOL_REPLAY_INTERVAL_S),
+            self._replay_allowance + (now - self._replayed_at) * self.spool_replay_rate,
+        )
+        self._replayed_at = now
+        if self._spool is None or not self._mqtt_client.is_connected():
+            return
+        if self._publish_queue:
+            # Live values go first.
+            return
+        while self._replay_allowance >= 1:
+            message = self._spool.pop()
+            if message is None:
+                return
+            topic, payload, _, timestamp = message
+            self._publish_telemetry(
+                topic, self._timestamped_payload(topic, payload, timestamp), False
+            )
+            self._replay_allowance -= 1
+
+    def _timestamped_payload(
+        self, topic: str, payload: bytes, timestamp: float
+    ) -> str | bytes:
+        # JSON messages get a timestamp key. Plain values are wrapped in a JSON
+        # object alongside their timestamp. Both are re-encoded with the codec of
+        # their topic.
+        codec = self._payload_codecs.get(topic[len(self.prefix) :])
+        if (
+            self.snapshot_topic is not None
+            and topic == self.prefix + self.snapshot_topic
+        ):
+            codec = self._snapshot_codec
+        if not topic.startswith(self.prefix) or codec is None:
+            codec = payloads.PayloadCodec()
+        try:
+            value = codec.decode(payload)
+        except ValueError:
+            return payload
+        formatted = (
+            datetime.fromtimestamp(timestamp)
+            .astimezone()
+            .strftime("%Y-%m-%dT%H:%M:%S%z")
+        )
+        if isinstance(value, dict):
+            # Values published with their read time keep it.
+            value.setdefault("timestamp", formatted)
+        else:
+            value = {"timestamp": formatted, "value": value}
+        return codec.encode(value)
+
+    def _publish_metrics(self):
+        if self.metrics_interval is None:
+            return
+        now = monotonic()
+        if (
+            self._metrics_published_at is not None
+            and now - self._metrics_published_at < self.metrics_interval
+        ):
+            return
+        self._metrics_published_at = now
+        metrics = self._mb.get_metrics()
+        metrics["mqtt_publishes_rejected"] = self._publishes_rejected
+        metrics["modbus_reconnect"] = {
+            "state": self._reconnect.state,
+            "failures": self._reconnect.failures,
+        }
+        if self._spool is not None:
+            metrics["spool"] = {
+                "pending": len(self._spool),
+                "dropped": self._spool.dropped,
+            }
+        if self._proxy is not None:
+            metrics["proxy"] = self._proxy.get_metrics()
+        if self.max_inflight is not None:
+            with self._queue_lock:
+                in_flight = len(self._in_flight)
+            metrics["mqtt_queue"] = {
+                "depth": len(self._publish_queue),
+                "in_flight": in_flight,
+                "dropped": self._queue_dropped,
+                "blocked_s": round(self._queue_blocked_s, 3),
+            }
+        metrics["timestamp"] = (
+            datetime.now().astimezone().strftime("%Y-%m-%dT%H:%M:%S%z")
+        )
+        self._publish_telemetry(
+            self.prefix + "modbus4mqtt/metrics",
+            json.dumps(metrics, sort_keys=True),
+            False,
+        )
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code == 0:
+            logging.info("Connected to MQTT.")
+            self._seed_update.set()
+        else:
+            logging.error("Couldn't connect to MQTT: {}".format(reason_code))
+            return
+        with self._alias_lock:
+            # Topic aliases only last as long as the connection.
+            self._topic_aliases = {}
+            self._topics_seen = set()
+            self._topic_alias_maximum = getattr(properties, "TopicAliasMaximum", 0)
+        with self._queue_lock:
+            # QoS 0 messages that were in flight were lost with the old connection.
+            # paho resends the others by itself.
+            self._in_flight = []
+        # Subscribe to all the set topics.
+        subscriptions = self._get_subscriptions()
+        if not subscriptions:
+            self._set_mqtt_connection_status(MqttConnectionStatus.Online)
+            return
+        for topic_filters in subscriptions:
+            self._subscribe(topic_filters)
         self._set_mqtt_connection_status(MqttConnectionStatus.Subscribing)
 
+    def _get_subscriptions(self) -> list[list[str]]:
+        # Returns the topic filters to subscribe to, grouped into SUBSCRIBE packets.
+        set_topics = list(self._set_topic_index)
+        subscriptions = []
+        if not set_topics:
+            pass
+        elif self.set_topic_subscription == "wildcard":
+            # One filter covering every set topic. Messages on topics that aren't
+            # set topics are dropped by _on_message.
+            subscriptions = [[self.prefix + self.set_topic_wildcard]]
+        elif self.set_topic_subscription == "combined":
+            # One SUBSCRIBE packet carrying every set topic, so there's only a
+            # single SUBACK to wait for.
+            subscriptions = [[self.prefix + topic for topic in set_topics]]
+        else:
+            subscriptions = [[self.prefix + topic] for topic in set_topics]
+        if self.remote_reload:
+            subscriptions.append([self.prefix + RELOAD_TOPIC])
+        if self.get_topics:
+            get_topics = [
+                self.prefix + topic + GET_TOPIC_SUFFIX
+                for topic in self._get_topic_index
+            ] + [self.prefix + GET_TOPIC]
+            if self.set_topic_subscription == "individual":
+                subscriptions += [[topic] for topic in get_topics]
+            else:
+                subscriptions.append(get_topics)
+        return subscriptions
+
+    def _subscribe(self, topic_filters: list[str]):
+        if len(topic_filters) == 1:
+            description = topic_filters[0]
+            result = self._mqtt_client.subscribe(topic_filters[0])
+        else:
+            description = "{} set topics".format(len(topic_filters))
+            result = self._mqtt_client.subscribe(
+                [(topic_filter, 0) for topic_filter in topic_filters]
+            )
+        try:
+            success, mid = result
+        except ValueError:
+            logging.error(
+                "Failed to subscribe to {}. Not enough return values.".format(
+                    description
+                )
+            )
+            return
+        if success != mqtt.MQTT_ERR_SUCCESS:
+            logging.error("Failed to subscribe to {}: {}".format(description, success))
+            return
+        self._subscription_mids[mid] = description
+        logging.info("Subscribing to {}".format(description))
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        # Only QoS 1 and 2 messages are acknowledged. MQTT 5 brokers say why they
+        # rejected one.
+        if getattr(reason_code, "is_failure", False):
+            self._publishes_rejected += 1
+            logging.warning(
+                "The broker rejected message {}: {}".format(mid, reason_code)
+            )
+        if self._publish_queue:
+            # There's room in the window now. The main loop sends the next ones.
+            self._wake.set()
+
     def _on_disconnect(self, client, userdata, flags, reason_code, properties):
         logging.warning("Disconnected from MQTT. Attempting to reconnect.")
 
     def _on_subscribe(self, client, userdata, mid, reason_code_list, properties):
-        logging.info(
-            f"Subscribed to {self._subscription_mids.get(mid, 'unknown topic')}."
-        )
+        if mid == self._seed_mid:
+            # Retained messages follow.
+            self._seed_last_message = monotonic()
+            self._seed_update.set()
+            return
+        description = self._subscription_mids.get(mid, "unknown topic")
+        failures = [
+            reason_code
+            for reason_code in reason_code_list
+            if getattr(reason_code, "is_failure", False)
+        ]
+        if failures:
+            logging.error(
+                "The broker refused the subscription to {}: {}".format(
+                    description, ", ".join(str(failure) for failure in failures)
+                )
+            )
+        else:
+            logging.info(f"Subscribed to {description}.")
         self._subscription_mids.pop(mid, None)
         if not self._subscription_mids:
             logging.info("Subscribed to all set topics.")
@@ -316,27 +1416,83 @@ class mqtt_interface:
 
     def _on_message(self, client, userdata, msg):
         # print("got a message: {}: {}".format(msg.topic, msg.payload))
-        # TODO Handle json_key writes. https://github.com/tjhowse/modbus4mqtt/issues/23
         topic = msg.topic[len(self.prefix) :]
-        for register in [
-            register for register in self.registers if "set_topic" in register
-        ]:
-            if topic != register["set_topic"]:
-                continue
+        seeds = self._seed_payloads
+        if seeds is not None and msg.retain and topic in self._seed_topics:
+            seeds[topic] = msg.payload
+            self._seed_last_message = monotonic()
+            self._seed_update.set()
+            return
+        if topic == RELOAD_TOPIC and self.remote_reload:
+            self.request_reload()
+            return
+        if self.get_topics:
+            if topic == GET_TOPIC:
+                self._request_get_batch(msg.payload)
+                return
+            if topic.endswith(GET_TOPIC_SUFFIX):
+                registers = self._get_topic_index.get(
+                    topic[: -len(GET_TOPIC_SUFFIX)], []
+                )
+                if registers:
+                    self._request_get(registers)
+                    return
+        registers = self._set_topic_index.get(topic, [])
+        if registers and "json_key" in registers[0]:
+            self._set_json_fields(topic, registers, msg.payload)
+            return
+        for register in registers:
             # We received a set topic message for this topic.
-            value = msg.payload
-            if "value_map" in register:
+            value = self._convert_set_value(register, topic, msg.payload)
+            if value is None:
+                continue
+            self._write_register(register, value)
+
+    def _set_json_fields(self, topic: str, registers: list[dict], payload: bytes):
+        # A JSON object on a set topic shared through json_key sets any of its
+        # registers at once. The changed words are written together, in as few
+        # requests as the write batching allows.
+        try:
+            fields = json.loads(payload)
+        except ValueError:
+            logging.error(
+                "Failed to decode JSON set message. Topic: {}, Payload: {!r}".format(
+                    topic, payload
+                )
+            )
+            return
+        if not isinstance(fields, dict):
+            logging.error(
+                "JSON set messages must be an object. Topic: {}, Payload: {!r}".format(
+                    topic, payload
+                )
+            )
+            return
+        written = []
+        # Hold the write lock until the flush, so a poll ending on another
+        # thread can't send some of these fields without the rest.
+        with self._mb.write_lock():
+            for register in registers:
+                if register["json_key"] not in fields:
+                    continue
+                value = self._convert_set_value(
+                    register, topic, fields[register["json_key"]]
+                )
+                if value is None:
+                    continue
+                self._write_register(register, value, flush=False)
+                written.append((register, value))
+            self._mb.flush_writes()
+        for register, value in written:
+            self._report_write(register, value)
+
+    def _convert_set_value(self, register: dict, topic: str, value) -> int | None:
+        # Turns a value from a set message into the raw modbus number. Returns None,
+        # having logged why, if it can't be.
+        if "value_map" in register:
+            if isinstance(value, bytes):
                 try:
                     value = str(value, "utf-8")
-                    if value not in register["value_map"]:
-                        logging.warning(
-                            "Value not in value_map. Topic: {}, value: {}, valid values: {}".format(
-                                topic, value, register["value_map"].keys()
-                            )
-                        )
-                        continue
-                    # Map the value from the human-readable form into the raw modbus number
-                    value = register["value_map"][value]
                 except UnicodeDecodeError:
                     logging.warning(
                         "Failed to decode MQTT payload as UTF-8. "
@@ -344,26 +1500,65 @@ class mqtt_interface:
                             register
                         )
                     )
-                    continue
-            try:
-                # Scale the value, if required.
-                value = float(value)
-                value = round(value / register.get("scale", 1))
-            except ValueError:
-                logging.error(
-                    "Failed to convert register value for writing. "
-                    "Bad/missing value_map? Topic: {}, Value: {}".format(topic, value)
+                    return None
+            if not isinstance(value, str) or value not in register["value_map"]:
+                logging.warning(
+                    "Value not in value_map. Topic: {}, value: {}, valid values: {}".format(
+                        topic, value, register["value_map"].keys()
+                    )
                 )
-                continue
-            type = register.get("type", "uint16")
+                return None
+            # Map the value from the human-readable form into the raw modbus number
+            value = register["value_map"][value]
+        try:
+            # Scale the value, if required.
+            value = float(value)
+            return int(round(value / register.get("scale", 1)))
+        except (TypeError, ValueError):
+            logging.error(
+                "Failed to convert register value for writing. "
+                "Bad/missing value_map? Topic: {}, Value: {}".format(topic, value)
+            )
+            return None
+
+    @staticmethod
+    def _unit(register: dict) -> dict:
+        # The device address argument for registers that have their own.
+        if "device_address" in register:
+            return {"unit": register["device_address"]}
+        return {}
+
+    def _write_register(self, register: dict, value: int, flush: bool = True):
+        type = register.get("type", "uint16")
+        if flush:
+            self._mb.set_value(
+                register.get("table", "holding"),
+                register["address"],
+                value,
+                register.get("mask", 0xFFFF),
+                type,
+                **self._unit(register),
+            )
+            self._report_write(register, value)
+        else:
             self._mb.set_value(
                 register.get("table", "holding"),
                 register["address"],
-                int(value),
+                value,
                 register.get("mask", 0xFFFF),
                 type,
+                flush=False,
+                **self._unit(register),
             )
 
+    def _report_write(self, register: dict, value: int):
+        if self.write_feedback:
+            # Say what was written straight away, then have the main loop read
+            # it back to confirm it.
+            self._publish_write_event(register, "pending", value)
+            self._read_backs.append((register, value))
+            self._wake.set()
+
     # This throws ValueError exceptions if the imported registers are invalid
     @staticmethod
     def _validate_registers(registers):
@@ -373,6 +1568,8 @@ class mqtt_interface:
         duplicate_json_keys = {}
         # Key: shared pub_topics, value: set of retain values (true/false)
         retain_setting = {}
+        # Key: shared pub_topics, value: set of (payload_codec, group_compression) values
+        codec_setting = {}
         valid_types = ["uint16", "int16", "uint32", "int32", "uint64", "int64"]
 
         # Look for duplicate pub_topics
@@ -384,22 +1581,33 @@ class mqtt_interface:
                         type
                     )
                 )
+            if "device_address" in register and register["device_address"] not in range(
+                1, 248
+            ):
+                raise ValueError(
+                    "Bad YAML configuration. Register has invalid device_address '{}'.".format(
+                        register["device_address"]
+                    )
+                )
+            if register.get("qos", 0) not in QOS_LEVELS:
+                raise ValueError(
+                    "Bad YAML configuration. Register has invalid qos '{}'.".format(
+                        register["qos"]
+                    )
+                )
+            if "pub_topic" not in register:
+                # Only written to.
+                continue
             if register["pub_topic"] in all_pub_topics:
                 duplicate_pub_topics.add(register["pub_topic"])
                 duplicate_json_keys[register["pub_topic"]] = []
                 retain_setting[register["pub_topic"]] = set()
-            if "json_key" in register and "set_topic" in register:
-                raise ValueError(
-                    "Bad YAML configuration. Register with set_topic '{}' has a json_key specified. "
-                    "This is invalid. See https://github.com/tjhowse/modbus4mqtt/issues/23 for details.".format(
-                        register["set_topic"]
-                    )
-                )
+                codec_setting[register["pub_topic"]] = set()
             all_pub_topics.add(register["pub_topic"])
 
         # Check that all registers with duplicate pub topics have json_keys
         for register in registers:
-            if register["pub_topic"] in duplicate_pub_topics:
+            if register.get("pub_topic") in duplicate_pub_topics:
                 if "json_key" not in register:
                     raise ValueError(
                         "Bad YAML configuration. pub_topic '{}' duplicated across registers without "
@@ -415,6 +1623,13 @@ class mqtt_interface:
                 duplicate_json_keys[register["pub_topic"]] += [register["json_key"]]
                 if "retain" in register:
                     retain_setting[register["pub_topic"]].add(register["retain"])
+                if "payload_codec" in register or "group_compression" in register:
+                    codec_setting[register["pub_topic"]].add(
+                        (
+                            register.get("payload_codec"),
+                            register.get("group_compression"),
+                        )
+                    )
         # Check that there are no disagreements as to whether this pub_topic should be retained or not.
         for topic, retain_set in retain_setting.items():
             if len(retain_set) > 1:
@@ -423,11 +1638,43 @@ class mqtt_interface:
                         topic
                     )
                 )
+        for topic, codec_set in codec_setting.items():
+            if len(codec_set) > 1:
+                raise ValueError(
+                    "Bad YAML configuration. pub_topic '{}' has conflicting payload_codec or "
+                    "group_compression settings.".format(topic)
+                )
+        # Registers sharing a set_topic through json_key must all have a unique json_key.
+        set_topic_json_keys: dict[str, list] = {}
+        for register in registers:
+            if "set_topic" in register:
+                if "json_key" in register and not isinstance(register["json_key"], str):
+                    # Keys in a JSON object are always strings, so it could never match.
+                    raise ValueError(
+                        "Bad YAML configuration. set_topic '{}' has a json_key that isn't a "
+                        "string.".format(register["set_topic"])
+                    )
+                set_topic_json_keys.setdefault(register["set_topic"], []).append(
+                    register.get("json_key", None)
+                )
+        for topic, json_keys in set_topic_json_keys.items():
+            if all(json_key is None for json_key in json_keys):
+                continue
+            if None in json_keys:
+                raise ValueError(
+                    "Bad YAML configuration. set_topic '{}' is shared by registers with and "
+                    "without a json_key. Registers that share a JSON set_topic must all have "
+                    "a json_key.".format(topic)
+                )
+            if len(set(json_keys)) != len(json_keys):
+                raise ValueError(
+                    "Bad YAML configuration. set_topic '{}' duplicated across registers with a "
+                    "duplicated json_key field.".format(topic)
+                )
 
     def _load_modbus_config(self, path: str) -> dict:
-        yaml = YAML(typ="safe")
         try:
-            result = yaml.load(open(path, "r").read())
+            raw = open(path, "rb").read()
         except FileNotFoundError:
             # Try to re-map the path from the old config path to the new one.
             alt_path = path.replace("/modbus4mqtt/modbus4mqtt", "/modbus4mqtt/config")
@@ -436,11 +1683,22 @@ class mqtt_interface:
                     path, alt_path
                 )
             )
-            result = yaml.load(open(alt_path, "r").read())
-        registers = [
-            register for register in result["registers"] if "pub_topic" in register
-        ]
-        mqtt_interface._validate_registers(registers)
+            raw = open(alt_path, "rb").read()
+
+        result = self._load_cached_config(raw)
+        if result is None:
+            # ruamel.yaml is slow to import, so only pay for it when the cache misses.
+            from ruamel.yaml import YAML
+
+            yaml = YAML(typ="safe")
+            result = yaml.load(raw.decode("utf-8"))
+            registers = [
+                register
+                for register in result["registers"]
+                if "pub_topic" in register or "set_topic" in register
+            ]
+            mqtt_interface._validate_registers(registers)
+            self._save_cached_config(raw, result)
 
         if "scan_batching" in result:
             logging.warning(
@@ -450,20 +1708,214 @@ class mqtt_interface:
             )
         return result
 
+    def _config_cache_path(self, raw: bytes) -> str | None:
+        # Compiled configs are keyed by the content of the YAML and the versions of
+        # everything that could change how it is interpreted or stored.
+        if self.config_cache is None:
+            return None
+        key = hashlib.sha256()
+        key.update(raw)
+        key.update(_version.encode())
+        key.update(sys.implementation.cache_tag.encode())
+        return os.path.join(self.config_cache, key.hexdigest() + ".marshal")
+
+    def _load_cached_config(self, raw: bytes) -> dict | None:
+        cache_path = self._config_cache_path(raw)
+        if cache_path is None:
+            return None
+        try:
+            with open(cache_path, "rb") as f:
+                return marshal.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            logging.warning("Ignoring bad config cache {}: {}".format(cache_path, e))
+            return None
+
+    def _save_cached_config(self, raw: bytes, config: dict):
+        cache_path = self._config_cache_path(raw)
+        if cache_path is None:
+            return
+        tmp_path = cache_path + ".tmp"
+        try:
+            os.makedirs(self.config_cache, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                marshal.dump(config, f)
+            os.replace(tmp_path, cache_path)
+        except (OSError, ValueError) as e:
+            logging.warning("Failed to write config cache {}: {}".format(cache_path, e))
+
+    def request_reload(self):
+        # Safe to call from signal handlers and other threads. The reload itself
+        # happens in the main loop, between polls.
+        self._reload_requested = True
+        self._wake.set()
+
+    def reload_config(self) -> bool:
+        # Re-reads the config file and applies the differences without dropping the
+        # modbus or MQTT connections. Registers that haven't changed keep their last
+        # values, so they aren't republished unless pub_only_on_change says so.
+        start = monotonic()
+        try:
+            config = self._load_modbus_config(self.config_file)
+            for key in RESTART_REQUIRED_SETTINGS:
+                if config.get(key) != self.config.get(key):
+                    logging.warning(
+                        "Changing {} requires a restart. Keeping the old value.".format(
+                            key
+                        )
+                    )
+                    if key in self.config:
+                        config[key] = self.config[key]
+                    else:
+                        config.pop(key)
+            tables = self._mb.get_tables()
+            if not isinstance(self._mb, modbus_interface.ModbusBus) and any(
+                "device_address" in register for register in config["registers"]
+            ):
+                raise ValueError(
+                    "Adding a device_address to registers requires a restart."
+                )
+            for register in config["registers"]:
+                if register.get("table", "holding") not in tables:
+                    raise ValueError(
+                        "Unsupported table type. Please only use: {}".format(
+                            tables.keys()
+                        )
+                    )
+            old_registers = self.registers
+            old_subscriptions = self._get_subscriptions()
+            self._apply_settings(config)
+        except Exception as e:
+            logging.error("Failed to reload config, keeping the old one: {}".format(e))
+            return False
+
+        previous_values = {
+            self._register_key(register): register["value"]
+            for register in old_registers
+        }
+        for register in self.registers:
+            register["value"] = previous_values.get(self._register_key(register))
+        new_keys = {self._register_key(register) for register in self.registers}
+        added = len(new_keys - previous_values.keys())
+        removed = len(previous_values.keys() - new_keys)
+
+        # Only the addresses that are no longer needed, or weren't needed before,
+        # touch the read plan.
+        old_words = self._get_monitored_words(old_registers)
+        new_words = self._get_monitored_words(self.registers)
+        for table, addr, unit in sorted(old_words - new_words, key=str):
+            self._mb.remove_monitor_register(
+                table, addr, **self._unit({"device_address": unit} if unit else {})
+            )
+        for table, addr, unit in sorted(new_words - old_words, key=str):
+            self._mb.add_monitor_register(
+                table, addr, **self._unit({"device_address": unit} if unit else {})
+            )
+
+        self._update_subscriptions(old_subscriptions)
+        if self._api is not None:
+            self._api.store.set_registers(self._get_registers_with("pub_topic"))
+        logging.info(
+            "Reloaded config in {:.1f} ms. {} registers added, {} removed.".format(
+                (monotonic() - start) * 1000, added, removed
+            )
+        )
+        return True
+
+    @staticmethod
+    def _register_key(register: dict) -> str:
+        # Identifies a register by everything in its definition.
+        return json.dumps(
+            {key: value for key, value in register.items() if key != "value"},
+            sort_keys=True,
+            default=str,
+        )
+
+    @staticmethod
+    def _get_monitored_words(
+        registers: list[dict],
+    ) -> set[tuple[str, int, int | None]]:
+        words = set()
+        for register in registers:
+            for i in range(
+                modbus_interface.type_length(register.get("type", "uint16"))
+            ):
+                words.add(
+                    (
+                        register.get("table", "holding"),
+                        register["address"] + i,
+                        register.get("device_address"),
+                    )
+                )
+        return words
+
+    def _update_subscriptions(self, old_subscriptions: list[list[str]]):
+        if not self._mqtt_client.is_connected():
+            # Everything will be subscribed to on reconnection.
+            return
+        old_filters = {f for topic_filters in old_subscriptions for f in topic_filters}
+        new_subscriptions = self._get_subscriptions()
+        new_filters = {f for topic_filters in new_subscriptions for f in topic_filters}
+        removed = sorted(old_filters - new_filters)
+        if removed:
+            self._mqtt_client.unsubscribe(removed)
+        for topic_filters in new_subscriptions:
+            added = [f for f in topic_filters if f not in old_filters]
+            if added:
+                self._subscribe(added)
+
     def loop_forever(self):
         while self._running:
             next_update_time_s = monotonic() + self.config["update_rate"]
             self.poll()
-            sleep(max(0, next_update_time_s - monotonic()))
+            # Sleep until the next poll, waking early to apply reloads, to send
+            # queued messages and to replay any spooled backlog.
+            while self._running:
+                timeout = next_update_time_s - monotonic()
+                if timeout <= 0:
+                    break
+                if (
+                    self._spool is not None and len(self._spool)
+                ) or self._publish_queue:
+                    timeout = min(timeout, SPOOL_REPLAY_INTERVAL_S)
+                if self.idle_probe_interval is not None:
+                    timeout = min(timeout, self.idle_probe_interval)
+                # Get requests made within a window of the poll wait for it.
+                get_window_remaining = self._get_window_remaining()
+                if get_window_remaining is not None and timeout > self.get_window:
+                    timeout = min(timeout, get_window_remaining)
+                if self._wake.wait(timeout):
+                    self._wake.clear()
+                # A blocked poll may have already cleared the wakeup for a reload.
+                if self._reload_requested:
+                    self._reload_requested = False
+                    self.reload_config()
+                if self._read_backs:
+                    self._process_read_backs()
+                self._process_get_requests(next_update_time_s)
+                if self._publish_queue:
+                    self._pump_publish_queue()
+                self._replay_spool()
+                self._check_modbus_link()
 
     def stop(self):
         self._running = False
+        self._wake.set()
         self._mqtt_client.loop_stop()
         self._mqtt_client.disconnect()
+        if self._proxy is not None:
+            self._proxy.stop()
+        if self._api is not None:
+            self._api.stop()
+        if self._shared_image is not None:
+            self._shared_image.close()
         self._mb.close()
+        if self._spool is not None:
+            self._spool.close()
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option(
     "--hostname",
     default="localhost",
@@ -527,7 +1979,22 @@ class mqtt_interface:
     help="Client private key for authentication, if required by server.",
     show_default=True,
 )
+@click.option(
+    "--config_cache",
+    default=None,
+    help="A directory to cache compiled configs in, for faster startup.",
+    show_default=True,
+)
+@click.option(
+    "--mqtt_version",
+    default="3.1.1",
+    type=click.Choice(list(MQTT_VERSIONS)),
+    help="The MQTT protocol version. Version 5 enables topic aliases and message expiry.",
+    show_default=True,
+)
+@click.pass_context
 def main(
+    ctx,
     hostname,
     port,
     username,
@@ -539,12 +2006,17 @@ def main(
     cafile,
     cert,
     key,
+    config_cache,
+    mqtt_version,
 ):
     logging.basicConfig(
         format="%(asctime)s %(levelname)-8s %(message)s",
         level=logging.INFO,
         datefmt="%Y-%m-%d %H:%M:%S",
     )
+    if ctx.invoked_subcommand is not None:
+        # One of the tools below is being run instead of the gateway.
+        return
     logging.info("Starting modbus4mqtt v{}".format(_version))
     i = mqtt_interface(
         hostname,
@@ -558,10 +2030,163 @@ def main(
         cafile,
         cert,
         key,
+        config_cache,
+        mqtt_version,
     )
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: i.request_reload())
     i.connect()
     i.loop_forever()
 
 
+@main.command("probe")
+@click.option("--ip", required=True, help="The IP address of the modbus device.")
+@click.option(
+    "--port", default=502, help="The port of the modbus device.", show_default=True
+)
+@click.option(
+    "--device_address",
+    default=1,
+    help="The modbus device address (unit) to probe.",
+    show_default=True,
+)
+@click.option(
+    "--variant",
+    default=None,
+    help="The modbus variant, as in the YAML config. Defaults to tcp.",
+)
+@click.option(
+    "--table",
+    default="holding",
+    type=click.Choice(["holding", "input"]),
+    help="The modbus table to sweep.",
+    show_default=True,
+)
+@click.option(
+    "--start", default=0, help="The first address to sweep.", show_default=True
+)
+@click.option(
+    "--end",
+    default=1000,
+    help="Sweep up to, but not including, this address.",
+    show_default=True,
+)
+@click.option(
+    "--samples",
+    default=probe.DEFAULT_LATENCY_SAMPLES,
+    help="The number of reads used to measure latency at each request size.",
+    show_default=True,
+)
+@click.option(
+    "--timeout",
+    default=float(modbus_interface.DEFAULT_REQUEST_TIMEOUT_S),
+    help="Seconds to wait for each response from the device.",
+    show_default=True,
+)
+@click.option(
+    "--retries",
+    default=modbus_interface.DEFAULT_REQUEST_RETRIES,
+    help="How many times to retry a request the device doesn't answer.",
+    show_default=True,
+)
+@click.option(
+    "--output",
+    default=None,
+    help="Write the starter YAML config to this file rather than stdout.",
+)
+def probe_command(
+    ip,
+    port,
+    device_address,
+    variant,
+    table,
+    start,
+    end,
+    samples,
+    timeout,
+    retries,
+    output,
+):
+    """Discover the readable registers of a device and write a starter config."""
+    result = probe.probe(
+        ip,
+        port,
+        device_address,
+        variant,
+        table,
+        start,
+        end,
+        samples,
+        timeout=timeout,
+        retries=retries,
+    )
+    if not result["blocks"]:
+        click.echo("No readable registers found.", err=True)
+        return
+    for block_start, block_length in result["blocks"]:
+        click.echo(
+            "Readable: {} to {} ({} registers)".format(
+                block_start, block_start + block_length - 1, block_length
+            ),
+            err=True,
+        )
+    click.echo("Largest accepted read: {}".format(result["max_batch"]), err=True)
+    for size, latency in result["latency"].items():
+        click.echo(
+            "Read of {} registers: {:.1f} ms".format(size, latency * 1000), err=True
+        )
+    from ruamel.yaml import YAML
+
+    yaml = YAML()
+    yaml.indent(mapping=2, sequence=4, offset=2)
+    if output is None:
+        yaml.dump(result["config"], sys.stdout)
+    else:
+        with open(output, "w") as f:
+            yaml.dump(result["config"], f)
+
+
+@main.command("plan")
+@click.option(
+    "--config",
+    required=True,
+    help="The YAML config file for your modbus device.",
+)
+@click.option(
+    "--latency",
+    default=10.0,
+    help="The round-trip latency of the modbus link in milliseconds.",
+    show_default=True,
+)
+@click.option(
+    "--bitrate",
+    default=None,
+    type=float,
+    help="The bitrate of the modbus link in bits per second, if it's slow enough to matter.",
+)
+def plan_command(config, latency, bitrate):
+    """Show the reads each poll will make, without connecting to anything."""
+    # Nothing touches the network until connect() is called, so this builds
+    # exactly the same batch plan the gateway would use.
+    i = mqtt_interface("localhost", 1883, "", "", config, "")
+    if isinstance(i._mb, modbus_interface.ModbusBus):
+        # Each device on a shared bus has its own plan, named <table>@<device_address>.
+        default_unit = i.config.get("device_address", 0x01)
+        result = {}
+        for unit in i._mb.get_units():
+            registers = [
+                register
+                for register in i.registers
+                if register.get("device_address", default_unit) == unit
+            ]
+            for name, table_plan in plan.build_plan(
+                i._mb.get_tables(unit), registers
+            ).items():
+                result["{}@{}".format(name, unit)] = table_plan
+    else:
+        result = plan.build_plan(i._mb.get_tables(), i.registers)
+    click.echo(plan.format_plan(result, latency / 1000, bitrate))
+
+
 if __name__ == "__main__":
     main()
@@ -1,20 +1,58 @@
+from contextlib import contextmanager
 from enum import Enum
+import json
 import logging
+import os
 from queue import Queue
-from pymodbus.client import ModbusTcpClient, ModbusUdpClient, ModbusTlsClient
+import random
+import select
+import socket
+import threading
+from time import monotonic, sleep, time
+from typing import Any, Callable
+from pymodbus.client import (
+    ModbusSerialClient,
+    ModbusTcpClient,
+    ModbusTlsClient,
+    ModbusUdpClient,
+)
 from pymodbus.framer import FramerType
 from pymodbus import ModbusException
+from pymodbus.exceptions import ConnectionException, ModbusIOException
 
-from SungrowModbusTcpClient import SungrowModbusTcpClient  # type: ignore
 from modbus4mqtt.modbus_table import ModbusTable
 
 DEFAULT_READ_BATCHING = 100
 DEFAULT_WRITE_BATCHING = 100
 MIN_BATCHING = 1
 MAX_BATCHING = 100
-DEFAULT_WRITE_BLOCK_INTERVAL_S = 0.2
-DEFAULT_WRITE_SLEEP_S = 0.05
-DEFAULT_READ_SLEEP_S = 0.05
+DEFAULT_REQUEST_TIMEOUT_S = 1
+DEFAULT_REQUEST_RETRIES = 3
+# Pacing is off by default. Slow devices and gateways may need gaps between requests.
+DEFAULT_WRITE_BLOCK_INTERVAL_S = 0
+DEFAULT_WRITE_SLEEP_S = 0
+DEFAULT_READ_SLEEP_S = 0
+# Modbus exception code returned by devices for function codes they don't support.
+ILLEGAL_FUNCTION = 1
+# Modbus exception code returned by devices for reads that touch an address they don't have.
+ILLEGAL_DATA_ADDRESS = 2
+DEFAULT_TARGET_READ_LATENCY_S = 0.5
+# Shrink the batch size by this factor when reads are slow or failing.
+BATCH_DECREASE_FACTOR = 0.5
+# Learned state that changes often, like tuned batch sizes, is only saved this often.
+STATE_SAVE_INTERVAL_S = 60
+# Unanswered keepalive probes before the OS gives up on a connection.
+KEEPALIVE_PROBES = 3
+DEFAULT_RECONNECT_INTERVAL_S = 5
+DEFAULT_RECONNECT_MAX_INTERVAL_S = 60
+DEFAULT_CIRCUIT_BREAKER_FAILURES = 5
+DEFAULT_CIRCUIT_BREAKER_INTERVAL_S = 300
+DEFAULT_BAUDRATE = 19200
+DEFAULT_BYTESIZE = 8
+DEFAULT_PARITY = "N"
+DEFAULT_STOPBITS = 1
+# Above 19200 baud the spec fixes the silent interval between RTU frames.
+RTU_FIXED_FRAME_GAP_S = 0.00175
 
 
 class WordOrder(Enum):
@@ -27,6 +65,162 @@ class WriteMode(Enum):
     Multi = 2
 
 
+class IllegalDataAddressException(ModbusException):
+    pass
+
+
+class IllegalFunctionException(ModbusException):
+    pass
+
+
+class UnreadableAddressError(ValueError):
+    # Raised for values that include an address the device won't let us read.
+    pass
+
+
+class BatchTuner:
+    # Adjusts the read batch size of a table from observed read behaviour using
+    # additive-increase/multiplicative-decrease. Full-sized batches that come back
+    # quickly grow the batch by one register. Timeouts, retries, exception responses
+    # and slow reads cut it down.
+
+    def __init__(
+        self,
+        size: int,
+        minimum: int = MIN_BATCHING,
+        maximum: int = MAX_BATCHING,
+        target_latency_s: float = DEFAULT_TARGET_READ_LATENCY_S,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency_s = target_latency_s
+        self.size = self._clamp(size)
+
+    def _clamp(self, size: int) -> int:
+        return max(self.minimum, min(self.maximum, size))
+
+    def _set(self, size: int) -> bool:
+        # Returns True if the batch size changed.
+        size = self._clamp(size)
+        changed = size != self.size
+        self.size = size
+        return changed
+
+    def success(self, count: int, latency_s: float, retries: int = 0) -> bool:
+        if retries > 0 or latency_s > self.target_latency_s:
+            return self.failure()
+        if count >= self.size:
+            return self._set(self.size + 1)
+        return False
+
+    def failure(self) -> bool:
+        return self._set(int(self.size * BATCH_DECREASE_FACTOR))
+
+
+class ReconnectBackoff:
+    # Decides when to try a failing device again. Each failure in a row doubles the
+    # wait, up to max_interval_s, and the wait is randomly cut by up to half so
+    # instances that lost their devices together don't retry in step. After
+    # failure_threshold failures in a row the circuit opens and the device is left
+    # alone for open_interval_s, then given a single trial.
+
+    def __init__(
+        self,
+        interval_s: float = DEFAULT_RECONNECT_INTERVAL_S,
+        max_interval_s: float = DEFAULT_RECONNECT_MAX_INTERVAL_S,
+        failure_threshold: int = DEFAULT_CIRCUIT_BREAKER_FAILURES,
+        open_interval_s: float = DEFAULT_CIRCUIT_BREAKER_INTERVAL_S,
+        rng: Callable[[], float] = random.random,
+    ):
+        self.interval_s = interval_s
+        self.max_interval_s = max_interval_s
+        self.failure_threshold = failure_threshold
+        self.open_interval_s = open_interval_s
+        self._rng = rng
+        self.failures = 0
+        self.next_attempt = 0.0
+
+    @property
+    def state(self) -> str:
+        if self.failures == 0:
+            return "closed"
+        if self.failures >= self.failure_threshold:
+            return "open"
+        return "backoff"
+
+    def ready(self, now: float) -> bool:
+        return now >= self.next_attempt
+
+    def success(self):
+        self.failures = 0
+        self.next_attempt = 0.0
+
+    def failure(self, now: float) -> float:
+        # Returns the number of seconds until the next attempt.
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            delay = self.open_interval_s
+        else:
+            delay = min(self.max_interval_s, self.interval_s * 2 ** (self.failures - 1))
+        delay *= 0.5 + 0.5 * self._rng()
+        self.next_attempt = now + delay
+        return delay
+
+
+class RequestPacer:
+    # Serialises requests to the device and spaces them out. Each read waits until
+    # read_gap_s after the previous request finished, and each write write_gap_s.
+    # Groups of writes made together start at least write_block_interval_s apart.
+
+    def __init__(
+        self,
+        read_gap_s: float = DEFAULT_READ_SLEEP_S,
+        write_gap_s: float = DEFAULT_WRITE_SLEEP_S,
+        write_block_interval_s: float = DEFAULT_WRITE_BLOCK_INTERVAL_S,
+        clock: Callable[[], float] = monotonic,
+        sleep: Callable[[float], None] = sleep,
+    ):
+        self.read_gap_s = read_gap_s
+        self.write_gap_s = write_gap_s
+        self.write_block_interval_s = write_block_interval_s
+        self._clock = clock
+        self._sleep = sleep
+        # Requests come from the poll loop and, for writes, the MQTT thread.
+        self._lock = threading.RLock()
+        self.last_request_end: float | None = None
+        self._last_write_block: float | None = None
+        # The total number of seconds spent waiting for gaps, and in requests.
+        self.waited_s = 0.0
+        self.busy_s = 0.0
+
+    def _wait_until(self, deadline: float):
+        delay = deadline - self._clock()
+        if delay > 0:
+            self._sleep(delay)
+            self.waited_s += delay
+
+    @contextmanager
+    def request(self, write: bool = False):
+        with self._lock:
+            gap = self.write_gap_s if write else self.read_gap_s
+            if gap and self.last_request_end is not None:
+                self._wait_until(self.last_request_end + gap)
+            start = self._clock()
+            try:
+                yield
+            finally:
+                self.last_request_end = self._clock()
+                self.busy_s += self.last_request_end - start
+
+    @contextmanager
+    def write_block(self):
+        with self._lock:
+            if self.write_block_interval_s and self._last_write_block is not None:
+                self._wait_until(self._last_write_block + self.write_block_interval_s)
+            self._last_write_block = self._clock()
+            yield
+
+
 class modbus_interface:
 
     def __init__(
@@ -39,9 +233,43 @@ class modbus_interface:
         read_batching: int = DEFAULT_READ_BATCHING,
         write_batching: int = DEFAULT_WRITE_BATCHING,
         word_order=WordOrder.HighLow,
+        state_file: str | None = None,
+        auto_batching: bool = False,
+        min_read_batching: int = MIN_BATCHING,
+        target_read_latency: float = DEFAULT_TARGET_READ_LATENCY_S,
+        mask_write: bool = False,
+        read_write_multiple: bool = False,
+        timeout: float = DEFAULT_REQUEST_TIMEOUT_S,
+        retries: int = DEFAULT_REQUEST_RETRIES,
+        read_gap: float = DEFAULT_READ_SLEEP_S,
+        write_gap: float = DEFAULT_WRITE_SLEEP_S,
+        write_block_interval: float = DEFAULT_WRITE_BLOCK_INTERVAL_S,
+        tcp_keepalive: int | None = None,
+        baudrate: int = DEFAULT_BAUDRATE,
+        bytesize: int = DEFAULT_BYTESIZE,
+        parity: str = DEFAULT_PARITY,
+        stopbits: int = DEFAULT_STOPBITS,
     ):
+        # For serial connections, ip is the serial port.
         self._ip: str = ip
+        self._tcp_keepalive: int | None = tcp_keepalive
+        self._timeout: float = timeout
+        self._retries: int = retries
         self._port: int = port
+        self._serial_settings: dict[str, Any] = {
+            "baudrate": baudrate,
+            "bytesize": bytesize,
+            "parity": parity,
+            "stopbits": stopbits,
+        }
+        framer, client = _parse_variant(variant)
+        if client == "serial" and framer in [None, "rtu"]:
+            # RTU frames are delimited by silence on the line, so back-to-back
+            # requests need at least the frame gap between them.
+            frame_gap = rtu_frame_gap(baudrate, bytesize, parity, stopbits)
+            read_gap = max(read_gap, frame_gap)
+            write_gap = max(write_gap, frame_gap)
+        self._pacer = RequestPacer(read_gap, write_gap, write_block_interval)
 
         self._planned_writes: Queue = Queue()
         self._write_mode: WriteMode = write_mode
@@ -71,21 +299,58 @@ class modbus_interface:
         if self._write_mode == WriteMode.Single and self._write_batching != 1:
             logging.warning("Overriding write batching to 1 due to single write mode.")
             self._write_batching = 1
+        # Masked writes use Mask Write Register (FC22), so the device merges the bits
+        # itself rather than us merging them into a value that may be a poll old.
+        self._mask_write: bool = mask_write
+        self._masked_writes: list[tuple[int, int, int]] = []
+        # Held while writes are planned and while they're sent, so values planned
+        # together go out together, and none are lost to a flush from another thread.
+        self._write_lock = threading.RLock()
+        # Writes use Read/Write Multiple Registers (FC23), which reads the written
+        # range back in the same transaction.
+        self._read_write_multiple: bool = (
+            read_write_multiple and self._write_mode == WriteMode.Multi
+        )
+        # Holding addresses read back by FC23 since they were last written.
+        self._verified: set[int] = set()
         self._tables: dict[str, ModbusTable] = {
             "input": ModbusTable(self._read_batching, self._write_batching),
             "holding": ModbusTable(self._read_batching, self._write_batching),
         }
+        # When auto batching is enabled each table gets its own read batch size,
+        # somewhere between min_read_batching and read_batching.
+        self._tuners: dict[str, BatchTuner] = {}
+        if auto_batching:
+            minimum = max(MIN_BATCHING, min(self._read_batching, min_read_batching))
+            for table in self._tables:
+                self._tuners[table] = BatchTuner(
+                    self._read_batching,
+                    minimum,
+                    self._read_batching,
+                    target_read_latency,
+                )
+        self._poll_read_requests: int = 0
+        self._poll_duration_s: float = 0
+        self._poll_start: float = monotonic()
+        # The fraction of the time between the last two polls spent in requests.
+        self._bus_utilisation: float = 0
+        self._poll_busy_s: float = 0
+        self._clock_offset: float = time() - monotonic()
+        # Things learned about the device at runtime are kept here across restarts.
+        self._state_file: str | None = state_file
+        self._state_dirty: bool = False
+        # Optional function codes the device has turned down.
+        self._unsupported_functions: set[str] = set()
+        self._state_saved_at: float = monotonic()
+        self._load_state()
 
     def connect(self) -> bool:
         # Connects to the modbus device. Returns True on success, False on failure.
-        clients = {
+        clients: dict[str, Callable[..., Any]] = {
             "tcp": ModbusTcpClient,
             "tls": ModbusTlsClient,
             "udp": ModbusUdpClient,
-            "sungrow": SungrowModbusTcpClient.SungrowModbusTcpClient,
-            # if 'serial' modbus is required at some point, the configuration
-            # needs to be changed to provide file, baudrate etc.
-            # "serial": (ModbusSerialClient, ModbusRtuFramer),
+            "sungrow": _sungrow_client,
         }
         framers = {
             "ascii": FramerType.ASCII,
@@ -94,18 +359,26 @@ class modbus_interface:
             "tls": FramerType.TLS,
         }
 
-        if self._variant is None:
-            desired_framer, desired_client = None, "tcp"
-        elif "-over-" in self._variant:
-            desired_framer, desired_client = self._variant.split("-over-")
-        else:
-            desired_framer, desired_client = None, self._variant
+        desired_framer, desired_client = _parse_variant(self._variant)
 
-        if desired_client not in clients:
+        if desired_client not in clients and desired_client != "serial":
             raise ValueError("Unknown modbus client: {}".format(desired_client))
         if desired_framer is not None and desired_framer not in framers:
             raise ValueError("Unknown modbus framer: {}".format(desired_framer))
 
+        if desired_client == "serial":
+            if desired_framer is None:
+                desired_framer = "rtu"
+            self._mb = ModbusSerialClient(
+                self._ip,
+                framer=framers[desired_framer],
+                retries=self._retries,
+                timeout=self._timeout,
+                **self._serial_settings,
+            )
+            self._mb.connect()
+            return self._mb.connected
+
         client = clients[desired_client]
 
         if desired_framer is None:
@@ -113,11 +386,78 @@ class modbus_interface:
         framer = framers[desired_framer]
 
         self._mb = client(
-            host=self._ip, port=self._port, framer=framer, retries=3, timeout=1
+            host=self._ip,
+            port=self._port,
+            framer=framer,
+            retries=self._retries,
+            timeout=self._timeout,
         )
         self._mb.connect()
+        if self._tcp_keepalive is not None:
+            self._set_keepalive(self._tcp_keepalive)
         return self._mb.connected
 
+    def _stream_socket(self):
+        # Returns the client's TCP socket, if it has one.
+        sock = getattr(self._mb, "socket", None)
+        if isinstance(sock, socket.socket) and sock.type == socket.SOCK_STREAM:
+            return sock
+        return None
+
+    def _set_keepalive(self, idle_s: int):
+        # Has the OS probe a quiet connection after idle_s seconds, so one that's
+        # gone half-open is reset after about twice that, rather than never.
+        sock = self._stream_socket()
+        if sock is None:
+            return
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        interval = max(1, idle_s // KEEPALIVE_PROBES)
+        for option, value in [
+            ("TCP_KEEPIDLE", idle_s),
+            ("TCP_KEEPINTVL", interval),
+            ("TCP_KEEPCNT", KEEPALIVE_PROBES),
+        ]:
+            # Not every platform has all of these.
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+    def _check_socket(self):
+        # A socket that's readable between requests has either been closed by the
+        # device, which reads as zero bytes, or has an error pending. Either way
+        # the connection is dead, and finding out now saves waiting for the next
+        # request to time out.
+        sock = self._stream_socket()
+        if sock is None or sock.fileno() < 0:
+            return
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            if not readable or hasattr(sock, "pending"):
+                # TLS sockets can't be peeked at.
+                return
+            if sock.recv(1, socket.MSG_PEEK) != b"":
+                # Stray bytes. The next response will sort them out.
+                return
+            reason = "The modbus device closed the connection."
+        except (OSError, ValueError) as e:
+            reason = "The modbus connection failed: {}".format(e)
+        self._mb.close()
+        raise ConnectionException(reason)
+
+    def check_link(self, idle_s: float) -> bool:
+        # Reads a single register if nothing has been sent to the device for idle_s
+        # seconds, so a dead link is found between polls. Raises a ModbusException
+        # if it is. Returns True if a read was made.
+        self._check_socket()
+        last = self._pacer.last_request_end
+        if last is not None and monotonic() - last < idle_s:
+            return False
+        for table in self._tables:
+            batches = self._tables[table].get_batched_addresses()
+            if batches:
+                self._scan_value_range(table, batches[0][0], 1)
+                return True
+        return False
+
     def close(self):
         self._mb.close()
 
@@ -134,20 +474,217 @@ class modbus_interface:
         for i in range(type_length(type)):
             self._tables[table].add_register(addr + i)
 
+    def remove_monitor_register(self, table, addr, type="uint16"):
+        # Stops monitoring a register. Only the read batches around it are re-planned.
+        if table not in self._tables:
+            raise ValueError(
+                "Unsupported table type. Please only use: {}".format(
+                    self._tables.keys()
+                )
+            )
+        for i in range(type_length(type)):
+            self._tables[table].remove_register(addr + i)
+
+    def get_tables(self) -> dict[str, ModbusTable]:
+        return self._tables
+
     def poll(self):
-        for table in self._tables:
-            for start, length in self._tables[table].get_batched_addresses():
-                try:
-                    values = self._scan_value_range(table, start, length)
-                    for offset, value in enumerate(values):
-                        self._tables[table].set_value(
-                            start + offset, value, write=False
-                        )
-                except ModbusException as e:
-                    if "Failed to connect" in str(e):
-                        raise e
-                    logging.error(e)
+        for table, start, length in self._begin_poll():
+            self._poll_batch(table, start, length)
+        self._end_poll()
+
+    def _begin_poll(self) -> list[tuple[str, int, int]]:
+        # Starts a poll and returns the reads it needs as (table, start, length).
+        start_time = monotonic()
+        busy_s = self._pacer.busy_s
+        if start_time > self._poll_start:
+            self._bus_utilisation = (busy_s - self._poll_busy_s) / (
+                start_time - self._poll_start
+            )
+        self._poll_start = start_time
+        self._poll_busy_s = busy_s
+        # Read times are measured on the monotonic clock and converted to wall clock
+        # time with an offset taken once per poll, so they stay consistent with each
+        # other even if the system clock is stepped mid-poll.
+        self._clock_offset = time() - start_time
+        self._poll_read_requests = 0
+        self._check_socket()
+        return [
+            (table, start, length)
+            for table in self._tables
+            for start, length in self._tables[table].get_batched_addresses()
+        ]
+
+    def _poll_batch(self, table, start, length) -> bool:
+        # Returns False if the device didn't answer. Raises if the connection failed.
+        try:
+            self._read_batch(table, start, length)
+        except ModbusException as e:
+            if "Failed to connect" in str(e):
+                raise e
+            logging.error(e)
+            # An exception response is about this read, not the device.
+            return not isinstance(e, (ModbusIOException, ConnectionException))
+        return True
+
+    def _end_poll(self):
         self._process_writes()
+        self._poll_duration_s = monotonic() - self._poll_start
+        if (
+            self._state_dirty
+            and monotonic() - self._state_saved_at >= STATE_SAVE_INTERVAL_S
+        ):
+            self._save_state()
+
+    def get_metrics(self) -> dict:
+        return {
+            "read_batching": {
+                table: self._tables[table].get_read_batch_size()
+                for table in self._tables
+            },
+            "write_batching": self._write_batching,
+            "poll_read_requests": self._poll_read_requests,
+            "poll_duration_s": round(self._poll_duration_s, 6),
+            "pacing_wait_s": round(self._pacer.waited_s, 6),
+            "bus_utilisation": round(self._bus_utilisation, 4),
+        }
+
+    def _tune_batching(self, table, changed):
+        if not changed:
+            return
+        size = self._tuners[table].size
+        logging.debug("Adjusting read batching for table {} to {}.".format(table, size))
+        self._tables[table].set_read_batch_size(size)
+        self._state_dirty = True
+
+    def _read_batch(self, table, start, length) -> bool:
+        # Returns True if the whole batch was read in one request.
+        tuner = self._tuners.get(table)
+        self._poll_read_requests += 1
+        waited_s = self._pacer.waited_s
+        request_time = monotonic()
+        try:
+            result = self._scan_value_range(table, start, length)
+            response_time = monotonic()
+        except IllegalDataAddressException:
+            if length == 1:
+                self._mark_unreadable(table, start)
+                return False
+            # Split the batch in half and try again. The halves that read cleanly are
+            # stored as normal, so only the bad addresses end up isolated.
+            half = length // 2
+            first = self._read_batch(table, start, half)
+            second = self._read_batch(table, start + half, length - half)
+            if first and second:
+                # Every address is readable, but not in one request. The device
+                # has a block boundary here, so batches are split at it from now on.
+                self._mark_break(table, start + half)
+            return False
+        except ModbusException as e:
+            # Timeouts and exception responses are the usual signs of a batch
+            # that's too big for a slow device.
+            if tuner is not None and not isinstance(e, ConnectionException):
+                self._tune_batching(table, tuner.failure())
+            raise
+        if tuner is not None:
+            # pymodbus doesn't say whether it retried, but a response that took
+            # longer than the timeout must have been retried.
+            latency_s = response_time - request_time - (self._pacer.waited_s - waited_s)
+            retries = int(latency_s // self._timeout) if self._timeout > 0 else 0
+            self._tune_batching(table, tuner.success(length, latency_s, retries))
+        for offset, value in enumerate(result.registers):
+            self._tables[table].set_value(start + offset, value, write=False)
+        if table == "holding":
+            # Newer than any write's read-back.
+            self._verified -= set(range(start, start + len(result.registers)))
+        # The device sampled the values somewhere between request and response.
+        self._tables[table].set_read_time(
+            start,
+            len(result.registers),
+            self._clock_offset + (request_time + response_time) / 2,
+        )
+        return True
+
+    def _mark_unreadable(self, table, addr):
+        logging.warning(
+            "Address {} in table {} is not readable on this device. "
+            "Excluding it from future reads.".format(addr, table)
+        )
+        self._tables[table].mark_unreadable(addr)
+        self._save_state()
+
+    def _mark_break(self, table, addr):
+        logging.warning(
+            "Reads in table {} can't span address {} on this device. "
+            "Splitting future reads there.".format(table, addr)
+        )
+        self._tables[table].mark_break(addr)
+        self._save_state()
+
+    def _load_state(self):
+        if self._state_file is None:
+            return
+        try:
+            with open(self._state_file, "r") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(
+                "Failed to load state file {}: {}".format(self._state_file, e)
+            )
+            return
+        for table, addresses in state.get("unreadable", {}).items():
+            if table not in self._tables:
+                continue
+            for addr in addresses:
+                self._tables[table].mark_unreadable(addr)
+        for table, addresses in state.get("breaks", {}).items():
+            if table not in self._tables:
+                continue
+            for addr in addresses:
+                self._tables[table].mark_break(addr)
+        for function in state.get("unsupported_functions", []):
+            self._unsupported_functions.add(function)
+            if function == "mask_write":
+                self._mask_write = False
+            elif function == "read_write_multiple":
+                self._read_write_multiple = False
+        for table, size in state.get("read_batching", {}).items():
+            if table not in self._tuners:
+                continue
+            self._tuners[table].size = self._tuners[table]._clamp(size)
+            self._tables[table].set_read_batch_size(self._tuners[table].size)
+
+    def _save_state(self):
+        if self._state_file is None:
+            return
+        state = {
+            "unreadable": {
+                table: sorted(self._tables[table].get_unreadable())
+                for table in self._tables
+            },
+            "breaks": {
+                table: sorted(self._tables[table].get_breaks())
+                for table in self._tables
+            },
+            "read_batching": {
+                table: tuner.size for table, tuner in self._tuners.items()
+            },
+            "unsupported_functions": sorted(self._unsupported_functions),
+        }
+        self._state_dirty = False
+        self._state_saved_at = monotonic()
+        # Write to a temporary file first so a crash can't leave a truncated state file behind.
+        tmp_path = self._state_file + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(state, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self._state_file)
+        except OSError as e:
+            logging.warning(
+                "Failed to save state file {}: {}".format(self._state_file, e)
+            )
 
     def get_value(self, table, addr, type="uint16"):
         if table not in self._tables:
@@ -162,8 +699,15 @@ class modbus_interface:
             )
         # Read sequential addresses to get enough bytes to satisfy the type of this register.
         # Note: Each address provides 2 bytes of data.
-        value = bytes(0)
         type_len = type_length(type)
+        for i in range(type_len):
+            if self._tables[table].is_unreadable(addr + i):
+                raise UnreadableAddressError(
+                    "Address {} in table {} is not readable on this device.".format(
+                        addr + i, table
+                    )
+                )
+        value = bytes(0)
         for i in range(type_len):
             if self._word_order == WordOrder.HighLow:
                 data = self._tables[table].get_value(addr + i)
@@ -173,7 +717,131 @@ class modbus_interface:
         value = _convert_from_bytes_to_type(value, type)
         return value
 
-    def set_value(self, table, addr, value, mask=0xFFFF, type="uint16"):
+    def get_read_time(self, table, addr, type="uint16") -> float | None:
+        # Returns the wall clock time the oldest word of this value was read, or None
+        # if it hasn't been read yet.
+        if table not in self._tables:
+            raise ValueError(
+                "Unsupported table type. Please only use: {}".format(
+                    self._tables.keys()
+                )
+            )
+        read_times = []
+        for i in range(type_length(type)):
+            read_time = self._tables[table].get_read_time(addr + i)
+            if read_time is None:
+                return None
+            read_times.append(read_time)
+        return min(read_times)
+
+    def refresh_value(self, table, addr, type="uint16"):
+        # Reads just the words of one value from the device, outside of a poll,
+        # and returns the new value. Used to confirm writes without a full poll.
+        if table not in self._tables:
+            raise ValueError(
+                "Unsupported table type. Please only use: {}".format(
+                    self._tables.keys()
+                )
+            )
+        length = type_length(type)
+        words = set(range(addr, addr + length))
+        if table == "holding" and words <= self._verified:
+            # Already read back with the write.
+            self._verified -= words
+            return self.get_value(table, addr, type)
+        request_time = monotonic()
+        result = self._scan_value_range(table, addr, length)
+        response_time = monotonic()
+        for offset, value in enumerate(result.registers):
+            self._tables[table].set_value(addr + offset, value, write=False)
+        self._tables[table].set_read_time(
+            addr,
+            length,
+            time() - monotonic() + (request_time + response_time) / 2,
+        )
+        return self.get_value(table, addr, type)
+
+    def read_cached(
+        self, table, start, count, max_age: float
+    ) -> tuple[list[int], bool]:
+        # Returns a range of registers, and whether they came from the cache. They do
+        # if every one is monitored and was read in the last max_age seconds.
+        # Otherwise the range is read from the device, refreshing the cache.
+        if table not in self._tables:
+            raise ValueError(
+                "Unsupported table type. Please only use: {}".format(
+                    self._tables.keys()
+                )
+            )
+        cache = self._tables[table]
+        oldest = time() - max_age
+        if all(
+            addr in cache and (cache.get_read_time(addr) or 0) >= oldest
+            for addr in range(start, start + count)
+        ):
+            return [cache.get_value(addr) for addr in range(start, start + count)], True
+        return self.refresh_range(table, start, count), False
+
+    def refresh_range(self, table, start, count) -> list[int]:
+        # Reads a range of registers from the device now, outside of a poll, and
+        # updates the monitored ones in the cache.
+        if table not in self._tables:
+            raise ValueError(
+                "Unsupported table type. Please only use: {}".format(
+                    self._tables.keys()
+                )
+            )
+        cache = self._tables[table]
+        request_time = monotonic()
+        result = self._scan_value_range(table, start, count)
+        response_time = monotonic()
+        if table == "holding":
+            self._verified -= set(range(start, start + count))
+        for offset, value in enumerate(result.registers):
+            if start + offset in cache:
+                cache.set_value(start + offset, value, write=False)
+                cache.set_read_time(
+                    start + offset,
+                    1,
+                    time() - monotonic() + (request_time + response_time) / 2,
+                )
+        return result.registers
+
+    def write_through(self, start, values: list[int]):
+        # Writes holding registers straight to the device, paced like any other
+        # write, and updates the monitored ones in the cache. Raises a
+        # ModbusException if the write fails.
+        self._verified -= set(range(start, start + len(values)))
+        with self._pacer.write_block():
+            self._perform_write(start, values)
+        for offset, value in enumerate(values):
+            if start + offset in self._tables["holding"]:
+                self._tables["holding"].set_value(start + offset, value, write=False)
+
+    def mask_write_through(self, addr, and_mask, or_mask):
+        # Sends a mask write straight to the device, as a Modbus client asked for it,
+        # so bits the device changes itself are left alone. Raises a
+        # ModbusException if the write fails.
+        self._verified.discard(addr)
+        with self._pacer.write_block():
+            self._perform_mask_write(addr, or_mask, ~and_mask & 0xFFFF)
+        if addr in self._tables["holding"]:
+            self._tables["holding"].set_value(
+                addr, or_mask, ~and_mask & 0xFFFF, write=False
+            )
+
+    def write_lock(self) -> threading.RLock:
+        # Hold this while planning several values with flush=False and flushing
+        # them, so no other thread's flush sends only some of them.
+        return self._write_lock
+
+    def set_value(self, table, addr, value, mask=0xFFFF, type="uint16", flush=True):
+        # Writes the value to the device. With flush=False it's only planned, so
+        # several values can go out together with flush_writes().
+        with self._write_lock:
+            self._set_value(table, addr, value, mask, type, flush)
+
+    def _set_value(self, table, addr, value, mask, type, flush):
         if table != "holding":
             # I'm not sure if this is true for all devices. I might support writing to coils later,
             # so leave this door open.
@@ -193,53 +861,366 @@ class modbus_interface:
                     bytes_to_write[(type_len - i - 1) * 2 : (type_len - i - 1) * 2 + 2],
                     "uint16",
                 )
+            self._verified.discard(addr + i)
+            if self._mask_write and mask != 0xFFFF:
+                self._masked_writes.append((addr + i, value, mask))
+                continue
             self._planned_writes.put((addr + i, value, mask))
             self._tables["holding"].set_value(addr + i, value, mask, write=True)
 
-        # TODO Determine if we want to do immediate writes here, or leave it to be handled in poll().
+        if flush:
+            self._process_writes()
+
+    def flush_writes(self):
         self._process_writes()
 
+    def _unsupported(self, function: str):
+        logging.warning(
+            "The modbus device doesn't support {}. Falling back to plain writes.".format(
+                function
+            )
+        )
+        self._unsupported_functions.add(function)
+        self._save_state()
+
+    def _perform_mask_write(self, addr, value, mask):
+        with self._pacer.request(write=True):
+            result = self._mb.mask_write_register(
+                address=addr,
+                and_mask=~mask & 0xFFFF,
+                or_mask=value & mask,
+                device_id=self._unit,
+            )
+        self._check_response(
+            result, "masked write of register {}".format(addr), check_length=None
+        )
+
     def _perform_write(self, addr, values):
+        if self._read_write_multiple:
+            try:
+                with self._pacer.request(write=True):
+                    result = self._mb.readwrite_registers(
+                        read_address=addr,
+                        read_count=len(values),
+                        write_address=addr,
+                        values=values,
+                        device_id=self._unit,
+                    )
+                self._check_response(
+                    result,
+                    "read/write of {} registers from {} on holding".format(
+                        len(values), addr
+                    ),
+                    len(values),
+                )
+            except IllegalFunctionException:
+                self._read_write_multiple = False
+                self._unsupported("read_write_multiple")
+            except IllegalDataAddressException:
+                # Some addresses can be written but not read.
+                pass
+            else:
+                response_time = monotonic()
+                for offset, value in enumerate(result.registers):
+                    if addr + offset not in self._tables["holding"]:
+                        continue
+                    self._tables["holding"].set_value(addr + offset, value, write=False)
+                    self._verified.add(addr + offset)
+                self._tables["holding"].set_read_time(
+                    addr, len(values), time() - monotonic() + response_time
+                )
+                return
         if self._write_mode == WriteMode.Single or len(values) == 1:
             for i, value in enumerate(values):
-                self._mb.write_register(
-                    address=addr + i, value=value, device_id=self._unit
-                )
+                with self._pacer.request(write=True):
+                    self._mb.write_register(
+                        address=addr + i, value=value, device_id=self._unit
+                    )
         else:
-            self._mb.write_registers(address=addr, values=values, device_id=self._unit)
+            with self._pacer.request(write=True):
+                self._mb.write_registers(
+                    address=addr, values=values, device_id=self._unit
+                )
 
     def _process_writes(self):
+        with self._write_lock:
+            masked_writes, self._masked_writes = self._masked_writes, []
+            if not masked_writes and not self._tables["holding"].get_batched_addresses(
+                write_mode=True
+            ):
+                return
+            with self._pacer.write_block():
+                self._write_block(masked_writes)
+
+    def _write_block(self, masked_writes: list[tuple[int, int, int]]):
+        for addr, value, mask in masked_writes:
+            if self._mask_write:
+                try:
+                    self._perform_mask_write(addr, value, mask)
+                    self._tables["holding"].set_value(addr, value, mask, write=False)
+                    continue
+                except IllegalFunctionException:
+                    self._mask_write = False
+                    self._unsupported("mask_write")
+                except ModbusException as e:
+                    logging.error("Failed to write to modbus device: {}".format(e))
+                    continue
+            # Merge the bits into the last value read and write the whole register.
+            self._planned_writes.put((addr, value, mask))
+            self._tables["holding"].set_value(addr, value, mask, write=True)
+        written: set[int] = set()
         for start, length in self._tables["holding"].get_batched_addresses(
             write_mode=True
         ):
             values = []
             for i in range(length):
                 values.append(self._tables["holding"].get_value(start + i))
+            written.update(range(start, start + length))
             try:
                 self._perform_write(start, values)
             except ModbusException as e:
                 logging.error("Failed to write to modbus device: {}".format(e))
-        self._tables["holding"].clear_changed_registers()
+        self._tables["holding"].clear_changed_registers(written)
+
+    def read_range(self, table, start, count) -> list[int]:
+        # Reads registers straight from the device without touching the monitored tables.
+        if table not in self._tables:
+            raise ValueError(
+                "Unsupported table type. Please only use: {}".format(
+                    self._tables.keys()
+                )
+            )
+        return self._scan_value_range(table, start, count).registers
 
     def _scan_value_range(self, table, start, count):
         result = None
-        if table == "input":
-            result = self._mb.read_input_registers(
-                address=start, count=count, device_id=self._unit
-            )
-        elif table == "holding":
-            result = self._mb.read_holding_registers(
-                address=start, count=count, device_id=self._unit
-            )
+        with self._pacer.request():
+            if table == "input":
+                result = self._mb.read_input_registers(
+                    address=start, count=count, device_id=self._unit
+                )
+            elif table == "holding":
+                result = self._mb.read_holding_registers(
+                    address=start, count=count, device_id=self._unit
+                )
         if result is None:
             raise ModbusException("No result from modbus read.")
-        if len(result.registers) != count:
+        self._check_response(
+            result,
+            "modbus read of {} registers from {} on {}".format(count, start, table),
+            count,
+        )
+        return result
+
+    @staticmethod
+    def _check_response(result, description: str, check_length: int | None):
+        # Raises a ModbusException if the device sent back an exception response,
+        # or the wrong number of registers.
+        exception_code = getattr(result, "exception_code", None)
+        if exception_code == ILLEGAL_FUNCTION:
+            raise IllegalFunctionException(
+                "Illegal function in {}.".format(description)
+            )
+        if exception_code == ILLEGAL_DATA_ADDRESS:
+            raise IllegalDataAddressException(
+                "Illegal data address in {}.".format(description)
+            )
+        if isinstance(exception_code, int) and exception_code > 0:
             raise ModbusException(
-                "Expected {} registers from modbus read on {}, got {}.".format(
-                    count, start, len(result.registers)
+                "Modbus exception code {} from {}.".format(exception_code, description)
+            )
+        if check_length is not None and len(result.registers) != check_length:
+            raise ModbusException(
+                "Expected {} registers from {}, got {}.".format(
+                    check_length, description, len(result.registers)
                 )
             )
-        return result.registers
+
+
+class ModbusBus:
+    # Several devices sharing one connection, such as the slaves on an RS485 line or
+    # behind a TCP gateway. Each device has its own modbus_interface, and so its own
+    # tables and batch plan, but they share the client and the request pacer, so
+    # only one request is on the bus at a time. Methods take the device address as
+    # unit, defaulting to device_address.
+
+    def __init__(
+        self, device_address: int = 0x01, state_file: str | None = None, **kwargs
+    ):
+        self._default_unit: int = device_address
+        self._state_file = state_file
+        self._kwargs = kwargs
+        self._devices: dict[int, modbus_interface] = {}
+        self._connected_device: modbus_interface | None = None
+        # Rotated each poll, so no device is always read last.
+        self._next_first: int = 0
+        self._device(device_address)
+
+    def _device(self, unit: int | None) -> modbus_interface:
+        if unit is None:
+            unit = self._default_unit
+        if unit not in self._devices:
+            state_file = self._state_file
+            if state_file is not None and unit != self._default_unit:
+                state_file = "{}.unit{}".format(state_file, unit)
+            device = modbus_interface(
+                device_address=unit, state_file=state_file, **self._kwargs
+            )
+            if self._devices:
+                primary = self._devices[self._default_unit]
+                device._pacer = primary._pacer
+                device._write_lock = primary._write_lock
+                if self._connected_device is not None:
+                    device._mb = self._connected_device._mb
+            self._devices[unit] = device
+        return self._devices[unit]
+
+    def connect(self) -> bool:
+        primary = self._devices[self._default_unit]
+        connected = primary.connect()
+        self._connected_device = primary
+        for device in self._devices.values():
+            device._mb = primary._mb
+        return connected
+
+    def close(self):
+        if self._connected_device is not None:
+            self._connected_device.close()
+
+    def check_link(self, idle_s: float) -> bool:
+        for device in self._devices.values():
+            if device.check_link(idle_s):
+                return True
+        return False
+
+    def poll(self):
+        # Interleaves the devices' batch plans, one read from each in turn, so a
+        # device with a long plan doesn't hold the others back. A device that doesn't
+        # answer a read is skipped for the rest of the poll, so a dead one costs a
+        # single timeout rather than one per batch.
+        devices = list(self._devices.values())
+        self._next_first = (self._next_first + 1) % len(devices)
+        devices = devices[self._next_first :] + devices[: self._next_first]
+        plans = [device._begin_poll() for device in devices]
+        failed = set()
+        for i in range(max(len(plan) for plan in plans)):
+            for index, device in enumerate(devices):
+                if index in failed or i >= len(plans[index]):
+                    continue
+                if not device._poll_batch(*plans[index][i]):
+                    failed.add(index)
+        for device in devices:
+            device._end_poll()
+
+    def get_metrics(self) -> dict:
+        metrics = self._devices[self._default_unit].get_metrics()
+        metrics["devices"] = {
+            unit: device.get_metrics()
+            for unit, device in self._devices.items()
+            if unit != self._default_unit
+        }
+        return metrics
+
+    def get_tables(self, unit: int | None = None) -> dict[str, ModbusTable]:
+        return self._device(unit).get_tables()
+
+    def add_monitor_register(self, table, addr, type="uint16", unit=None):
+        self._device(unit).add_monitor_register(table, addr, type)
+
+    def remove_monitor_register(self, table, addr, type="uint16", unit=None):
+        self._device(unit).remove_monitor_register(table, addr, type)
+
+    def get_value(self, table, addr, type="uint16", unit=None):
+        return self._device(unit).get_value(table, addr, type)
+
+    def get_read_time(self, table, addr, type="uint16", unit=None) -> float | None:
+        return self._device(unit).get_read_time(table, addr, type)
+
+    def refresh_value(self, table, addr, type="uint16", unit=None):
+        return self._device(unit).refresh_value(table, addr, type)
+
+    def set_value(
+        self, table, addr, value, mask=0xFFFF, type="uint16", flush=True, unit=None
+    ):
+        self._device(unit).set_value(table, addr, value, mask, type, flush=flush)
+
+    def write_lock(self) -> threading.RLock:
+        # Every device on the bus shares the one write lock.
+        return self._device(None).write_lock()
+
+    def flush_writes(self):
+        for device in self._devices.values():
+            device.flush_writes()
+
+    def read_range(self, table, start, count, unit=None) -> list[int]:
+        return self._device(unit).read_range(table, start, count)
+
+    def read_cached(
+        self, table, start, count, max_age: float, unit=None
+    ) -> tuple[list[int], bool]:
+        return self._device(unit).read_cached(table, start, count, max_age)
+
+    def refresh_range(self, table, start, count, unit=None) -> list[int]:
+        return self._device(unit).refresh_range(table, start, count)
+
+    def write_through(self, start, values: list[int], unit=None):
+        self._device(unit).write_through(start, values)
+
+    def mask_write_through(self, addr, and_mask, or_mask, unit=None):
+        self._device(unit).mask_write_through(addr, and_mask, or_mask)
+
+    def get_units(self) -> list[int]:
+        return list(self._devices)
+
+
+def merge_ranges(
+    ranges: list[tuple[int, int]],
+    max_length: int,
+    unreadable: frozenset[int] | set[int] = frozenset(),
+) -> list[tuple[int, int]]:
+    # Merges (start, length) ranges that overlap or touch into as few as possible,
+    # none longer than max_length, unless it was to start with. Ranges including
+    # an unreadable address are left on their own, as reading them will fail.
+    merged: list[tuple[int, int]] = []
+    alone = False
+    for start, length in sorted(set(ranges)):
+        was_alone = alone
+        alone = any(addr in unreadable for addr in range(start, start + length))
+        if merged and not alone and not was_alone:
+            merged_start, merged_length = merged[-1]
+            end = max(merged_start + merged_length, start + length)
+            if start <= merged_start + merged_length and (
+                end - merged_start <= max_length
+            ):
+                merged[-1] = (merged_start, end - merged_start)
+                continue
+        merged.append((start, length))
+    return merged
+
+
+def _parse_variant(variant: str | None) -> tuple[str | None, str]:
+    # Splits a variant into its framer, which may be None, and its connection.
+    if variant is None:
+        return None, "tcp"
+    if "-over-" in variant:
+        framer, client = variant.split("-over-")
+        return framer, client
+    return None, variant
+
+
+def rtu_frame_gap(baudrate: int, bytesize: int, parity: str, stopbits: int) -> float:
+    # Returns the 3.5 character times of silence that end an RTU frame.
+    if baudrate > 19200:
+        return RTU_FIXED_FRAME_GAP_S
+    bits = 1 + bytesize + (0 if parity.upper() == "N" else 1) + stopbits
+    return 3.5 * bits / baudrate
+
+
+def _sungrow_client(**kwargs):
+    # Imported on demand, because the Sungrow client's crypto dependencies are slow to import.
+    from SungrowModbusTcpClient import SungrowModbusTcpClient  # type: ignore
+
+    return SungrowModbusTcpClient.SungrowModbusTcpClient(**kwargs)
 
 
 def type_length(type):
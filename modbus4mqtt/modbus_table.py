@@ -1,11 +1,16 @@
+from bisect import bisect_left, bisect_right
+from typing import Iterable
+
+
 class ModbusTable:
 
     def __init__(self, read_batch_size: int = 100, write_batch_size: int = 0):
         self._registers: dict[int, int] = {}
-        # This flag is cleared when the register list is sorted
-        # and the batching is calculated.
+        # This flag is cleared when the batching is calculated.
         self._batches: list[tuple[int, int]] = []
         self._stale: bool = True
+        # This flag is cleared when the register list is sorted.
+        self._sorted: bool = True
         self._read_batch_size = read_batch_size
         if write_batch_size > 0:
             self._write_batch_size = write_batch_size
@@ -14,22 +19,98 @@ class ModbusTable:
         # These values have changed since the last write operation
         # and should be included in the next one.
         self._changed_registers: set[int] = set()
+        # These addresses have been rejected by the device as illegal.
+        # They are left out of read batches so they don't fail their neighbours.
+        self._unreadable: set[int] = set()
+        # Read batches always start a new batch at these addresses, as the device
+        # won't read across them, even though both sides are readable.
+        self._breaks: set[int] = set()
+        # The wall clock time each address was last read from the device.
+        self._read_times: dict[int, float] = {}
 
     def add_register(self, addr: int):
+        if addr in self._registers:
+            return
         self._registers[addr] = 0
-        self._stale = True
+        self._sorted = False
+        self._replan(addr)
+
+    def remove_register(self, addr: int):
+        if addr not in self._registers:
+            return
+        del self._registers[addr]
+        self._changed_registers.discard(addr)
+        self._read_times.pop(addr, None)
+        self._replan(addr)
+
+    def get_read_batch_size(self) -> int:
+        return self._read_batch_size
+
+    def set_read_batch_size(self, size: int):
+        if size != self._read_batch_size:
+            self._read_batch_size = size
+            self._stale = True
+
+    def mark_unreadable(self, addr: int):
+        if addr not in self._unreadable:
+            self._unreadable.add(addr)
+            self._replan(addr)
+
+    def is_unreadable(self, addr: int) -> bool:
+        return addr in self._unreadable
+
+    def get_unreadable(self) -> set[int]:
+        return set(self._unreadable)
+
+    def mark_break(self, addr: int):
+        if addr not in self._breaks:
+            self._breaks.add(addr)
+            self._replan(addr)
+
+    def get_breaks(self) -> set[int]:
+        return set(self._breaks)
 
     def sort(self):
         # This sorts the registers by address.
         self._registers = dict(sorted(self._registers.items()))
+        self._sorted = True
 
-    def get_batched_addresses(self, write_mode: bool = False) -> list[tuple[int, int]]:
+    def _is_batchable(self, addr: int) -> bool:
+        return addr in self._registers and addr not in self._unreadable
+
+    def _replan(self, addr: int):
+        # Batches never span a gap, so adding or removing an address can only change
+        # the batches of the contiguous run of readable addresses around it.
+        # Those are regenerated and the rest of the plan is left alone.
         if self._stale:
-            # If the number of registers has changed, we need to
-            # sort them again.
+            # A full plan is pending anyway.
+            return
+        low = addr
+        while self._is_batchable(low - 1):
+            low -= 1
+        high = addr
+        while self._is_batchable(high + 1):
+            high += 1
+        first = bisect_left(self._batches, low, key=lambda batch: batch[0])
+        last = bisect_right(self._batches, high, key=lambda batch: batch[0])
+        # A new list, rather than changing the old one in place, as a poll may be
+        # part way through the plan get_batched_addresses() returned.
+        self._batches = (
+            self._batches[:first]
+            + self._batch_addresses(
+                (a for a in range(low, high + 1) if self._is_batchable(a)),
+                self._read_batch_size,
+                self._breaks,
+            )
+            + self._batches[last:]
+        )
+
+    def get_batched_addresses(self, write_mode: bool = False) -> list[tuple[int, int]]:
+        if not self._sorted:
             self.sort()
+        if self._stale:
             self._stale = False
-            self._batches = self._generate_batched_addresses(write_mode=write_mode)
+            self._batches = self._generate_batched_addresses()
 
         if write_mode:
             if self._changed_registers:
@@ -42,23 +123,36 @@ class ModbusTable:
     def _generate_batched_addresses(
         self, write_mode: bool = False
     ) -> list[tuple[int, int]]:
-        # This returns a list of pair tuples. Each tuple is the start and length
-        # of a range of addresses that can be read/written together.
         # If "write_mode" is true, the returned lists will only include
         # registers that've changed since the last read operation.
+        if write_mode:
+            return self._batch_addresses(
+                (addr for addr in self._registers if addr in self._changed_registers),
+                self._write_batch_size,
+            )
+        return self._batch_addresses(
+            (addr for addr in self._registers if addr not in self._unreadable),
+            self._read_batch_size,
+            self._breaks,
+        )
+
+    @staticmethod
+    def _batch_addresses(
+        addresses: Iterable[int],
+        max_batch_size: int,
+        breaks: set[int] | frozenset[int] = frozenset(),
+    ) -> list[tuple[int, int]]:
+        # This returns a list of pair tuples. Each tuple is the start and length
+        # of a range of addresses that can be read/written together.
+        # The addresses must be sorted. A batch never continues across a break.
         result: list[tuple[int, int]] = []
         current_batch_start: int = -1
         current_batch_size: int = 0
         previous_addr = None
-        if write_mode:
-            max_batch_size = self._write_batch_size
-        else:
-            max_batch_size = self._read_batch_size
-        for addr in self._registers:
-            if write_mode and addr not in self._changed_registers:
-                continue
+        for addr in addresses:
             if current_batch_size >= max_batch_size or (
-                previous_addr is not None and addr != previous_addr + 1
+                previous_addr is not None
+                and (addr != previous_addr + 1 or addr in breaks)
             ):
                 result.append((current_batch_start, current_batch_size))
                 current_batch_start = addr
@@ -73,20 +167,42 @@ class ModbusTable:
             result.append((current_batch_start, current_batch_size))
         return result
 
-    def clear_changed_registers(self):
-        self._changed_registers = set()
+    def get_runs(self) -> list[tuple[int, int]]:
+        # Returns the contiguous runs of monitored addresses as (start, length) pairs.
+        if not self._sorted:
+            self.sort()
+        return self._batch_addresses(self._registers, max(1, len(self._registers)))
+
+    def get_range(self, start: int, length: int) -> list[int]:
+        return [self._registers[addr] for addr in range(start, start + length)]
+
+    def clear_changed_registers(self, addrs: Iterable[int] | None = None):
+        if addrs is None:
+            self._changed_registers = set()
+        else:
+            self._changed_registers.difference_update(addrs)
 
     def set_value(self, addr: int, value: int, mask: int = 0xFFFF, write: bool = False):
         if addr not in self._registers:
             raise ValueError("Address {} not in monitored registers.".format(addr))
         if value < 0 or value > 0xFFFF:
             raise ValueError("Value {} out of range for modbus register.".format(value))
+        if not write and addr in self._changed_registers:
+            # A read from the device mustn't undo a write that hasn't gone out yet.
+            return
         new_value = self._registers[addr] & (~mask) | (value & mask)
         if write:
             if new_value != self._registers[addr]:
                 self._changed_registers.add(addr)
         self._registers[addr] = new_value
 
+    def set_read_time(self, start: int, length: int, read_time: float):
+        for addr in range(start, start + length):
+            self._read_times[addr] = read_time
+
+    def get_read_time(self, addr: int) -> float | None:
+        return self._read_times.get(addr, None)
+
     def get_value(self, addr: int) -> int:
         if addr not in self._registers:
             raise ValueError("Address {} not in monitored registers.".format(addr))
@@ -0,0 +1,99 @@
+import json
+import zlib
+from typing import Any, Callable
+
+PAYLOAD_CODECS = ["text", "json", "cbor", "msgpack"]
+PAYLOAD_COMPRESSIONS = ["none", "zlib"]
+
+
+class PayloadCodec:
+    # Turns published values into MQTT payloads and back again. The functions that
+    # do the work are picked once, when the config is loaded, rather than per message.
+    #   text: Plain values are published as they are. JSON messages are JSON.
+    #   json: Everything is compact JSON.
+    #   cbor, msgpack: Everything is binary. These need the cbor2 or msgpack packages.
+    # Compression only applies to JSON messages, as plain values are too short to benefit.
+
+    def __init__(self, codec: str = "text", compression: str = "none"):
+        if codec not in PAYLOAD_CODECS:
+            raise ValueError(
+                "Bad YAML configuration. payload_codec must be one of {}.".format(
+                    PAYLOAD_CODECS
+                )
+            )
+        if compression not in PAYLOAD_COMPRESSIONS:
+            raise ValueError(
+                "Bad YAML configuration. Compression must be one of {}.".format(
+                    PAYLOAD_COMPRESSIONS
+                )
+            )
+        self.codec = codec
+        self.compression = compression
+        self._dumps: Callable[[Any], Any]
+        self._loads: Callable[[bytes], Any]
+        if codec == "text":
+            self._dumps = _dumps_text
+            self._loads = _loads_text
+        elif codec == "json":
+            self._dumps = _dumps_json
+            self._loads = json.loads
+        elif codec == "cbor":
+            try:
+                import cbor2
+            except ImportError:
+                raise ValueError(
+                    "The cbor payload codec needs the cbor2 package. "
+                    "Install it with: pip install modbus4mqtt[cbor]"
+                )
+            self._dumps = cbor2.dumps
+            self._loads = cbor2.loads
+        else:
+            try:
+                import msgpack
+            except ImportError:
+                raise ValueError(
+                    "The msgpack payload codec needs the msgpack package. "
+                    "Install it with: pip install modbus4mqtt[msgpack]"
+                )
+            self._dumps = msgpack.packb
+            self._loads = msgpack.unpackb
+
+    def encode(self, value: Any) -> Any:
+        payload = self._dumps(value)
+        if self.compression == "zlib" and isinstance(value, dict):
+            if isinstance(payload, str):
+                payload = payload.encode("utf-8")
+            payload = zlib.compress(payload)
+        return payload
+
+    def decode(self, payload: bytes) -> Any:
+        # Raises ValueError if the payload can't be decoded.
+        if self.compression == "zlib":
+            try:
+                payload = zlib.decompress(payload)
+            except zlib.error:
+                # Plain values aren't compressed.
+                pass
+        try:
+            return self._loads(payload)
+        except Exception as e:
+            raise ValueError("Couldn't decode {} payload: {}".format(self.codec, e))
+
+
+def _dumps_text(value: Any) -> Any:
+    if isinstance(value, dict):
+        return json.dumps(value, sort_keys=True)
+    # paho turns numbers into text itself.
+    return value
+
+
+def _loads_text(payload: bytes) -> Any:
+    text = payload.decode("utf-8")
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def _dumps_json(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"))
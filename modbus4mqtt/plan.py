@@ -0,0 +1,96 @@
+from .modbus_interface import type_length
+from .modbus_table import ModbusTable
+
+# Modbus TCP frame sizes in bytes. A read request is the 7 byte MBAP header plus
+# function code, start address and count. The response is the header plus function
+# code, byte count and two bytes per register.
+READ_REQUEST_BYTES = 12
+READ_RESPONSE_BASE_BYTES = 9
+
+
+def build_plan(tables: dict[str, ModbusTable], registers: list[dict]) -> dict:
+    # Describes the reads a single poll will perform, per table.
+    plan = {}
+    for name, table in tables.items():
+        batches = table.get_batched_addresses()
+        batch_of: dict[int, int] = {}
+        for index, (start, length) in enumerate(batches):
+            for addr in range(start, start + length):
+                batch_of[addr] = index
+        wanted: set[int] = set()
+        split = []
+        for register in registers:
+            if register.get("table", "holding") != name:
+                continue
+            addresses = range(
+                register["address"],
+                register["address"] + type_length(register.get("type", "uint16")),
+            )
+            wanted.update(addresses)
+            if len({batch_of.get(addr) for addr in addresses}) > 1:
+                # This value is assembled from more than one read, so its words
+                # can come from different moments in time.
+                split.append(register)
+        plan[name] = {
+            "batches": batches,
+            "requests": len(batches),
+            "words_read": sum(length for _, length in batches),
+            "words_wanted": len(wanted),
+            "split": split,
+        }
+    return plan
+
+
+def wire_bytes(batches: list[tuple[int, int]]) -> int:
+    return sum(
+        READ_REQUEST_BYTES + READ_RESPONSE_BASE_BYTES + 2 * length
+        for _, length in batches
+    )
+
+
+def estimate_wire_time(
+    batches: list[tuple[int, int]], latency_s: float, bitrate: float | None = None
+) -> float:
+    # Each request costs a round trip, plus the time to clock its bytes onto the
+    # link if a bitrate is given.
+    wire_time = latency_s * len(batches)
+    if bitrate:
+        wire_time += wire_bytes(batches) * 8 / bitrate
+    return wire_time
+
+
+def format_plan(plan: dict, latency_s: float, bitrate: float | None = None) -> str:
+    lines = []
+    total_requests = 0
+    total_time = 0.0
+    for name, table_plan in plan.items():
+        batches = table_plan["batches"]
+        wire_time = estimate_wire_time(batches, latency_s, bitrate)
+        total_requests += table_plan["requests"]
+        total_time += wire_time
+        lines.append("Table: {}".format(name))
+        lines.append("  Requests per poll: {}".format(table_plan["requests"]))
+        lines.append(
+            "  Words read: {}, words wanted: {}".format(
+                table_plan["words_read"], table_plan["words_wanted"]
+            )
+        )
+        lines.append("  Bytes on the wire: {}".format(wire_bytes(batches)))
+        lines.append("  Estimated wire time: {:.1f} ms".format(wire_time * 1000))
+        for start, length in batches:
+            lines.append(
+                "    Read {} registers from {} to {}".format(
+                    length, start, start + length - 1
+                )
+            )
+        for register in table_plan["split"]:
+            lines.append(
+                "  Warning: {} {} at {} is split across reads".format(
+                    register.get("type", "uint16"),
+                    register.get("pub_topic", register.get("set_topic", "")),
+                    register["address"],
+                )
+            )
+    lines.append("Total requests per poll: {}".format(total_requests))
+    lines.append("Total estimated wire time: {:.1f} ms".format(total_time * 1000))
+    return "\n".join(lines)
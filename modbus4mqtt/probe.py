@@ -0,0 +1,191 @@
+import logging
+from statistics import median
+from time import monotonic
+from typing import Callable
+
+from pymodbus import ModbusException
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+
+from . import modbus_interface
+
+# The modbus spec allows up to 125 registers in a single read.
+PROTOCOL_MAX_READ = 125
+DEFAULT_LATENCY_SAMPLES = 5
+
+
+def find_readable_blocks(
+    read: Callable[[int, int], object], start: int, end: int, batch_size: int
+) -> list[tuple[int, int]]:
+    # Sweeps the addresses from start up to (but not including) end and returns a
+    # list of (start, length) tuples of contiguous readable addresses.
+    # Each batch is read whole first. If the device rejects it, it's split in half and
+    # each half is tried again, so big readable regions are found in a handful of
+    # requests. A batch the device doesn't answer at all is skipped, rather than
+    # split into many more requests that would each wait out the timeout.
+    readable: list[tuple[int, int]] = []
+
+    def sweep(addr: int, count: int):
+        try:
+            read(addr, count)
+        except ConnectionException:
+            raise
+        except ModbusIOException:
+            logging.warning(
+                "No response to a read of {} registers from {}. Skipping them.".format(
+                    count, addr
+                )
+            )
+            return
+        except ModbusException:
+            if count == 1:
+                return
+            half = count // 2
+            sweep(addr, half)
+            sweep(addr + half, count - half)
+            return
+        readable.append((addr, count))
+
+    for addr in range(start, end, batch_size):
+        sweep(addr, min(batch_size, end - addr))
+
+    # Stitch neighbouring readable ranges back together.
+    blocks: list[tuple[int, int]] = []
+    for addr, count in readable:
+        if blocks and blocks[-1][0] + blocks[-1][1] == addr:
+            blocks[-1] = (blocks[-1][0], blocks[-1][1] + count)
+        else:
+            blocks.append((addr, count))
+    return blocks
+
+
+def find_max_batch(
+    read: Callable[[int, int], object], block: tuple[int, int], limit: int
+) -> int:
+    # Binary searches for the biggest read the device will accept within a readable block.
+    # A read the device doesn't answer is taken as too big, like a rejected one, as
+    # slow devices often time out on big reads.
+    addr, length = block
+    good, bad = 1, min(length, limit) + 1
+    while bad - good > 1:
+        size = (good + bad) // 2
+        try:
+            read(addr, size)
+            good = size
+        except ConnectionException:
+            raise
+        except ModbusIOException:
+            logging.warning("No response to a read of {} registers.".format(size))
+            bad = size
+        except ModbusException:
+            bad = size
+    return good
+
+
+def measure_latency(
+    read: Callable[[int, int], object],
+    addr: int,
+    max_batch: int,
+    samples: int = DEFAULT_LATENCY_SAMPLES,
+) -> dict[int, float]:
+    # Returns the median round-trip time in seconds for reads of increasing size.
+    sizes = []
+    size = 1
+    while size < max_batch:
+        sizes.append(size)
+        size *= 2
+    sizes.append(max_batch)
+    result = {}
+    for size in sizes:
+        timings = []
+        for _ in range(samples):
+            start_time = monotonic()
+            read(addr, size)
+            timings.append(monotonic() - start_time)
+        result[size] = median(timings)
+    return result
+
+
+def starter_config(
+    ip: str,
+    port: int,
+    device_address: int,
+    variant: str | None,
+    table: str,
+    blocks: list[tuple[int, int]],
+    read_batching: int,
+) -> dict:
+    # Builds a config with a register for every readable address. The registers are
+    # grouped into one JSON topic per batch-sized chunk of each readable block.
+    config: dict = {"ip": ip, "port": port, "device_address": device_address}
+    if variant is not None:
+        config["variant"] = variant
+    config["update_rate"] = 5
+    config["read_batching"] = read_batching
+    registers = []
+    for block_start, block_length in blocks:
+        for chunk_start in range(
+            block_start, block_start + block_length, read_batching
+        ):
+            chunk_end = min(chunk_start + read_batching, block_start + block_length)
+            topic = "{}/{}-{}".format(table, chunk_start, chunk_end - 1)
+            for addr in range(chunk_start, chunk_end):
+                registers.append(
+                    {
+                        "pub_topic": topic,
+                        "table": table,
+                        "address": addr,
+                        "json_key": str(addr),
+                    }
+                )
+    config["registers"] = registers
+    return config
+
+
+def probe(
+    ip: str,
+    port: int,
+    device_address: int,
+    variant: str | None,
+    table: str,
+    start: int,
+    end: int,
+    samples: int = DEFAULT_LATENCY_SAMPLES,
+    timeout: float = modbus_interface.DEFAULT_REQUEST_TIMEOUT_S,
+    retries: int = modbus_interface.DEFAULT_REQUEST_RETRIES,
+) -> dict:
+    # Probes a device and returns a dictionary describing what was found.
+    mb = modbus_interface.modbus_interface(
+        ip=ip,
+        port=port,
+        device_address=device_address,
+        variant=variant,
+        timeout=timeout,
+        retries=retries,
+    )
+    if not mb.connect():
+        raise ConnectionException("Failed to connect to {}:{}".format(ip, port))
+    try:
+
+        def read(addr: int, count: int):
+            return mb.read_range(table, addr, count)
+
+        logging.info("Sweeping {} table from {} to {}...".format(table, start, end))
+        blocks = find_readable_blocks(read, start, end, PROTOCOL_MAX_READ)
+        if not blocks:
+            return {"blocks": [], "max_batch": None, "latency": {}, "config": None}
+        largest = max(blocks, key=lambda block: block[1])
+        max_batch = find_max_batch(read, largest, PROTOCOL_MAX_READ)
+        logging.info("Largest accepted read: {} registers.".format(max_batch))
+        latency = measure_latency(read, largest[0], max_batch, samples)
+        read_batching = min(max_batch, modbus_interface.MAX_BATCHING)
+        config = starter_config(
+            ip, port, device_address, variant, table, blocks, read_batching
+        )
+        return {
+            "blocks": blocks,
+            "max_batch": max_batch,
+            "latency": latency,
+            "config": config,
+        }
+    finally:
+        mb.close()
@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import threading
+from typing import Any
+
+from pymodbus import ModbusException
+from pymodbus.constants import ExcCodes
+from pymodbus.datastore import ModbusBaseDeviceContext, ModbusServerContext
+from pymodbus.pdu import ExceptionResponse, ModbusPDU
+from pymodbus.pdu.register_message import (
+    MaskWriteRegisterRequest,
+    MaskWriteRegisterResponse,
+)
+from pymodbus.server import ModbusTcpServer
+
+from modbus4mqtt.modbus_interface import (
+    IllegalDataAddressException,
+    IllegalFunctionException,
+)
+
+DEFAULT_PROXY_HOST = "127.0.0.1"
+# How long to wait for the server to start listening, or to shut down.
+PROXY_START_TIMEOUT_S = 5
+HOLDING_FUNCTION_CODES = [3, 6, 16, 22, 23]
+INPUT_FUNCTION_CODES = [4]
+# These read the register as part of a write, so always get it from the device.
+UNCACHED_FUNCTION_CODES = [22, 23]
+
+
+class ForwardedMaskWriteRequest(MaskWriteRegisterRequest):
+    # pymodbus serves a mask write by reading the register, applying the masks and
+    # writing all of it back. Through the proxy that would undo any bits the device
+    # had changed since the read, so the masks are passed on to the device instead.
+
+    async def update_datastore(self, context) -> ModbusPDU:
+        rc = await context.async_mask_write(self.address, self.and_mask, self.or_mask)
+        if rc:
+            return ExceptionResponse(self.function_code, rc)
+        return MaskWriteRegisterResponse(
+            address=self.address,
+            and_mask=self.and_mask,
+            or_mask=self.or_mask,
+            dev_id=self.dev_id,
+            transaction_id=self.transaction_id,
+        )
+
+
+class CacheContext(ModbusBaseDeviceContext):
+    # Answers a Modbus client's requests for one device. Reads are served from the
+    # register image the poller keeps, if it's fresh enough, and read from the device
+    # otherwise. Writes go straight through to the device.
+
+    def __init__(
+        self,
+        interface,
+        max_age: float,
+        stats: dict,
+        stats_lock: threading.Lock,
+        unit: int | None,
+    ):
+        self._interface = interface
+        self._max_age = max_age
+        self._stats = stats
+        self._stats_lock = stats_lock
+        self._unit: dict[str, Any] = {} if unit is None else {"unit": unit}
+
+    def reset(self):
+        pass
+
+    # The device may need to be asked, which blocks, so that's done off the
+    # server's event loop to keep other clients' cached reads moving.
+    async def async_getValues(self, func_code: int, address: int, count: int = 1):
+        return await asyncio.to_thread(self.getValues, func_code, address, count)
+
+    async def async_setValues(self, func_code: int, address: int, values):
+        return await asyncio.to_thread(self.setValues, func_code, address, values)
+
+    async def async_mask_write(self, address: int, and_mask: int, or_mask: int):
+        return await asyncio.to_thread(self.mask_write, address, and_mask, or_mask)
+
+    def _count(self, stat: str):
+        # The requests are served on worker threads.
+        with self._stats_lock:
+            self._stats[stat] += 1
+
+    def getValues(self, func_code: int, address: int, count: int = 1):
+        if func_code in HOLDING_FUNCTION_CODES:
+            table = "holding"
+        elif func_code in INPUT_FUNCTION_CODES:
+            table = "input"
+        else:
+            return ExcCodes.ILLEGAL_FUNCTION
+        try:
+            if func_code in UNCACHED_FUNCTION_CODES:
+                registers = self._interface.refresh_range(
+                    table, address, count, **self._unit
+                )
+                cached = False
+            else:
+                registers, cached = self._interface.read_cached(
+                    table, address, count, self._max_age, **self._unit
+                )
+        except IllegalDataAddressException:
+            return ExcCodes.ILLEGAL_ADDRESS
+        except (ModbusException, ValueError) as e:
+            logging.warning("Failed to forward a proxied read: {}".format(e))
+            self._count("failures")
+            return ExcCodes.GATEWAY_NO_RESPONSE
+        self._count("cached_reads" if cached else "forwarded_reads")
+        return registers
+
+    def setValues(self, func_code: int, address: int, values):
+        if func_code not in HOLDING_FUNCTION_CODES:
+            return ExcCodes.ILLEGAL_FUNCTION
+        try:
+            self._interface.write_through(address, list(values), **self._unit)
+        except IllegalDataAddressException:
+            return ExcCodes.ILLEGAL_ADDRESS
+        except ModbusException as e:
+            logging.warning("Failed to forward a proxied write: {}".format(e))
+            self._count("failures")
+            return ExcCodes.GATEWAY_NO_RESPONSE
+        self._count("writes")
+        return None
+
+    def mask_write(self, address: int, and_mask: int, or_mask: int):
+        try:
+            self._interface.mask_write_through(address, and_mask, or_mask, **self._unit)
+        except IllegalDataAddressException:
+            return ExcCodes.ILLEGAL_ADDRESS
+        except IllegalFunctionException:
+            return ExcCodes.ILLEGAL_FUNCTION
+        except ModbusException as e:
+            logging.warning("Failed to forward a proxied mask write: {}".format(e))
+            self._count("failures")
+            return ExcCodes.GATEWAY_NO_RESPONSE
+        self._count("writes")
+        return None
+
+
+class ProxyServer:
+    # A Modbus TCP server that shares one upstream connection between any number of
+    # local clients. It runs its own event loop on a background thread.
+    # With units, only those device addresses are answered. Otherwise every
+    # address is taken to mean the one device.
+
+    def __init__(
+        self,
+        interface,
+        port: int,
+        max_age: float,
+        host: str = DEFAULT_PROXY_HOST,
+        units: list[int] | None = None,
+    ):
+        self._stats = {
+            "cached_reads": 0,
+            "forwarded_reads": 0,
+            "writes": 0,
+            "failures": 0,
+        }
+        self._stats_lock = threading.Lock()
+        if units is None:
+            self._context = ModbusServerContext(
+                devices=CacheContext(
+                    interface, max_age, self._stats, self._stats_lock, None
+                ),
+                single=True,
+            )
+        else:
+            self._context = ModbusServerContext(
+                devices={
+                    unit: CacheContext(
+                        interface, max_age, self._stats, self._stats_lock, unit
+                    )
+                    for unit in units
+                },
+                single=False,
+            )
+        self._address = (host, port)
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._server: ModbusTcpServer | None = None
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        # Raises RuntimeError if the server can't listen on its address.
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        error: list[BaseException] = []
+
+        async def serve():
+            try:
+                self._server = ModbusTcpServer(
+                    self._context,
+                    address=self._address,
+                    custom_pdu=[ForwardedMaskWriteRequest],
+                )
+                await self._server.serve_forever(background=True)
+            except BaseException as e:
+                error.append(e)
+                return
+            finally:
+                ready.set()
+            await self._server.serving
+
+        self._thread = threading.Thread(
+            target=self._loop.run_until_complete, args=(serve(),), daemon=True
+        )
+        self._thread.start()
+        ready.wait(PROXY_START_TIMEOUT_S)
+        if error:
+            raise RuntimeError(
+                "Couldn't start the modbus proxy on {}:{}: {}".format(
+                    *self._address, error[0]
+                )
+            )
+        logging.info("Modbus proxy listening on {}:{}.".format(*self._address))
+
+    def stop(self):
+        if self._loop is None or self._thread is None:
+            return
+        if self._server is not None and self._thread.is_alive():
+            asyncio.run_coroutine_threadsafe(
+                self._server.shutdown(), self._loop
+            ).result(PROXY_START_TIMEOUT_S)
+        self._thread.join(PROXY_START_TIMEOUT_S)
+        self._loop.close()
+        self._loop = None
+
+    def get_metrics(self) -> dict:
+        with self._stats_lock:
+            return dict(self._stats)
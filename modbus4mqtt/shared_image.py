@@ -0,0 +1,216 @@
+import mmap
+import os
+import struct
+from time import monotonic, sleep
+
+from modbus4mqtt.modbus_table import ModbusTable
+
+# The image file starts with a header: a magic number, the format version, flags,
+# the seqlock sequence number, the wall clock time of the poll the image is from, the
+# number of tables and the number of runs. A table entry follows for each table,
+# giving its name and its first run. A run entry follows for each contiguous run of
+# monitored addresses, giving its first address, its length and where its values are.
+# The values themselves follow, as little-endian 16 bit words.
+#
+# The sequence number is odd while the image is being written, which includes a new
+# file until its first values are in. To read a consistent image, read the sequence
+# number, wait for it to be even, read the values, then check the sequence number
+# hasn't changed. If it has, read again. A sequence number that stays odd means the
+# writer stopped part way through, so readers give up after a while.
+#
+# When the layout changes, such as on a config reload, a new file replaces the old one
+# and the old one is flagged as superseded, so readers know to open the path again.
+HEADER = struct.Struct("<4sHHQdII")
+MAGIC = b"M4MI"
+VERSION = 1
+FLAG_SUPERSEDED = 1
+FLAGS_OFFSET = 6
+SEQUENCE = struct.Struct("<Q")
+SEQUENCE_OFFSET = 8
+POLL_TIME = struct.Struct("<d")
+POLL_TIME_OFFSET = 16
+TABLE = struct.Struct("<16sII")
+RUN = struct.Struct("<III")
+
+
+class SharedImage:
+    # Mirrors the raw register tables into a memory-mapped file after each poll, for
+    # processes on the same machine that want the values with no copying and no
+    # socket in between. Put it on a tmpfs, like /dev/shm, to keep it off the disk.
+
+    def __init__(self, path: str):
+        self._path = path
+        self._map: mmap.mmap | None = None
+        self._layout: list[tuple[str, list[tuple[int, int]]]] = []
+        self._data_offsets: list[int] = []
+        self._sequence = 0
+
+    def update(self, tables: dict[str, ModbusTable], poll_time: float):
+        layout = [(name, table.get_runs()) for name, table in tables.items()]
+        if self._map is None or layout != self._layout:
+            self._create(layout)
+        assert self._map is not None
+        if self._sequence % 2 == 0:
+            self._sequence += 1
+            SEQUENCE.pack_into(self._map, SEQUENCE_OFFSET, self._sequence)
+        POLL_TIME.pack_into(self._map, POLL_TIME_OFFSET, poll_time)
+        offsets = iter(self._data_offsets)
+        for name, runs in layout:
+            for start, length in runs:
+                struct.pack_into(
+                    "<{}H".format(length),
+                    self._map,
+                    next(offsets),
+                    *tables[name].get_range(start, length),
+                )
+        self._sequence += 1
+        SEQUENCE.pack_into(self._map, SEQUENCE_OFFSET, self._sequence)
+
+    def _create(self, layout: list[tuple[str, list[tuple[int, int]]]]):
+        run_count = sum(len(runs) for _, runs in layout)
+        data_offset = HEADER.size + len(layout) * TABLE.size + run_count * RUN.size
+        size = data_offset + 2 * sum(length for _, runs in layout for _, length in runs)
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w+b") as f:
+            f.truncate(max(size, 1))
+            new_map = mmap.mmap(f.fileno(), max(size, 1))
+        # A new image starts out being written, so a reader that opens it before
+        # its values are filled in waits for them.
+        HEADER.pack_into(new_map, 0, MAGIC, VERSION, 0, 1, 0.0, len(layout), run_count)
+        offset = HEADER.size
+        first_run = 0
+        for name, runs in layout:
+            TABLE.pack_into(new_map, offset, name.encode("utf-8"), first_run, len(runs))
+            offset += TABLE.size
+            first_run += len(runs)
+        self._data_offsets = []
+        for _, runs in layout:
+            for start, length in runs:
+                RUN.pack_into(new_map, offset, start, length, data_offset)
+                self._data_offsets.append(data_offset)
+                offset += RUN.size
+                data_offset += 2 * length
+        if self._map is None:
+            self._supersede_previous_run()
+        os.replace(tmp_path, self._path)
+        if self._map is not None:
+            struct.pack_into("<H", self._map, FLAGS_OFFSET, FLAG_SUPERSEDED)
+            self._map.close()
+        self._map = new_map
+        self._layout = layout
+        self._sequence = 1
+
+    def _supersede_previous_run(self):
+        # Readers may still have the image from before a restart open.
+        try:
+            with open(self._path, "r+b") as f:
+                header = f.read(HEADER.size)
+                if len(header) == HEADER.size and header[:4] == MAGIC:
+                    f.seek(FLAGS_OFFSET)
+                    f.write(struct.pack("<H", FLAG_SUPERSEDED))
+        except OSError:
+            pass
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class SharedImageReader:
+    # Reads the image written by SharedImage, from another process. Reads raise
+    # TimeoutError if they can't get a consistent image within timeout seconds.
+
+    def __init__(self, path: str, timeout: float = 1.0):
+        self._path = path
+        self._timeout = timeout
+        self._map: mmap.mmap | None = None
+        self._open()
+
+    def _open(self) -> None:
+        if self._map is not None:
+            self._map.close()
+        with open(self._path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, _, _, table_count, run_count = HEADER.unpack_from(
+            self._map, 0
+        )
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} isn't a register image.".format(self._path))
+        # Keyed by table name, a list of (start, length, data offset) for each run.
+        self.layout: dict[str, list[tuple[int, int, int]]] = {}
+        runs_offset = HEADER.size + table_count * TABLE.size
+        for i in range(table_count):
+            name, first_run, count = TABLE.unpack_from(
+                self._map, HEADER.size + i * TABLE.size
+            )
+            self.layout[name.rstrip(b"\0").decode("utf-8")] = [
+                RUN.unpack_from(self._map, runs_offset + run * RUN.size)
+                for run in range(first_run, first_run + count)
+            ]
+
+    def _consistent(self, read):
+        # Calls read() until it gets a result the writer didn't change underneath it.
+        deadline = monotonic() + self._timeout
+        while True:
+            if monotonic() > deadline:
+                raise TimeoutError(
+                    "{} was still being written after {} s.".format(
+                        self._path, self._timeout
+                    )
+                )
+            assert self._map is not None
+            (flags,) = struct.unpack_from("<H", self._map, FLAGS_OFFSET)
+            if flags & FLAG_SUPERSEDED:
+                self._open()
+                continue
+            (before,) = SEQUENCE.unpack_from(self._map, SEQUENCE_OFFSET)
+            if before % 2:
+                sleep(0)
+                continue
+            result = read()
+            (after,) = SEQUENCE.unpack_from(self._map, SEQUENCE_OFFSET)
+            if before == after:
+                return result
+
+    def read(self) -> tuple[float, dict[str, dict[int, int]]]:
+        # Returns the time of the poll and every table's values, keyed by address.
+        def read():
+            assert self._map is not None
+            (poll_time,) = POLL_TIME.unpack_from(self._map, POLL_TIME_OFFSET)
+            tables = {}
+            for name, runs in self.layout.items():
+                values = {}
+                for start, length, offset in runs:
+                    words = struct.unpack_from("<{}H".format(length), self._map, offset)
+                    values.update(zip(range(start, start + length), words))
+                tables[name] = values
+            return poll_time, tables
+
+        return self._consistent(read)
+
+    def read_range(self, table: str, start: int, count: int) -> list[int]:
+        # Reads just these addresses, which must all be in one run.
+        def read():
+            assert self._map is not None
+            for run_start, length, offset in self.layout[table]:
+                if run_start <= start and start + count <= run_start + length:
+                    return list(
+                        struct.unpack_from(
+                            "<{}H".format(count),
+                            self._map,
+                            offset + 2 * (start - run_start),
+                        )
+                    )
+            raise ValueError(
+                "Addresses {} to {} of {} aren't in the image.".format(
+                    start, start + count - 1, table
+                )
+            )
+
+        return self._consistent(read)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
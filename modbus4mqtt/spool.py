@@ -0,0 +1,176 @@
+import logging
+import mmap
+import os
+import struct
+
+DEFAULT_SPOOL_MAX_BYTES = 16 * 1024 * 1024
+SPOOL_SEGMENTS = 16
+# Each segment starts with a header: a magic number, the segment's sequence number
+# and the offset of the next record to replay from it. A sequence number of 0 marks
+# a segment that has never been used.
+HEADER = struct.Struct("<4sQI")
+MAGIC = b"M4MS"
+# Each record is a length, then the retain flag, the wall clock time it was
+# captured, the topic length, the topic and the payload. A zero length marks the
+# end of the records in a segment.
+RECORD_LENGTH = struct.Struct("<I")
+RECORD_HEADER = struct.Struct("<?dH")
+
+
+class Spool:
+    # A bounded store-and-forward buffer for MQTT messages, kept on disk in a ring of
+    # fixed-size memory-mapped segment files. When the ring is full the oldest segment
+    # is dropped to make room, so disk and memory use never grow past the configured
+    # size, however long the outage lasts. The replay position is kept in the segment
+    # headers, so a backlog survives restarts.
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = DEFAULT_SPOOL_MAX_BYTES,
+        segments: int = SPOOL_SEGMENTS,
+    ):
+        if segments < 2:
+            raise ValueError("A spool needs at least two segments.")
+        self._segment_size = max_bytes // segments
+        if self._segment_size < HEADER.size + 2 * RECORD_LENGTH.size:
+            raise ValueError("Spool size {} is too small.".format(max_bytes))
+        os.makedirs(path, exist_ok=True)
+        self._maps: list[mmap.mmap] = []
+        for i in range(segments):
+            segment_path = os.path.join(path, "segment-{:04d}".format(i))
+            with open(segment_path, "a+b") as f:
+                if os.fstat(f.fileno()).st_size != self._segment_size:
+                    # Left over from a spool of a different size. Start it afresh.
+                    f.truncate(0)
+                    f.truncate(self._segment_size)
+                self._maps.append(mmap.mmap(f.fileno(), self._segment_size))
+        # The number of records waiting to be replayed from each segment.
+        self._pending = [0] * segments
+        self.dropped = 0
+        self._recover()
+
+    def _read_header(self, segment: int) -> tuple[int, int]:
+        magic, sequence, read_offset = HEADER.unpack_from(self._maps[segment], 0)
+        if magic != MAGIC:
+            return 0, HEADER.size
+        return sequence, read_offset
+
+    def _write_header(self, segment: int, sequence: int, read_offset: int):
+        HEADER.pack_into(self._maps[segment], 0, MAGIC, sequence, read_offset)
+
+    def _scan(self, segment: int, offset: int) -> tuple[int, int]:
+        # Returns the number of records from offset onwards and the offset of the end.
+        count = 0
+        segment_map = self._maps[segment]
+        while offset + RECORD_LENGTH.size <= self._segment_size:
+            (length,) = RECORD_LENGTH.unpack_from(segment_map, offset)
+            end = offset + RECORD_LENGTH.size + length
+            if length == 0 or end > self._segment_size:
+                break
+            count += 1
+            offset = end
+        return count, offset
+
+    def _recover(self):
+        sequences = [
+            self._read_header(segment)[0] for segment in range(len(self._maps))
+        ]
+        used = sorted(
+            (sequence, segment)
+            for segment, sequence in enumerate(sequences)
+            if sequence > 0
+        )
+        if not used:
+            self._sequence = 0
+            self._start_segment(0)
+            self._read_segment = 0
+            return
+        self._sequence, self._write_segment = used[-1]
+        self._read_segment = self._write_segment
+        for _, segment in reversed(used):
+            _, read_offset = self._read_header(segment)
+            count, end = self._scan(segment, read_offset)
+            self._pending[segment] = count
+            if segment == self._write_segment:
+                self._write_offset = end
+            if count:
+                self._read_segment = segment
+        if any(self._pending):
+            logging.info(
+                "Recovered {} spooled messages from a previous run.".format(len(self))
+            )
+
+    def _start_segment(self, segment: int):
+        self._sequence += 1
+        self._write_segment = segment
+        self._write_offset = HEADER.size
+        self._pending[segment] = 0
+        self._write_header(segment, self._sequence, HEADER.size)
+        RECORD_LENGTH.pack_into(self._maps[segment], HEADER.size, 0)
+
+    def __len__(self) -> int:
+        return sum(self._pending)
+
+    def append(self, topic: str, payload: bytes, retain: bool, timestamp: float):
+        topic_bytes = topic.encode("utf-8")
+        record = (
+            RECORD_HEADER.pack(retain, timestamp, len(topic_bytes))
+            + topic_bytes
+            + payload
+        )
+        size = RECORD_LENGTH.size + len(record)
+        if HEADER.size + size > self._segment_size:
+            raise ValueError(
+                "Message on {} is too big for a spool segment of {} bytes.".format(
+                    topic, self._segment_size
+                )
+            )
+        if self._write_offset + size > self._segment_size:
+            self._maps[self._write_segment].flush()
+            segment = (self._write_segment + 1) % len(self._maps)
+            if self._pending[segment]:
+                # The ring is full. Make room by dropping the oldest messages.
+                self.dropped += self._pending[segment]
+                if segment == self._read_segment:
+                    self._read_segment = (segment + 1) % len(self._maps)
+            self._start_segment(segment)
+            if not self._pending[self._read_segment]:
+                # Everything before this segment has been replayed.
+                self._read_segment = segment
+        segment_map = self._maps[self._write_segment]
+        RECORD_LENGTH.pack_into(segment_map, self._write_offset, len(record))
+        start = self._write_offset + RECORD_LENGTH.size
+        segment_map[start : start + len(record)] = record
+        self._write_offset = start + len(record)
+        if self._write_offset + RECORD_LENGTH.size <= self._segment_size:
+            RECORD_LENGTH.pack_into(segment_map, self._write_offset, 0)
+        self._pending[self._write_segment] += 1
+
+    def pop(self) -> tuple[str, bytes, bool, float] | None:
+        # Returns the oldest message as (topic, payload, retain, timestamp), or None.
+        while not self._pending[self._read_segment]:
+            if self._read_segment == self._write_segment:
+                return None
+            self._read_segment = (self._read_segment + 1) % len(self._maps)
+        segment = self._read_segment
+        segment_map = self._maps[segment]
+        sequence, offset = self._read_header(segment)
+        (length,) = RECORD_LENGTH.unpack_from(segment_map, offset)
+        start = offset + RECORD_LENGTH.size
+        retain, timestamp, topic_length = RECORD_HEADER.unpack_from(segment_map, start)
+        topic_start = start + RECORD_HEADER.size
+        payload_start = topic_start + topic_length
+        topic = segment_map[topic_start:payload_start].decode("utf-8")
+        payload = segment_map[payload_start : start + length]
+        self._write_header(segment, sequence, start + length)
+        self._pending[segment] -= 1
+        if not self._pending[segment] and segment != self._write_segment:
+            self._read_segment = (segment + 1) % len(self._maps)
+        return topic, payload, retain, timestamp
+
+    def close(self):
+        for segment_map in self._maps:
+            segment_map.flush()
+            segment_map.close()
+        self._maps = []
@@ -0,0 +1,97 @@
+import http.client
+import json
+import socket
+import threading
+from time import monotonic
+
+import pytest
+
+from modbus4mqtt import api
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__("localhost")
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self._path)
+
+
+def get(path, url):
+    connection = UnixHTTPConnection(path)
+    try:
+        connection.request("GET", url)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def test_store_changes():
+    store = api.ValueStore()
+    store.update([("a", None, 1, 100.0), ("b", "x", "on", 100.0)])
+    result = store.get()
+    assert result["sequence"] == 2
+    assert [entry["value"] for entry in result["values"]] == [1, "on"]
+    # Unchanged values don't count as changes.
+    store.update([("a", None, 1, 101.0), ("b", "x", "off", 101.0)])
+    result = store.get(since=2)
+    assert result["sequence"] == 3
+    assert result["values"] == [
+        {"topic": "b", "json_key": "x", "value": "off", "timestamp": 101.0}
+    ]
+    assert store.get(["a"])["values"][0]["timestamp"] == 101.0
+    # Nothing has changed since the latest sequence number.
+    assert store.get(since=3)["values"] == []
+    # Values of registers removed by a reload go with them.
+    store.set_registers([{"pub_topic": "b", "json_key": "x", "address": 2}])
+    assert [entry["topic"] for entry in store.get()["values"]] == ["b"]
+
+
+def test_store_long_poll():
+    store = api.ValueStore()
+    store.update([("a", None, 1, None)])
+    timer = threading.Timer(0.1, store.update, [[("a", None, 2, None)]])
+    timer.start()
+    start = monotonic()
+    result = store.get(since=1, wait=5)
+    assert monotonic() - start < 1
+    assert result["values"][0]["value"] == 2
+    # A wait with no changes times out empty-handed.
+    assert store.get(since=2, wait=0.05)["values"] == []
+
+
+def test_unix_socket(tmp_path):
+    path = str(tmp_path / "api.sock")
+    local_api = api.LocalApi(socket_path=path)
+    local_api.start()
+    try:
+        local_api.store.set_registers(
+            [{"pub_topic": "meter/power", "address": 1, "value": 5}]
+        )
+        local_api.store.update([("meter/power", None, 5, 100.0)])
+        status, body = get(path, "/values/meter%2Fpower")
+        assert status == 200
+        assert body["values"][0]["value"] == 5
+        status, body = get(path, "/values?topic=meter/power&topic=other")
+        assert len(body["values"]) == 1
+        status, body = get(path, "/registers")
+        assert body["registers"] == [{"pub_topic": "meter/power", "address": 1}]
+        status, _ = get(path, "/values/missing")
+        assert status == 404
+        status, _ = get(path, "/values?since=x")
+        assert status == 400
+        status, _ = get(path, "/values?wait=nan")
+        assert status == 400
+    finally:
+        local_api.stop()
+
+
+def test_socket_path_not_a_socket(tmp_path):
+    path = tmp_path / "api.sock"
+    path.write_text("keep me")
+    with pytest.raises(ValueError):
+        api.LocalApi(socket_path=str(path))
+    assert path.read_text() == "keep me"
@@ -1,9 +1,15 @@
 from collections import namedtuple
+import json
+import os
+import socket
+import tempfile
+from time import sleep, time
 import unittest
 from unittest.mock import patch, Mock
 
 from modbus4mqtt import modbus_interface
 from pymodbus import ModbusException
+from pymodbus.exceptions import ConnectionException, ModbusIOException
 
 
 def assert_no_call(self, *args, **kwargs):
@@ -24,6 +30,9 @@ MQTT_TOPIC_PREFIX = "prefix"
 
 class ModbusTests(unittest.TestCase):
     modbusRegister = namedtuple("modbusRegister", "registers")
+    modbusExceptionResponse = namedtuple(
+        "modbusExceptionResponse", "registers exception_code"
+    )
 
     def setUp(self):
         modbus_interface.DEFAULT_READ_BATCHING = 10
@@ -47,6 +56,16 @@ class ModbusTests(unittest.TestCase):
             registers=self.holding_registers.registers[address : address + count]
         )
 
+    def read_holding_registers_with_holes(self, address, count, device_id):
+        # Reads that touch an address in self.illegal_addresses fail the whole batch.
+        self.read_counts.append(count)
+        if any(address + i in self.illegal_addresses for i in range(count)):
+            return self.modbusExceptionResponse(
+                registers=[],
+                exception_code=modbus_interface.ILLEGAL_DATA_ADDRESS,
+            )
+        return self.read_holding_registers(address, count, device_id)
+
     def write_holding_register(self, address, value, device_id):
         self.holding_registers.registers[address] = value
 
@@ -103,6 +122,105 @@ class ModbusTests(unittest.TestCase):
         )
         self.assertRaises(ValueError, m.connect)
 
+    def test_serial(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusSerialClient") as mock_modbus:
+            m = modbus_interface.modbus_interface(
+                ip="/dev/ttyUSB0", variant="serial", baudrate=9600, parity="E"
+            )
+            m.connect()
+            mock_modbus.assert_called_with(
+                "/dev/ttyUSB0",
+                framer=modbus_interface.FramerType.RTU,
+                retries=3,
+                timeout=1,
+                baudrate=9600,
+                bytesize=8,
+                parity="E",
+                stopbits=1,
+            )
+            # Requests are at least 3.5 characters of 11 bits apart.
+            self.assertAlmostEqual(m._pacer.read_gap_s, 3.5 * 11 / 9600)
+            self.assertAlmostEqual(m._pacer.write_gap_s, 3.5 * 11 / 9600)
+
+            m = modbus_interface.modbus_interface(
+                ip="/dev/ttyUSB0", variant="ascii-over-serial"
+            )
+            m.connect()
+            self.assertEqual(
+                mock_modbus.call_args.kwargs["framer"],
+                modbus_interface.FramerType.ASCII,
+            )
+            # ASCII frames have their own delimiters.
+            self.assertEqual(m._pacer.read_gap_s, 0)
+
+        self.assertAlmostEqual(
+            modbus_interface.rtu_frame_gap(19200, 8, "N", 1), 3.5 * 10 / 19200
+        )
+        self.assertEqual(
+            modbus_interface.rtu_frame_gap(115200, 8, "N", 1),
+            modbus_interface.RTU_FIXED_FRAME_GAP_S,
+        )
+
+    def test_modbus_bus(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
+            mock_modbus().connect.side_effect = self.connect_success
+            reads = []
+            dead_units = set()
+            failing_reads = set()
+
+            def read_holding_registers(address, count, device_id):
+                reads.append((device_id, address))
+                if device_id in dead_units:
+                    raise ModbusIOException("No response received")
+                if (device_id, address) in failing_reads:
+                    return self.modbusExceptionResponse(registers=[], exception_code=4)
+                # Each device's registers hold their address plus 1000 times its unit.
+                return self.modbusRegister(
+                    registers=[device_id * 1000 + address + i for i in range(count)]
+                )
+
+            mock_modbus().read_holding_registers.side_effect = read_holding_registers
+            m = modbus_interface.ModbusBus(ip="1.1.1.1", read_batching=2)
+            for addr in range(6):
+                m.add_monitor_register("holding", addr)
+            m.add_monitor_register("holding", 0, unit=2)
+            m.add_monitor_register("holding", 1, unit=2)
+            m.add_monitor_register("holding", 5, unit=3)
+            m.connect()
+            m.poll()
+            self.assertEqual(m.get_value("holding", 4), 1004)
+            self.assertEqual(m.get_value("holding", 1, unit=2), 2001)
+            self.assertEqual(m.get_value("holding", 5, unit=3), 3005)
+            # The plans are interleaved, rather than one device after another.
+            self.assertEqual([unit for unit, _ in reads], [2, 3, 1, 1, 1])
+
+            # A device that doesn't answer is only asked once per poll.
+            reads.clear()
+            dead_units.add(1)
+            m.poll()
+            self.assertEqual([unit for unit, _ in reads].count(1), 1)
+            self.assertEqual(len(reads), 3)
+
+            # But one that answers with an exception still has its other reads made.
+            reads.clear()
+            dead_units.clear()
+            failing_reads.add((1, 0))
+            with self.assertLogs(level="ERROR"):
+                m.poll()
+            self.assertEqual(
+                sorted(address for unit, address in reads if unit == 1), [0, 2, 4]
+            )
+            failing_reads.clear()
+
+            # Writes go to the right device.
+            m.set_value("holding", 1, 7, unit=2)
+            mock_modbus().write_register.assert_called_with(
+                address=1, value=7, device_id=2
+            )
+            metrics = m.get_metrics()
+            self.assertIn("bus_utilisation", metrics)
+            self.assertIn(2, metrics["devices"])
+
     def test_connect(self):
         with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
             mock_modbus().connect.side_effect = self.connect_success
@@ -667,3 +785,623 @@ class ModbusTests(unittest.TestCase):
             self.assertEqual(m.get_value("holding", 1, "uint64"), 18446573203856197441)
             # Read the value out as a different type.
             self.assertEqual(m.get_value("holding", 1, "int64"), -170869853354175)
+
+    def test_illegal_address_bisection(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
+            mock_modbus().connect.side_effect = self.connect_success
+            mock_modbus().read_holding_registers.side_effect = (
+                self.read_holding_registers_with_holes
+            )
+            self.illegal_addresses = {13}
+            self.read_counts = []
+            with tempfile.TemporaryDirectory() as tmpdir:
+                state_file = os.path.join(tmpdir, "state.json")
+                with self.assertLogs() as mock_logger:
+                    m = modbus_interface.modbus_interface(
+                        "1.1.1.1", 111, read_batching=16, state_file=state_file
+                    )
+                    m.connect()
+                    for i in range(0, 16):
+                        m.add_monitor_register("holding", i)
+                    m.poll()
+                    self.assertIn(
+                        "Address 13 in table holding is not readable on this device.",
+                        mock_logger.output[-1],
+                    )
+
+                # Every readable address got a value despite the bad one.
+                for i in range(0, 16):
+                    if i == 13:
+                        continue
+                    self.assertEqual(m.get_value("holding", i), i)
+                self.assertRaises(ValueError, m.get_value, "holding", 13)
+                self.assertRaises(ValueError, m.get_value, "holding", 12, "uint32")
+
+                # Subsequent polls read around the bad address in big batches.
+                mock_modbus().read_holding_registers.reset_mock()
+                m.poll()
+                mock_modbus().read_holding_registers.assert_any_call(
+                    address=0, count=13, device_id=1
+                )
+                mock_modbus().read_holding_registers.assert_any_call(
+                    address=14, count=2, device_id=1
+                )
+                self.assertEqual(mock_modbus().read_holding_registers.call_count, 2)
+
+                with open(state_file) as f:
+                    self.assertEqual(
+                        json.load(f)["unreadable"], {"holding": [13], "input": []}
+                    )
+
+                # A new interface picks up the learned map without re-probing.
+                self.read_counts = []
+                m = modbus_interface.modbus_interface(
+                    "1.1.1.1", 111, read_batching=16, state_file=state_file
+                )
+                m.connect()
+                for i in range(0, 16):
+                    m.add_monitor_register("holding", i)
+                m.poll()
+                self.assertEqual(self.read_counts, [13, 2])
+
+    def test_block_boundary_bisection(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
+            mock_modbus().connect.side_effect = self.connect_success
+
+            def read_blocks(address, count, device_id):
+                # Every address is readable, but reads can't span address 50.
+                self.read_counts.append((address, count))
+                if address < 50 < address + count:
+                    return self.modbusExceptionResponse(
+                        registers=[],
+                        exception_code=modbus_interface.ILLEGAL_DATA_ADDRESS,
+                    )
+                return self.read_holding_registers(address, count, device_id)
+
+            mock_modbus().read_holding_registers.side_effect = read_blocks
+            self.read_counts = []
+            with tempfile.TemporaryDirectory() as tmpdir:
+                state_file = os.path.join(tmpdir, "state.json")
+                m = modbus_interface.modbus_interface(
+                    "1.1.1.1", 111, read_batching=20, state_file=state_file
+                )
+                m.connect()
+                for i in range(40, 60):
+                    m.add_monitor_register("holding", i)
+                with self.assertLogs() as mock_logger:
+                    m.poll()
+                self.assertEqual(self.read_counts, [(40, 20), (40, 10), (50, 10)])
+                self.assertIn(
+                    "Reads in table holding can't span address 50 on this device.",
+                    mock_logger.output[-1],
+                )
+                for i in range(40, 60):
+                    self.assertEqual(m.get_value("holding", i), i)
+
+                # The next poll splits at the boundary without bisecting again.
+                self.read_counts = []
+                m.poll()
+                self.assertEqual(self.read_counts, [(40, 10), (50, 10)])
+
+                with open(state_file) as f:
+                    state = json.load(f)
+                self.assertEqual(state["breaks"], {"holding": [50], "input": []})
+                self.assertEqual(state["unreadable"], {"holding": [], "input": []})
+
+                # A new interface picks up the boundary too.
+                self.read_counts = []
+                m = modbus_interface.modbus_interface(
+                    "1.1.1.1", 111, read_batching=20, state_file=state_file
+                )
+                m.connect()
+                for i in range(40, 60):
+                    m.add_monitor_register("holding", i)
+                m.poll()
+                self.assertEqual(self.read_counts, [(40, 10), (50, 10)])
+
+    def test_bisection_during_poll(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
+            mock_modbus().connect.side_effect = self.connect_success
+            mock_modbus().read_holding_registers.side_effect = (
+                self.read_holding_registers_with_holes
+            )
+            self.illegal_addresses = {3}
+            self.read_counts = []
+            m = modbus_interface.modbus_interface("1.1.1.1", 111, read_batching=10)
+            m.connect()
+            for i in range(0, 40):
+                m.add_monitor_register("holding", i)
+            with self.assertLogs():
+                m.poll()
+            # Learning the bad address mid-poll doesn't change the rest of the poll.
+            self.assertEqual(
+                [
+                    (c.kwargs["address"], c.kwargs["count"])
+                    for c in mock_modbus().read_holding_registers.call_args_list
+                    if c.kwargs["address"] >= 10
+                ],
+                [(10, 10), (20, 10), (30, 10)],
+            )
+            for i in range(0, 40):
+                if i != 3:
+                    self.assertEqual(m.get_value("holding", i), i)
+
+    def test_batch_tuner(self):
+        tuner = modbus_interface.BatchTuner(10, 2, 12, target_latency_s=0.5)
+        # Quick, full-sized batches grow by one register at a time.
+        self.assertTrue(tuner.success(10, 0.1))
+        self.assertEqual(tuner.size, 11)
+        # Smaller batches don't tell us anything about the limit.
+        self.assertFalse(tuner.success(3, 0.1))
+        self.assertEqual(tuner.size, 11)
+        tuner.success(11, 0.1)
+        tuner.success(12, 0.1)
+        self.assertEqual(tuner.size, 12)
+        # Slow reads, retries and failures cut the batch size.
+        tuner.success(12, 0.6)
+        self.assertEqual(tuner.size, 6)
+        tuner.success(6, 0.1, retries=1)
+        self.assertEqual(tuner.size, 3)
+        tuner.failure()
+        self.assertEqual(tuner.size, 2)
+        self.assertFalse(tuner.failure())
+
+    def test_reconnect_backoff(self):
+        jitter = [1.0]
+        backoff = modbus_interface.ReconnectBackoff(
+            1, 5, failure_threshold=5, open_interval_s=60, rng=lambda: jitter[0]
+        )
+        self.assertEqual(backoff.state, "closed")
+        self.assertTrue(backoff.ready(0))
+        # Each failure doubles the wait, up to the maximum.
+        self.assertEqual([backoff.failure(100) for _ in range(4)], [1.0, 2.0, 4.0, 5.0])
+        self.assertEqual(backoff.state, "backoff")
+        self.assertFalse(backoff.ready(104))
+        self.assertTrue(backoff.ready(105))
+        # Enough failures in a row open the circuit.
+        self.assertEqual(backoff.failure(100), 60)
+        self.assertEqual(backoff.state, "open")
+        # A failed trial keeps it open. Jitter takes up to half off the wait.
+        jitter[0] = 0
+        self.assertEqual(backoff.failure(200), 30)
+        self.assertEqual(backoff.state, "open")
+        backoff.success()
+        self.assertEqual(backoff.state, "closed")
+        self.assertTrue(backoff.ready(0))
+        self.assertEqual(backoff.failure(300), 0.5)
+
+    def test_request_pacer(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(delay):
+            sleeps.append(delay)
+            now[0] += delay
+
+        pacer = modbus_interface.RequestPacer(
+            0.05, 0.2, 1, clock=lambda: now[0], sleep=sleep
+        )
+        with pacer.request():
+            now[0] += 0.01
+        # Reads wait read_gap_s after the previous request finished.
+        with pacer.request():
+            pass
+        self.assertEqual(len(sleeps), 1)
+        self.assertAlmostEqual(sleeps[0], 0.05)
+        # A slow caller doesn't wait at all.
+        now[0] += 1
+        with pacer.request(write=True):
+            pass
+        self.assertEqual(len(sleeps), 1)
+        # Writes wait write_gap_s.
+        with pacer.request(write=True):
+            pass
+        self.assertAlmostEqual(sleeps[-1], 0.2)
+        # Write blocks start write_block_interval_s apart.
+        with pacer.write_block():
+            pass
+        now[0] += 0.25
+        with pacer.write_block():
+            pass
+        self.assertAlmostEqual(sleeps[-1], 0.75)
+        self.assertAlmostEqual(pacer.waited_s, 1.0)
+
+    def test_request_settings(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
+            mock_modbus().connect.side_effect = self.connect_success
+            mock_modbus().read_holding_registers.side_effect = (
+                self.read_holding_registers
+            )
+            m = modbus_interface.modbus_interface(
+                "1.1.1.1", 111, timeout=0.2, retries=0, read_gap=0.01
+            )
+            m.connect()
+            mock_modbus.assert_called_with(
+                host="1.1.1.1",
+                port=111,
+                framer=modbus_interface.FramerType.SOCKET,
+                retries=0,
+                timeout=0.2,
+            )
+            m.add_monitor_register("holding", 1)
+            m.add_monitor_register("holding", 3)
+            m.poll()
+            # The second read waited for the gap.
+            self.assertGreater(m.get_metrics()["pacing_wait_s"], 0)
+
+    def test_dead_link_detection(self):
+        # A real connection to a listener that hangs up straight away.
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        port = listener.getsockname()[1]
+        m = modbus_interface.modbus_interface(
+            "127.0.0.1", port, timeout=5, retries=0, tcp_keepalive=30
+        )
+        try:
+            m.connect()
+            sock = m._mb.socket
+            self.assertEqual(sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE), 1)
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                self.assertEqual(
+                    sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE), 30
+                )
+            m.add_monitor_register("holding", 1)
+            peer, _ = listener.accept()
+            peer.close()
+            # The close is found before the read, rather than after it times out.
+            start = time()
+            with self.assertRaises(ConnectionException):
+                m.poll()
+            self.assertLess(time() - start, 1)
+            self.assertFalse(m._mb.connected)
+        finally:
+            m.close()
+            listener.close()
+
+    def test_check_link(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
+            mock_modbus().connect.side_effect = self.connect_success
+            mock_modbus().read_holding_registers.side_effect = (
+                self.read_holding_registers
+            )
+            m = modbus_interface.modbus_interface("1.1.1.1", 111)
+            m.connect()
+            m.add_monitor_register("holding", 5)
+            m.add_monitor_register("holding", 6)
+            # The link hasn't been used yet, so it's checked.
+            self.assertTrue(m.check_link(10))
+            mock_modbus().read_holding_registers.assert_called_with(
+                address=5, count=1, device_id=1
+            )
+            mock_modbus().read_holding_registers.reset_mock()
+            # It's just been used, so it isn't.
+            self.assertFalse(m.check_link(10))
+            mock_modbus().read_holding_registers.assert_not_called()
+            # Failures are raised.
+            mock_modbus().read_holding_registers.side_effect = ModbusIOException(
+                "No response received"
+            )
+            with self.assertRaises(ModbusException):
+                m.check_link(0)
+
+    def test_auto_batching(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
+            mock_modbus().connect.side_effect = self.connect_success
+
+            # This device times out on reads of more than 8 registers.
+            def read_holding_registers(address, count, device_id):
+                if count > 8:
+                    raise ModbusIOException("No response received")
+                return self.read_holding_registers(address, count, device_id)
+
+            mock_modbus().read_holding_registers.side_effect = read_holding_registers
+            with tempfile.TemporaryDirectory() as tmpdir:
+                state_file = os.path.join(tmpdir, "state.json")
+                m = modbus_interface.modbus_interface(
+                    "1.1.1.1",
+                    111,
+                    read_batching=20,
+                    state_file=state_file,
+                    auto_batching=True,
+                    min_read_batching=4,
+                )
+                m.connect()
+                for i in range(0, 40):
+                    m.add_monitor_register("holding", i)
+                # Both 20 register batches time out, halving the batch size each time.
+                with self.assertLogs(level="ERROR"):
+                    m.poll()
+                self.assertEqual(m.get_metrics()["read_batching"]["holding"], 5)
+                # Now that reads succeed the batch size creeps back up.
+                for expected in [6, 7, 8]:
+                    m.poll()
+                    self.assertEqual(
+                        m.get_metrics()["read_batching"]["holding"], expected
+                    )
+                self.assertEqual(m.get_value("holding", 39), 39)
+                for _ in range(3):
+                    m.poll()
+                metrics = m.get_metrics()
+                self.assertLessEqual(metrics["read_batching"]["holding"], 9)
+                self.assertGreaterEqual(metrics["read_batching"]["holding"], 4)
+                self.assertEqual(metrics["read_batching"]["input"], 20)
+
+                # The tuned value survives a restart.
+                m._save_state()
+                tuned = metrics["read_batching"]["holding"]
+                m = modbus_interface.modbus_interface(
+                    "1.1.1.1",
+                    111,
+                    read_batching=20,
+                    state_file=state_file,
+                    auto_batching=True,
+                )
+                self.assertEqual(m.get_metrics()["read_batching"]["holding"], tuned)
+
+    def test_auto_batching_counts_retries(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
+            mock_modbus().connect.side_effect = self.connect_success
+
+            # Every read only gets through after a retry, though well within the
+            # target latency.
+            def read_holding_registers(address, count, device_id):
+                sleep(0.03)
+                return self.read_holding_registers(address, count, device_id)
+
+            mock_modbus().read_holding_registers.side_effect = read_holding_registers
+            m = modbus_interface.modbus_interface(
+                "1.1.1.1",
+                111,
+                read_batching=20,
+                auto_batching=True,
+                timeout=0.02,
+            )
+            m.connect()
+            for i in range(0, 20):
+                m.add_monitor_register("holding", i)
+            m.poll()
+            self.assertEqual(m.get_metrics()["read_batching"]["holding"], 10)
+
+    def test_read_times(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
+            mock_modbus().connect.side_effect = self.connect_success
+            mock_modbus().read_holding_registers.side_effect = (
+                self.read_holding_registers
+            )
+            m = modbus_interface.modbus_interface("1.1.1.1", 111, read_batching=2)
+            m.connect()
+            for i in range(0, 4):
+                m.add_monitor_register("holding", i)
+            self.assertIsNone(m.get_read_time("holding", 0))
+            before = time()
+            m.poll()
+            after = time()
+            first = m.get_read_time("holding", 0)
+            self.assertTrue(before <= first <= after)
+            self.assertEqual(m.get_read_time("holding", 1), first)
+            # A value spanning two batches takes the time of its oldest word.
+            second = m.get_read_time("holding", 2)
+            self.assertGreaterEqual(second, first)
+            self.assertEqual(m.get_read_time("holding", 1, "uint32"), first)
+
+    def test_refresh_value(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
+            mock_modbus().connect.side_effect = self.connect_success
+            mock_modbus().read_holding_registers.side_effect = (
+                self.read_holding_registers
+            )
+            m = modbus_interface.modbus_interface("1.1.1.1", 111)
+            m.connect()
+            for i in range(0, 10):
+                m.add_monitor_register("holding", i)
+            m.poll()
+            mock_modbus().read_holding_registers.reset_mock()
+            self.holding_registers.registers[3] = 1
+            self.holding_registers.registers[4] = 2
+            # Only the words of the one value are read.
+            self.assertEqual(m.refresh_value("holding", 3, "uint32"), 0x10002)
+            mock_modbus().read_holding_registers.assert_called_once_with(
+                address=3, count=2, device_id=1
+            )
+            self.assertEqual(m.get_value("holding", 4), 2)
+            self.assertIsNotNone(m.get_read_time("holding", 3, "uint32"))
+
+    def test_refresh_range(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
+            mock_modbus().connect.side_effect = self.connect_success
+            mock_modbus().read_holding_registers.side_effect = (
+                self.read_holding_registers
+            )
+            m = modbus_interface.modbus_interface("1.1.1.1", 111)
+            m.connect()
+            m.add_monitor_register("holding", 3)
+            m.add_monitor_register("holding", 5)
+            m.poll()
+            mock_modbus().read_holding_registers.reset_mock()
+            self.holding_registers.registers[3] = 7
+            self.holding_registers.registers[4] = 8
+            self.holding_registers.registers[5] = 9
+            self.assertEqual(m.refresh_range("holding", 3, 3), [7, 8, 9])
+            mock_modbus().read_holding_registers.assert_called_once_with(
+                address=3, count=3, device_id=1
+            )
+            # Only the monitored words are cached.
+            self.assertEqual(m.get_value("holding", 3), 7)
+            self.assertEqual(m.get_value("holding", 5), 9)
+            self.assertNotIn(4, m.get_tables()["holding"])
+
+    def test_merge_ranges(self):
+        merge = modbus_interface.merge_ranges
+        self.assertEqual(merge([], 100), [])
+        # Overlapping and touching ranges merge, in any order.
+        self.assertEqual(
+            merge([(10, 2), (0, 2), (2, 1), (11, 4)], 100), [(0, 3), (10, 5)]
+        )
+        self.assertEqual(merge([(0, 4), (1, 1)], 100), [(0, 4)])
+        # But not past the longest read.
+        self.assertEqual(merge([(0, 2), (2, 2), (4, 2)], 4), [(0, 4), (4, 2)])
+        # Nor with a range the device won't read.
+        self.assertEqual(
+            merge([(0, 2), (2, 2), (4, 2), (6, 1)], 100, {3}),
+            [(0, 2), (2, 2), (4, 3)],
+        )
+
+    def mask_write_register(self, address, and_mask, or_mask, device_id):
+        # The device merges the bits into its current value.
+        value = self.holding_registers.registers[address]
+        self.holding_registers.registers[address] = (value & and_mask) | (
+            or_mask & ~and_mask
+        )
+        return self.modbusRegister(registers=[])
+
+    def readwrite_registers(
+        self, read_address, read_count, write_address, values, device_id
+    ):
+        for i, value in enumerate(values):
+            self.holding_registers.registers[write_address + i] = value
+        return self.read_holding_registers(read_address, read_count, device_id)
+
+    def test_mask_write(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
+            mock_modbus().connect.side_effect = self.connect_success
+            mock_modbus().read_holding_registers.side_effect = (
+                self.read_holding_registers
+            )
+            mock_modbus().write_register.side_effect = self.write_holding_register
+            mock_modbus().mask_write_register.side_effect = self.mask_write_register
+
+            m = modbus_interface.modbus_interface("1.1.1.1", 111, mask_write=True)
+            m.connect()
+            self.holding_registers.registers[1] = 0
+            m.add_monitor_register("holding", 1)
+            m.poll()
+
+            # The device changes the register after our last read.
+            self.holding_registers.registers[1] = 0x0F00
+            m.set_value("holding", 1, 0x00FF, 0x00F0)
+            mock_modbus().mask_write_register.assert_called_once_with(
+                address=1, and_mask=0xFF0F, or_mask=0x00F0, device_id=1
+            )
+            mock_modbus().write_register.assert_not_called()
+            # Its change survives.
+            self.assertEqual(self.holding_registers.registers[1], 0x0FF0)
+
+            # Devices without FC22 get the old read-merge-write.
+            mock_modbus().mask_write_register.side_effect = None
+            mock_modbus().mask_write_register.return_value = (
+                self.modbusExceptionResponse(
+                    registers=[], exception_code=modbus_interface.ILLEGAL_FUNCTION
+                )
+            )
+            m.poll()
+            m.set_value("holding", 1, 0x0000, 0x0F00)
+            self.assertEqual(self.holding_registers.registers[1], 0x00F0)
+            m.set_value("holding", 1, 0xFFFF, 0x000F)
+            self.assertEqual(self.holding_registers.registers[1], 0x00FF)
+            # FC22 isn't tried again.
+            self.assertEqual(mock_modbus().mask_write_register.call_count, 2)
+
+    def test_read_write_multiple(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
+            mock_modbus().connect.side_effect = self.connect_success
+            mock_modbus().read_holding_registers.side_effect = (
+                self.read_holding_registers
+            )
+            mock_modbus().write_registers.side_effect = self.write_holding_registers
+            mock_modbus().readwrite_registers.side_effect = self.readwrite_registers
+
+            with tempfile.TemporaryDirectory() as tmp:
+                state_file = os.path.join(tmp, "state.json")
+                m = modbus_interface.modbus_interface(
+                    "1.1.1.1", 111, read_write_multiple=True, state_file=state_file
+                )
+                m.connect()
+                for i in range(0, 4):
+                    m.add_monitor_register("holding", i)
+                m.poll()
+                mock_modbus().read_holding_registers.reset_mock()
+
+                m.set_value("holding", 1, 0x50006, type="uint32")
+                mock_modbus().readwrite_registers.assert_called_once_with(
+                    read_address=1,
+                    read_count=2,
+                    write_address=1,
+                    values=[5, 6],
+                    device_id=1,
+                )
+                mock_modbus().write_registers.assert_not_called()
+                # The value was read back with the write, so verifying it is free.
+                self.assertEqual(m.refresh_value("holding", 1, "uint32"), 0x50006)
+                mock_modbus().read_holding_registers.assert_not_called()
+                # But only once.
+                m.refresh_value("holding", 1, "uint32")
+                mock_modbus().read_holding_registers.assert_called_once()
+                # And not once a poll has read something newer.
+                m.set_value("holding", 1, 0x70008, type="uint32")
+                m.poll()
+                mock_modbus().read_holding_registers.reset_mock()
+                m.refresh_value("holding", 1, "uint32")
+                mock_modbus().read_holding_registers.assert_called_once()
+
+                # Devices without FC23 get plain writes, and that's remembered.
+                mock_modbus().readwrite_registers.side_effect = None
+                mock_modbus().readwrite_registers.return_value = (
+                    self.modbusExceptionResponse(
+                        registers=[], exception_code=modbus_interface.ILLEGAL_FUNCTION
+                    )
+                )
+                m.set_value("holding", 1, 0x30004, type="uint32")
+                self.assertEqual(self.holding_registers.registers[1:3], [3, 4])
+                mock_modbus().write_registers.assert_called_once()
+                m = modbus_interface.modbus_interface(
+                    "1.1.1.1", 111, read_write_multiple=True, state_file=state_file
+                )
+                m.connect()
+                m.add_monitor_register("holding", 1)
+                m.set_value("holding", 1, 5)
+                self.assertEqual(mock_modbus().readwrite_registers.call_count, 3)
+
+    def test_write_during_poll_read(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
+            mock_modbus().connect.side_effect = self.connect_success
+            mock_modbus().write_register.side_effect = self.write_holding_register
+            m = modbus_interface.modbus_interface("1.1.1.1", 111)
+
+            # A write is planned while a poll's read of the same word is on the wire.
+            def read_holding_registers(address, count, device_id):
+                result = self.read_holding_registers(address, count, device_id)
+                m.set_value("holding", 1, 1234, flush=False)
+                return result
+
+            mock_modbus().read_holding_registers.side_effect = read_holding_registers
+            m.connect()
+            for i in range(0, 4):
+                m.add_monitor_register("holding", i)
+            m.poll()
+            # The read's older value didn't replace the one waiting to be written.
+            mock_modbus().write_register.assert_called_once_with(
+                address=1, value=1234, device_id=1
+            )
+            self.assertEqual(self.holding_registers.registers[1], 1234)
+
+    def test_coalesced_writes(self):
+        with patch("modbus4mqtt.modbus_interface.ModbusTcpClient") as mock_modbus:
+            mock_modbus().connect.side_effect = self.connect_success
+            mock_modbus().write_registers.side_effect = self.write_holding_registers
+            m = modbus_interface.modbus_interface("1.1.1.1", 111)
+            m.connect()
+            for i in range(10, 14):
+                m.add_monitor_register("holding", i)
+            m.set_value("holding", 10, 6, flush=False)
+            m.set_value("holding", 11, 30, flush=False)
+            m.set_value("holding", 13, 15, flush=False)
+            mock_modbus().write_registers.assert_not_called()
+            m.flush_writes()
+            # Neighbouring words share a request.
+            mock_modbus().write_registers.assert_called_once_with(
+                address=10, values=[6, 30], device_id=1
+            )
+            mock_modbus().write_register.assert_called_once_with(
+                address=13, value=15, device_id=1
+            )
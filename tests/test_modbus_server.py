@@ -1,6 +1,7 @@
 import json
 import pytest
 from modbus4mqtt.modbus4mqtt import mqtt_interface
+from modbus4mqtt import modbus_interface, probe, proxy
 import pytest_asyncio
 import random
 from time import monotonic, sleep
@@ -11,6 +12,7 @@ from paho.mqtt import client as mqtt_client
 from pymodbus import (
     ModbusDeviceIdentification,
 )
+from pymodbus.client import ModbusTcpClient
 from pymodbus.server import ModbusTcpServer
 from pymodbus.constants import ExcCodes
 from pymodbus.datastore import (
@@ -309,6 +311,82 @@ async def test_mqtt_write(
         assert False, "Timeout waiting for Modbus register to update"
 
 
+@pytest.mark.asyncio
+async def test_probe(modbus_fixture: ModbusServer):
+    # The test server has 100 holding registers, but the datastore's offset
+    # means only 0 to 98 can be read.
+    result = await asyncio.to_thread(
+        probe.probe, "127.0.0.1", 5020, 1, None, "holding", 0, 300, 2
+    )
+    assert result["blocks"] == [(0, 99)]
+    assert result["max_batch"] == 99
+    assert max(result["latency"].keys()) == 99
+    assert result["config"]["read_batching"] == 99
+    assert len(result["config"]["registers"]) == 99
+
+
+@pytest.mark.asyncio
+async def test_proxy(modbus_fixture: ModbusServer):
+    await modbus_fixture.set_holding_register(1, 1111)
+    await modbus_fixture.set_holding_register(50, 5050)
+    upstream = modbus_interface.modbus_interface("127.0.0.1", 5020)
+    upstream.add_monitor_register("holding", 1)
+    server = proxy.ProxyServer(upstream, 5021, max_age=60)
+    client = ModbusTcpClient("127.0.0.1", port=5021)
+
+    def start():
+        upstream.connect()
+        upstream.poll()
+        server.start()
+        client.connect()
+
+    def stop():
+        client.close()
+        server.stop()
+        upstream.close()
+
+    await asyncio.to_thread(start)
+    try:
+        await modbus_fixture.set_holding_register(1, 2222)
+        # Monitored registers are served from the last poll.
+        result = await asyncio.to_thread(client.read_holding_registers, 1)
+        assert result.registers == [1111]
+        # Anything else is read from the device.
+        result = await asyncio.to_thread(client.read_holding_registers, 50)
+        assert result.registers == [5050]
+        # Writes go straight through, and update the cache.
+        await asyncio.to_thread(client.write_register, 1, 3333)
+        assert await modbus_fixture.get_holding_register(1) == 3333
+        result = await asyncio.to_thread(client.read_holding_registers, 1)
+        assert result.registers == [3333]
+        # Mask writes are passed on as they are, so they don't undo changes the
+        # device made since the last poll.
+        await modbus_fixture.set_holding_register(1, 0x00F0)
+        await asyncio.to_thread(
+            client.mask_write_register, address=1, and_mask=0xFFFE, or_mask=0x0001
+        )
+        assert await modbus_fixture.get_holding_register(1) == 0x00F1
+        # Read/write multiples' reads go to the device too.
+        result = await asyncio.to_thread(
+            client.readwrite_registers,
+            read_address=1,
+            read_count=1,
+            write_address=50,
+            values=[6060],
+        )
+        assert await modbus_fixture.get_holding_register(50) == 6060
+        assert result.registers == [0x00F1]
+        # The write's response is read back from the cache too.
+        assert server.get_metrics() == {
+            "cached_reads": 3,
+            "forwarded_reads": 2,
+            "writes": 3,
+            "failures": 0,
+        }
+    finally:
+        await asyncio.to_thread(stop)
+
+
 if __name__ == "__main__":
     # Just run a modbus server
     modbus_server = ModbusServer()
@@ -1,3 +1,4 @@
+import random
 import pytest
 from modbus4mqtt.modbus_table import ModbusTable
 
@@ -81,3 +82,112 @@ def test_generate_batched_addresses_max_batch_write_mode():
     batches = table.get_batched_addresses(write_mode=True)
     # Should batch: [2] (start=2, len=1), [4] (start=4, len=1)
     assert batches == [(2, 1), (4, 1)]
+
+
+def test_generate_batched_addresses_skips_unreadable():
+    table = ModbusTable(10)
+    for addr in range(1, 9):
+        table.add_register(addr)
+    assert table.get_batched_addresses() == [(1, 8)]
+    table.mark_unreadable(4)
+    assert table.is_unreadable(4)
+    # The batches are re-planned around the unreadable address.
+    assert table.get_batched_addresses() == [(1, 3), (5, 4)]
+    # Unreadable addresses can still be written.
+    table.set_value(4, 123, write=True)
+    assert table.get_batched_addresses(write_mode=True) == [(4, 1)]
+
+
+def test_incremental_replan_matches_full_plan():
+    rng = random.Random(4)
+    table = ModbusTable(8)
+    for addr in rng.sample(range(200), 120):
+        table.add_register(addr)
+    table.get_batched_addresses()
+    for _ in range(300):
+        addr = rng.randrange(200)
+        if rng.random() < 0.1:
+            table.mark_unreadable(addr)
+        elif addr in table:
+            table.remove_register(addr)
+        else:
+            table.add_register(addr)
+        incremental = list(table.get_batched_addresses())
+        table.sort()
+        assert incremental == table._generate_batched_addresses()
+
+
+def test_breaks():
+    table = ModbusTable(8)
+    for addr in range(40, 60):
+        table.add_register(addr)
+    assert table.get_batched_addresses() == [(40, 8), (48, 8), (56, 4)]
+    table.mark_break(50)
+    assert table.get_breaks() == {50}
+    # Batches start again at a break, but writes aren't affected.
+    assert table.get_batched_addresses() == [(40, 8), (48, 2), (50, 8), (58, 2)]
+    table.set_value(49, 1, write=True)
+    table.set_value(50, 1, write=True)
+    assert table.get_batched_addresses(write_mode=True) == [(49, 2)]
+    rng = random.Random(7)
+    for _ in range(100):
+        addr = rng.randrange(30, 70)
+        if rng.random() < 0.2:
+            table.mark_break(addr)
+        elif addr in table:
+            table.remove_register(addr)
+        else:
+            table.add_register(addr)
+        incremental = list(table.get_batched_addresses())
+        table.sort()
+        assert incremental == table._generate_batched_addresses()
+
+
+def test_replan_leaves_returned_plan_alone():
+    table = ModbusTable(4)
+    for addr in range(12):
+        table.add_register(addr)
+    plan = table.get_batched_addresses()
+    table.mark_unreadable(1)
+    assert plan == [(0, 4), (4, 4), (8, 4)]
+    assert table.get_batched_addresses() == [(0, 1), (2, 4), (6, 4), (10, 2)]
+
+
+def test_reads_keep_pending_writes():
+    table = ModbusTable()
+    table.add_register(1)
+    table.add_register(2)
+    table.set_value(1, 5, write=True)
+    table.set_value(2, 6, write=True)
+    # A read doesn't replace a value that hasn't been written yet.
+    table.set_value(1, 0)
+    assert table.get_value(1) == 5
+    table.clear_changed_registers([1])
+    assert table.get_batched_addresses(write_mode=True) == [(2, 1)]
+    table.set_value(1, 0)
+    assert table.get_value(1) == 0
+
+
+def test_remove_register():
+    table = ModbusTable(2)
+    for addr in [1, 2, 3, 10, 11]:
+        table.add_register(addr)
+    assert table.get_batched_addresses() == [(1, 2), (3, 1), (10, 2)]
+    table.set_value(2, 5, write=True)
+    table.remove_register(2)
+    assert 2 not in table
+    assert table.get_batched_addresses() == [(1, 1), (3, 1), (10, 2)]
+    # Pending writes to a removed register are dropped.
+    assert table.get_batched_addresses(write_mode=True) == []
+    table.add_register(2)
+    assert table.get_batched_addresses() == [(1, 2), (3, 1), (10, 2)]
+
+
+def test_get_runs():
+    table = ModbusTable(read_batch_size=2)
+    for addr in [1, 2, 3, 7, 9, 10]:
+        table.add_register(addr)
+        table.set_value(addr, addr * 10)
+    # Runs aren't limited by the batch size.
+    assert table.get_runs() == [(1, 3), (7, 1), (9, 2)]
+    assert table.get_range(1, 3) == [10, 20, 30]
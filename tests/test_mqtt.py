@@ -1,9 +1,23 @@
 import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import monotonic
 import unittest
-from unittest.mock import patch, Mock
+import pytest
+import zlib
+from unittest.mock import call, patch, Mock
+import paho.mqtt.client
 from paho.mqtt.client import MQTTMessage
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.reasoncodes import ReasonCode
+from pymodbus import ModbusException
 
-from modbus4mqtt import modbus4mqtt
+from modbus4mqtt import modbus4mqtt, modbus_interface, shared_image
+from modbus4mqtt.modbus_table import ModbusTable
 
 from click.testing import CliRunner
 
@@ -52,11 +66,11 @@ class MQTTTests(unittest.TestCase):
 
     def connect_success(self):
         self.connect_attempts += 1
-        return False
+        return True
 
     def connect_failure(self):
         self.connect_attempts += 1
-        return True
+        return False
 
     def test_main(self):
         with patch("paho.mqtt.client.Client") as mock_mqtt:
@@ -176,6 +190,14 @@ class MQTTTests(unittest.TestCase):
                     MQTT_TOPIC_PREFIX + "/pub_on_change_absent", 17, retain=False
                 )
 
+                # snapshot_mode only matters with a snapshot_topic.
+                m.snapshot_mode = "all"
+                mock_mqtt().publish.reset_mock()
+                m.poll()
+                mock_mqtt().publish.assert_no_call(
+                    MQTT_TOPIC_PREFIX + "/pub_on_change_true", 16, retain=False
+                )
+
     def test_retain_flag(self):
         with patch("paho.mqtt.client.Client") as mock_mqtt:
             with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
@@ -309,6 +331,40 @@ class MQTTTests(unittest.TestCase):
                     MQTT_TOPIC_PREFIX + "/value_map_present", "b", retain=False
                 )
 
+    def test_unreadable_address(self):
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+
+                def read_modbus_register(table, address, type="uint16"):
+                    if address == 2:
+                        raise modbus_interface.UnreadableAddressError(
+                            "Address 2 in table holding is not readable."
+                        )
+                    return self.read_modbus_register(table, address, type)
+
+                mock_modbus().get_value.side_effect = read_modbus_register
+
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    "./tests/test_value_map.yaml",
+                    MQTT_TOPIC_PREFIX,
+                )
+                m.connect()
+                self.modbus_tables["holding"][1] = 1
+                self.modbus_tables["holding"][3] = 1
+                # The device already told us address 2 can't be read, so it's
+                # skipped quietly rather than warned about every poll.
+                with self.assertNoLogs(level="WARNING"):
+                    m.poll()
+                    m.poll()
+                mock_mqtt().publish.assert_any_call(
+                    MQTT_TOPIC_PREFIX + "/value_map_absent", 1, retain=False
+                )
+
     def test_set_topics(self):
         with patch("paho.mqtt.client.Client") as mock_mqtt:
             with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
@@ -403,6 +459,68 @@ class MQTTTests(unittest.TestCase):
                     )
                     self.assertEqual(self.modbus_tables["holding"][2], 1)
 
+    def perform_set_topic_subscription_test(self, config_file, expected_subscription):
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().set_value.side_effect = self.write_modbus_register
+                mock_mqtt().subscribe.return_value = (0, 1)
+                self.modbus_tables["holding"][1] = 1
+                self.modbus_tables["holding"][2] = 2
+
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    config_file,
+                    MQTT_TOPIC_PREFIX,
+                )
+                m.connect()
+                mock_mqtt().subscribe.reset_mock()
+
+                m._on_connect(None, None, None, reason_code=0, properties=None)
+                # A single subscription covers every set topic.
+                mock_mqtt().subscribe.assert_called_once_with(expected_subscription)
+                self.assertEqual(
+                    m.mqtt_connection_status,
+                    modbus4mqtt.MqttConnectionStatus.Subscribing,
+                )
+                m._on_subscribe(None, None, 1, [0], None)
+                self.assertEqual(
+                    m.mqtt_connection_status, modbus4mqtt.MqttConnectionStatus.Online
+                )
+
+                # Messages are dispatched to the right register through the topic index.
+                msg = MQTTMessage(
+                    topic=bytes(MQTT_TOPIC_PREFIX + "/value_map/set", "utf-8")
+                )
+                msg.payload = b"a"
+                m._on_message(None, None, msg)
+                self.assertEqual(self.modbus_tables["holding"][2], 1)
+                self.assertEqual(self.modbus_tables["holding"][1], 1)
+
+                # Anything else caught by a wildcard is ignored.
+                mock_modbus().set_value.reset_mock()
+                msg = MQTTMessage(
+                    topic=bytes(MQTT_TOPIC_PREFIX + "/no_value_map", "utf-8")
+                )
+                msg.payload = b"3"
+                m._on_message(None, None, msg)
+                mock_modbus().set_value.assert_not_called()
+
+    def test_set_topic_subscription(self):
+        self.perform_set_topic_subscription_test(
+            "./tests/test_set_topic_combined.yaml",
+            [
+                (MQTT_TOPIC_PREFIX + "/no_value_map/set", 0),
+                (MQTT_TOPIC_PREFIX + "/value_map/set", 0),
+            ],
+        )
+        self.perform_set_topic_subscription_test(
+            "./tests/test_set_topic_wildcard.yaml", MQTT_TOPIC_PREFIX + "/#"
+        )
+
     def test_scale(self):
         with patch("paho.mqtt.client.Client") as mock_mqtt:
             with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
@@ -650,8 +768,1094 @@ class MQTTTests(unittest.TestCase):
                 m._on_message(None, None, msg)
                 self.assertEqual(self.modbus_tables["holding"][0], 65533)
 
+    def test_metrics(self):
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+                mock_modbus().get_metrics.return_value = {
+                    "read_batching": {"holding": 50, "input": 100}
+                }
+
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    "./tests/test_metrics.yaml",
+                    MQTT_TOPIC_PREFIX,
+                )
+                m.connect()
+                self.modbus_tables["holding"][1] = 1
+                m.poll()
+
+                metrics_calls = [
+                    call
+                    for call in mock_mqtt().publish.call_args_list
+                    if call.args[0] == MQTT_TOPIC_PREFIX + "/modbus4mqtt/metrics"
+                ]
+                self.assertEqual(len(metrics_calls), 1)
+                payload = json.loads(metrics_calls[0].args[1])
+                self.assertEqual(payload["read_batching"]["holding"], 50)
+                self.assertIn("timestamp", payload)
+
+                # Metrics are rate limited by metrics_interval.
+                mock_mqtt().publish.reset_mock()
+                m.poll()
+                mock_mqtt().publish.assert_no_call(
+                    MQTT_TOPIC_PREFIX + "/modbus4mqtt/metrics"
+                )
+
+    def test_reload(self):
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+                mock_modbus().get_tables.return_value = {"holding": {}, "input": {}}
+                with tempfile.TemporaryDirectory() as directory:
+                    config_file = os.path.join(directory, "config.yaml")
+                    shutil.copy("./tests/test_reload.yaml", config_file)
+                    m = modbus4mqtt.mqtt_interface(
+                        "kroopit",
+                        1885,
+                        "brengis",
+                        "pranto",
+                        config_file,
+                        MQTT_TOPIC_PREFIX,
+                    )
+                    m.connect()
+                    for address in range(1, 6):
+                        self.modbus_tables["holding"][address] = address
+                    m.poll()
+                    mock_mqtt().publish.reset_mock()
+                    mock_modbus().add_monitor_register.reset_mock()
+
+                    with open(config_file, "w") as f:
+                        f.write(
+                            "ip: 192.168.1.91\n"
+                            "update_rate: 1\n"
+                            "remote_reload: true\n"
+                            "registers:\n"
+                            "  - pub_topic: unchanged\n"
+                            "    address: 1\n"
+                            "  - pub_topic: changed\n"
+                            "    address: 3\n"
+                            "    scale: 2\n"
+                            "  - pub_topic: added\n"
+                            "    set_topic: added/set\n"
+                            "    address: 4\n"
+                            "    type: uint32\n"
+                        )
+                    self.assertTrue(m.reload_config())
+
+                    # Settings baked into the modbus connection are kept.
+                    self.assertEqual(m.config["ip"], "192.168.1.90")
+                    self.assertEqual(m.config["port"], 502)
+                    # Only the words that changed touch the read plan.
+                    mock_modbus().remove_monitor_register.assert_called_once_with(
+                        "holding", 2
+                    )
+                    self.assertEqual(
+                        mock_modbus().add_monitor_register.call_args_list,
+                        [(("holding", 4),), (("holding", 5),)],
+                    )
+                    mock_mqtt().unsubscribe.assert_called_with(
+                        [MQTT_TOPIC_PREFIX + "/removed/set"]
+                    )
+                    mock_mqtt().subscribe.assert_called_with(
+                        MQTT_TOPIC_PREFIX + "/added/set"
+                    )
+                    mock_mqtt().connect.assert_called_once()
+
+                    # Unchanged registers keep their last value, so aren't republished.
+                    m.poll()
+                    mock_mqtt().publish.assert_no_call(
+                        MQTT_TOPIC_PREFIX + "/unchanged", 1, retain=False
+                    )
+                    mock_mqtt().publish.assert_any_call(
+                        MQTT_TOPIC_PREFIX + "/changed", 6, retain=False
+                    )
+                    mock_mqtt().publish.assert_any_call(
+                        MQTT_TOPIC_PREFIX + "/added", 5 << 16 | 4, retain=False
+                    )
+
+                    # A bad config is rejected and the running one is kept.
+                    with open(config_file, "w") as f:
+                        f.write(
+                            "ip: 192.168.1.90\n"
+                            "update_rate: 1\n"
+                            "set_topic_subscription: bogus\n"
+                            "registers: []\n"
+                        )
+                    self.assertFalse(m.reload_config())
+                    self.assertEqual(len(m.registers), 3)
+
+                    # The reload topic asks the main loop to reload.
+                    msg = MQTTMessage(
+                        topic=bytes(MQTT_TOPIC_PREFIX + "/modbus4mqtt/reload", "utf-8")
+                    )
+                    m._on_message(None, None, msg)
+                    self.assertTrue(m._reload_requested)
+                    self.assertTrue(m._wake.is_set())
+
+    def test_spool(self):
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+                with tempfile.TemporaryDirectory() as directory:
+                    config_file = os.path.join(directory, "config.yaml")
+                    with open(config_file, "w") as f:
+                        f.write(
+                            "ip: 192.168.1.90\n"
+                            "update_rate: 1\n"
+                            "spool_dir: {}\n"
+                            "spool_replay_rate: 1000\n"
+                            "registers:\n"
+                            "  - pub_topic: plain\n"
+                            "    address: 1\n"
+                            "    retain: true\n"
+                            "  - pub_topic: grouped\n"
+                            "    address: 2\n"
+                            "    json_key: a\n".format(os.path.join(directory, "spool"))
+                        )
+                    m = modbus4mqtt.mqtt_interface(
+                        "kroopit",
+                        1885,
+                        "brengis",
+                        "pranto",
+                        config_file,
+                        MQTT_TOPIC_PREFIX,
+                    )
+                    m.connect()
+
+                    # Values read while MQTT is offline go to the spool.
+                    mock_mqtt().is_connected.return_value = False
+                    for value in range(1, 4):
+                        self.modbus_tables["holding"][1] = value
+                        self.modbus_tables["holding"][2] = value * 10
+                        m.poll()
+                    mock_mqtt().publish.assert_no_call(
+                        MQTT_TOPIC_PREFIX + "/plain", 3, retain=True
+                    )
+                    self.assertEqual(len(m._spool), 6)
+                    m._replay_spool()
+                    self.assertEqual(len(m._spool), 6)
+
+                    # Once MQTT is back they're replayed in order, unretained and
+                    # with the time they were captured.
+                    mock_mqtt().is_connected.return_value = True
+                    mock_mqtt().publish.reset_mock()
+                    m._replayed_at -= 1
+                    m._replay_spool()
+                    self.assertEqual(len(m._spool), 0)
+                    replayed = mock_mqtt().publish.call_args_list
+                    self.assertEqual(len(replayed), 6)
+                    self.assertEqual(replayed[0].args[0], MQTT_TOPIC_PREFIX + "/plain")
+                    self.assertEqual(replayed[0].kwargs, {"retain": False})
+                    payload = json.loads(replayed[0].args[1])
+                    self.assertEqual(payload["value"], 1)
+                    self.assertIn("timestamp", payload)
+                    payload = json.loads(replayed[5].args[1])
+                    self.assertEqual(payload["a"], 30)
+                    self.assertIn("timestamp", payload)
+                    m.stop()
+
+    def test_publish_timestamps(self):
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+                read_times = {1: 1700000000.25, 2: 1700000001.5, 3: 1700000000.125}
+                mock_modbus().get_read_time.side_effect = (
+                    lambda table, address, type: read_times[address]
+                )
+
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    "./tests/test_timestamps.yaml",
+                    MQTT_TOPIC_PREFIX,
+                )
+                m.connect()
+                self.modbus_tables["holding"][1] = 1
+                self.modbus_tables["holding"][2] = 2
+                self.modbus_tables["holding"][3] = 3
+                m.poll()
+
+                published = {
+                    call.args[0]: json.loads(call.args[1])
+                    for call in mock_mqtt().publish.call_args_list
+                }
+                plain = published[MQTT_TOPIC_PREFIX + "/plain"]
+                self.assertEqual(plain["value"], 1)
+                self.assertEqual(
+                    plain["timestamp"],
+                    modbus4mqtt._format_read_time(1700000000.25),
+                )
+                self.assertIn(".250", plain["timestamp"])
+                grouped = published[MQTT_TOPIC_PREFIX + "/grouped"]
+                self.assertEqual(grouped["a"], 2)
+                self.assertEqual(grouped["b"], 3)
+                # JSON messages carry the time of their oldest value.
+                self.assertEqual(
+                    grouped["timestamp"],
+                    modbus4mqtt._format_read_time(1700000000.125),
+                )
+
+    def perform_snapshot_test(self, config_file, decode):
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    config_file,
+                    MQTT_TOPIC_PREFIX,
+                )
+                m.connect()
+                snapshots = []
+                for value in [1, 1, 2]:
+                    self.modbus_tables["holding"][1] = value
+                    self.modbus_tables["holding"][2] = 20
+                    self.modbus_tables["holding"][3] = 30
+                    mock_mqtt().publish.reset_mock()
+                    m.poll()
+                    calls = mock_mqtt().publish.call_args_list
+                    # Nothing is published to the individual topics.
+                    topics = {call.args[0] for call in calls}
+                    self.assertNotIn(MQTT_TOPIC_PREFIX + "/plain", topics)
+                    self.assertNotIn(MQTT_TOPIC_PREFIX + "/grouped", topics)
+                    snapshots.append(
+                        [
+                            (decode(call.args[1]), call.kwargs["retain"])
+                            for call in calls
+                            if call.args[0] == MQTT_TOPIC_PREFIX + "/snapshot"
+                        ]
+                    )
+                return snapshots
+
+    def test_snapshot(self):
+        snapshots = self.perform_snapshot_test(
+            "./tests/test_snapshot.yaml", lambda payload: json.loads(payload)
+        )
+        ((first, retain),) = snapshots[0]
+        self.assertFalse(retain)
+        self.assertEqual(first["values"], {"plain": 1, "grouped": {"a": 20, "b": 30}})
+        self.assertIn("timestamp", first)
+        # Nothing changed, so there's nothing to publish.
+        self.assertEqual(snapshots[1], [])
+        ((third, _),) = snapshots[2]
+        self.assertEqual(third["values"], {"plain": 2})
+
+    def test_snapshot_all_compressed(self):
+        snapshots = self.perform_snapshot_test(
+            "./tests/test_snapshot_all.yaml",
+            lambda payload: json.loads(zlib.decompress(payload)),
+        )
+        for snapshot, value in zip(snapshots, [1, 1, 2]):
+            ((document, retain),) = snapshot
+            self.assertTrue(retain)
+            self.assertEqual(
+                document["values"], {"plain": value, "grouped": {"a": 20, "b": 30}}
+            )
+
+    def test_mqtt5(self):
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    "./tests/test_mqtt5.yaml",
+                    MQTT_TOPIC_PREFIX,
+                    mqtt_version="5",
+                )
+                m.connect()
+                mock_mqtt.assert_called_with(
+                    paho.mqtt.client.CallbackAPIVersion.VERSION2,
+                    protocol=paho.mqtt.client.MQTTv5,
+                )
+                # This broker allows two topic aliases.
+                properties = Properties(PacketTypes.CONNACK)
+                properties.TopicAliasMaximum = 2
+                m._on_connect(None, None, None, reason_code=0, properties=properties)
+                for address in range(1, 4):
+                    self.modbus_tables["holding"][address] = address
+
+                def published():
+                    calls = [
+                        call
+                        for call in mock_mqtt().publish.call_args_list
+                        if "properties" in call.kwargs
+                    ]
+                    mock_mqtt().publish.reset_mock()
+                    return [
+                        (
+                            call.args[0],
+                            getattr(call.kwargs["properties"], "TopicAlias", None),
+                            call.kwargs["properties"].MessageExpiryInterval,
+                        )
+                        for call in calls
+                    ]
+
+                a = MQTT_TOPIC_PREFIX + "/a"
+                b = MQTT_TOPIC_PREFIX + "/b"
+                c = MQTT_TOPIC_PREFIX + "/c"
+                mock_mqtt().publish.reset_mock()
+                m.poll()
+                # Topics are sent in full the first time.
+                self.assertEqual(
+                    published(), [(a, None, 30), (b, None, 30), (c, None, 30)]
+                )
+                m.poll()
+                # Repeated topics are given an alias, while there are aliases left.
+                self.assertEqual(published(), [(a, 1, 30), (b, 2, 30), (c, None, 30)])
+                m.poll()
+                self.assertEqual(published(), [("", 1, 30), ("", 2, 30), (c, None, 30)])
+
+                # Aliases are forgotten when reconnecting.
+                m._on_connect(None, None, None, reason_code=0, properties=properties)
+                m.poll()
+                self.assertEqual(
+                    published(), [(a, None, 30), (b, None, 30), (c, None, 30)]
+                )
+
+    def test_publish_window(self):
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+                mock_modbus().get_metrics.return_value = {}
+                sent = []
+
+                def publish(topic, payload, qos=0, retain=False):
+                    info = paho.mqtt.client.MQTTMessageInfo(len(sent))
+                    info.rc = paho.mqtt.client.MQTT_ERR_SUCCESS
+                    sent.append((topic, payload, qos, info))
+                    return info
+
+                mock_mqtt().publish.side_effect = publish
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    "./tests/test_publish_window.yaml",
+                    MQTT_TOPIC_PREFIX,
+                )
+                m.connect()
+                mock_mqtt().max_inflight_messages_set.assert_called_with(2)
+                mock_mqtt().max_queued_messages_set.assert_called_with(2)
+
+                def telemetry():
+                    return [
+                        (topic[len(MQTT_TOPIC_PREFIX) + 1 :], payload, qos)
+                        for topic, payload, qos, _ in sent
+                        if "/modbus4mqtt/" not in topic
+                    ]
+
+                def metrics():
+                    return json.loads(
+                        [p for t, p, _, _ in sent if t.endswith("/metrics")][-1]
+                    )["mqtt_queue"]
+
+                for address in range(1, 6):
+                    self.modbus_tables["holding"][address] = address
+                m.poll()
+                # Only two messages can be in flight. The rest wait.
+                self.assertEqual(telemetry(), [("a", 1, 1), ("b", 2, 0)])
+                self.assertEqual(
+                    metrics(),
+                    {"depth": 2, "in_flight": 2, "dropped": 0, "blocked_s": 0},
+                )
+
+                # A newer value replaces a queued one for the same topic.
+                self.modbus_tables["holding"][3] = 30
+                m.poll()
+                self.assertEqual(metrics()["dropped"], 1)
+                self.assertEqual(metrics()["depth"], 2)
+
+                # Once the broker catches up, the queue drains in order. A JSON
+                # message takes the highest QoS of its values.
+                for _, _, _, info in sent:
+                    info._set_as_published()
+                m._pump_publish_queue()
+                self.assertEqual(
+                    telemetry()[2:], [("d", '{"x": 4, "y": 5}', 2), ("c", 30, 0)]
+                )
+
+                # With the block policy, a full queue holds up polling, unless MQTT
+                # is disconnected, when the oldest message is dropped instead.
+                m.publish_overload = "block"
+                mock_mqtt().is_connected.return_value = False
+                for address in range(1, 6):
+                    self.modbus_tables["holding"][address] += 100
+                m.poll()
+                self.assertEqual(metrics()["depth"], 2)
+                # Four messages, with room for two.
+                self.assertEqual(metrics()["dropped"], 3)
+
+    def test_seed_from_retained(self):
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    "./tests/test_seed.yaml",
+                    MQTT_TOPIC_PREFIX,
+                )
+                # The broker holds these from before the restart. There's nothing
+                # retained on c.
+                retained = {"a": b"1", "b": b"off", "d": b'{"x": 4, "y": 50}'}
+
+                def subscribe(topic_filters):
+                    for topic, payload in retained.items():
+                        msg = paho.mqtt.client.MQTTMessage(
+                            topic=bytes(MQTT_TOPIC_PREFIX + "/" + topic, "utf-8")
+                        )
+                        msg.payload = payload
+                        msg.retain = True
+                        m._on_message(None, None, msg)
+                    return (paho.mqtt.client.MQTT_ERR_SUCCESS, 1)
+
+                mock_mqtt().subscribe.side_effect = subscribe
+                m.connect()
+                # Only the retained topics are subscribed to, and only while seeding.
+                filters = [MQTT_TOPIC_PREFIX + "/" + topic for topic in "abcd"]
+                mock_mqtt().subscribe.assert_called_once_with(
+                    [(topic_filter, 0) for topic_filter in filters]
+                )
+                mock_mqtt().unsubscribe.assert_called_once_with(filters)
+
+                for address in range(1, 7):
+                    self.modbus_tables["holding"][address] = address
+                self.modbus_tables["holding"][2] = 1
+                mock_mqtt().publish.reset_mock()
+                start = monotonic()
+                m.poll()
+                # Four messages at 20 per second.
+                self.assertGreaterEqual(monotonic() - start, 0.15)
+                published = [
+                    call.args[:2]
+                    for call in mock_mqtt().publish.call_args_list
+                    if "/modbus4mqtt/" not in call.args[0]
+                ]
+                # a already holds the latest value, so isn't published again.
+                self.assertEqual(
+                    published,
+                    [
+                        (MQTT_TOPIC_PREFIX + "/b", "on"),
+                        (MQTT_TOPIC_PREFIX + "/c", 3),
+                        (MQTT_TOPIC_PREFIX + "/d", '{"y": 5}'),
+                        (MQTT_TOPIC_PREFIX + "/e", 6),
+                    ],
+                )
+
+                # Later polls aren't paced.
+                for address in range(1, 7):
+                    self.modbus_tables["holding"][address] += 10
+                start = monotonic()
+                m.poll()
+                self.assertLess(monotonic() - start, 0.15)
+
+    def test_write_feedback(self):
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+                mock_modbus().set_value.side_effect = self.write_modbus_register
+                mock_modbus().refresh_value.side_effect = self.read_modbus_register
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    "./tests/test_write_feedback.yaml",
+                    MQTT_TOPIC_PREFIX,
+                )
+                m.connect()
+                self.modbus_tables["holding"][1] = 0
+                self.modbus_tables["holding"][2] = 100
+                m.poll()
+
+                def events():
+                    result = [
+                        json.loads(call.args[1])
+                        for call in mock_mqtt().publish.call_args_list
+                        if call.args[0] == MQTT_TOPIC_PREFIX + "/modbus4mqtt/writes"
+                    ]
+                    for event in result:
+                        del event["timestamp"]
+                    return result
+
+                def set(topic, payload):
+                    msg = MQTTMessage(
+                        topic=bytes(MQTT_TOPIC_PREFIX + "/" + topic, "utf-8")
+                    )
+                    msg.payload = payload
+                    m._on_message(None, None, msg)
+
+                mock_mqtt().publish.reset_mock()
+                set("mode/set", b"on")
+                # The write is reported straight away, but not yet on the pub topic.
+                self.assertEqual(
+                    events(),
+                    [{"set_topic": "mode/set", "state": "pending", "value": "on"}],
+                )
+                mock_modbus().refresh_value.assert_not_called()
+                mock_mqtt().publish.reset_mock()
+                m._process_read_backs()
+                # Only the written register is read back.
+                mock_modbus().refresh_value.assert_called_once_with(
+                    "holding", 1, "uint16"
+                )
+                self.assertEqual(
+                    events(),
+                    [{"set_topic": "mode/set", "state": "confirmed", "value": "on"}],
+                )
+                mock_mqtt().publish.assert_any_call(
+                    MQTT_TOPIC_PREFIX + "/mode", "on", retain=False
+                )
+
+                # The device doesn't take the new value.
+                mock_modbus().set_value.side_effect = None
+                set("power/set", b"12.5")
+                mock_mqtt().publish.reset_mock()
+                m._process_read_backs()
+                self.assertEqual(
+                    events(),
+                    [
+                        {
+                            "set_topic": "power/set",
+                            "state": "mismatch",
+                            "value": 10.0,
+                            "expected": 12.5,
+                        }
+                    ],
+                )
+
+    def test_get_topics(self):
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+                mock_modbus().get_tables.return_value = {
+                    "holding": ModbusTable(),
+                    "input": ModbusTable(),
+                }
+                mock_mqtt().subscribe.return_value = (0, 1)
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    "./tests/test_get_topics.yaml",
+                    MQTT_TOPIC_PREFIX,
+                )
+                m.connect()
+                self.modbus_tables["holding"][1] = 1
+                self.modbus_tables["holding"][2] = 2
+                self.modbus_tables["holding"][3] = 3
+                self.modbus_tables["input"][40] = 4
+                m.poll()
+
+                # Every get topic is subscribed to in one SUBSCRIBE packet.
+                m._on_connect(None, None, None, reason_code=0, properties=None)
+                mock_mqtt().subscribe.assert_any_call(
+                    [
+                        (MQTT_TOPIC_PREFIX + "/a/get", 0),
+                        (MQTT_TOPIC_PREFIX + "/b/get", 0),
+                        (MQTT_TOPIC_PREFIX + "/c/get", 0),
+                        (MQTT_TOPIC_PREFIX + "/modbus4mqtt/get", 0),
+                    ]
+                )
+
+                def get(topic, payload=b""):
+                    msg = MQTTMessage(
+                        topic=bytes(MQTT_TOPIC_PREFIX + "/" + topic, "utf-8")
+                    )
+                    msg.payload = payload
+                    m._on_message(None, None, msg)
+
+                mock_mqtt().publish.reset_mock()
+                get("a/get")
+                get("modbus4mqtt/get", b'["b", "nope"]')
+                # Nothing is read until the window has passed.
+                self.assertGreater(m._get_window_remaining(), 0)
+                m._process_get_requests(monotonic() + 60)
+                mock_modbus().refresh_range.assert_not_called()
+                m.get_window = 0
+                # A poll that's about to happen serves the requests itself.
+                m._process_get_requests(monotonic())
+                mock_modbus().refresh_range.assert_not_called()
+
+                m._process_get_requests(monotonic() + 60)
+                # The overlapping words of a and b are read together.
+                mock_modbus().refresh_range.assert_called_once_with("holding", 1, 3)
+                # The values haven't changed, but are published because they were
+                # asked for.
+                mock_mqtt().publish.assert_any_call(
+                    MQTT_TOPIC_PREFIX + "/a", 0x20001, retain=False
+                )
+                mock_mqtt().publish.assert_any_call(
+                    MQTT_TOPIC_PREFIX + "/b", 3, retain=False
+                )
+                self.assertEqual(mock_mqtt().publish.call_count, 2)
+                self.assertIsNone(m._get_window_remaining())
+
+                # Reads are merged no further than the table's read batching, and
+                # registers whose read failed aren't published.
+                mock_modbus().get_tables()["holding"].set_read_batch_size(2)
+                mock_modbus().refresh_range.reset_mock()
+                mock_mqtt().publish.reset_mock()
+
+                def refresh_range(table, start, count):
+                    if start == 3:
+                        raise ModbusException("Timed out")
+
+                mock_modbus().refresh_range.side_effect = refresh_range
+                get("modbus4mqtt/get", b'["a", "b"]')
+                with self.assertLogs() as mock_logger:
+                    m._process_get_requests(monotonic() + 60)
+                self.assertIn("Timed out", mock_logger.output[0])
+                self.assertEqual(
+                    mock_modbus().refresh_range.call_args_list,
+                    [call("holding", 1, 2), call("holding", 3, 1)],
+                )
+                mock_mqtt().publish.assert_called_once_with(
+                    MQTT_TOPIC_PREFIX + "/a", 0x20001, retain=False
+                )
+                mock_modbus().refresh_range.side_effect = None
+
+                # Requests still pending at the next poll are served by it.
+                mock_modbus().refresh_range.reset_mock()
+                mock_mqtt().publish.reset_mock()
+                get("c/get")
+                get("modbus4mqtt/get", b"not json")
+                m.poll()
+                mock_modbus().refresh_range.assert_not_called()
+                mock_mqtt().publish.assert_called_once_with(
+                    MQTT_TOPIC_PREFIX + "/c", 4, retain=False
+                )
+                self.assertIsNone(m._get_window_remaining())
+
+    def test_json_set_topic(self):
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    "./tests/test_json_set.yaml",
+                    MQTT_TOPIC_PREFIX,
+                )
+                m.connect()
+                # It's subscribed to once, like any other set topic.
+                m._on_connect(None, None, None, reason_code=0, properties=None)
+                mock_mqtt().subscribe.assert_called_once_with(
+                    MQTT_TOPIC_PREFIX + "/schedule/set"
+                )
+
+                def set(payload):
+                    msg = MQTTMessage(
+                        topic=bytes(MQTT_TOPIC_PREFIX + "/schedule/set", "utf-8")
+                    )
+                    msg.payload = payload
+                    mock_modbus().set_value.reset_mock()
+                    mock_modbus().flush_writes.reset_mock()
+                    m._on_message(None, None, msg)
+
+                set(b'{"hours": 6, "minutes": 30, "mode": "on", "power": 1.5}')
+                # The fields are planned together, then written in one go.
+                self.assertEqual(
+                    mock_modbus().set_value.call_args_list,
+                    [
+                        call("holding", 10, 6, 0xFFFF, "uint16", flush=False),
+                        call("holding", 11, 30, 0xFFFF, "uint16", flush=False),
+                        call("holding", 12, 1, 0xFFFF, "uint16", flush=False),
+                        call("holding", 13, 15, 0xFFFF, "uint16", flush=False),
+                    ],
+                )
+                mock_modbus().flush_writes.assert_called_once()
+                # The write lock is held from the first field through the flush.
+                self.assertEqual(
+                    [
+                        name
+                        for name, _, _ in mock_modbus().mock_calls
+                        if name
+                        in (
+                            "write_lock().__enter__",
+                            "set_value",
+                            "flush_writes",
+                            "write_lock().__exit__",
+                        )
+                    ],
+                    [
+                        "write_lock().__enter__",
+                        "set_value",
+                        "set_value",
+                        "set_value",
+                        "set_value",
+                        "flush_writes",
+                        "write_lock().__exit__",
+                    ],
+                )
+
+                # Only the fields present are written. Bad ones are skipped.
+                set(b'{"minutes": 45, "mode": "maybe", "other": 1}')
+                self.assertEqual(
+                    mock_modbus().set_value.call_args_list,
+                    [call("holding", 11, 45, 0xFFFF, "uint16", flush=False)],
+                )
+
+                for payload in [b"45", b"not json", b"\xff"]:
+                    set(payload)
+                    mock_modbus().set_value.assert_not_called()
+
+    def test_multi_drop(self):
+        with patch("paho.mqtt.client.Client"):
+            with patch("modbus4mqtt.modbus_interface.ModbusBus") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    "./tests/test_multi_drop.yaml",
+                    MQTT_TOPIC_PREFIX,
+                )
+                m.connect()
+                self.assertEqual(mock_modbus.call_args.kwargs["ip"], "/dev/ttyUSB0")
+                self.assertEqual(mock_modbus.call_args.kwargs["variant"], "serial")
+                self.assertEqual(mock_modbus.call_args.kwargs["baudrate"], 9600)
+                # Registers with a device_address are read from that device.
+                mock_modbus().add_monitor_register.assert_any_call(
+                    "holding", 10, "uint16"
+                )
+                mock_modbus().add_monitor_register.assert_any_call(
+                    "holding", 20, "int32", unit=2
+                )
+                m.poll()
+                mock_modbus().get_value.assert_any_call("holding", 20, "int32", unit=2)
+
+                # And written to it.
+                msg = MQTTMessage(
+                    topic=bytes(MQTT_TOPIC_PREFIX + "/heatpump/setpoint/set", "utf-8")
+                )
+                msg.payload = b"21"
+                m._on_message(None, None, msg)
+                mock_modbus().set_value.assert_called_with(
+                    "holding", 20, 21, 0xFFFF, "int32", unit=2
+                )
+
+    def test_local_api(self):
+        with patch("paho.mqtt.client.Client"):
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+                mock_modbus().get_read_time.return_value = 100.0
+                self.modbus_tables["holding"][1] = 1
+                self.modbus_tables["holding"][2] = 6
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    "./tests/test_local_api.yaml",
+                    MQTT_TOPIC_PREFIX,
+                )
+                m.connect()
+                try:
+                    m.poll()
+                    # Values are decoded, as they're published.
+                    self.assertEqual(
+                        m._api.store.get()["values"],
+                        [
+                            {
+                                "topic": "mode",
+                                "json_key": None,
+                                "value": "on",
+                                "timestamp": 100.0,
+                            },
+                            {
+                                "topic": "schedule",
+                                "json_key": "hours",
+                                "value": 6,
+                                "timestamp": 100.0,
+                            },
+                        ],
+                    )
+                    self.assertEqual(len(m._api.store.registers), 2)
+                    self.modbus_tables["holding"][1] = 0
+                    m.poll()
+                    values = m._api.store.get(since=2)["values"]
+                    self.assertEqual([value["value"] for value in values], ["off"])
+                finally:
+                    m.stop()
+
+    def test_shared_image(self):
+        with patch("paho.mqtt.client.Client"):
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+                table = ModbusTable()
+                table.add_register(1)
+                table.set_value(1, 42)
+                mock_modbus().get_tables.return_value = {"holding": table}
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    "./tests/test_type.yaml",
+                    MQTT_TOPIC_PREFIX,
+                )
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    path = os.path.join(tmpdir, "image")
+                    m._shared_image = shared_image.SharedImage(path)
+                    m.connect()
+                    m.poll()
+                    reader = shared_image.SharedImageReader(path)
+                    self.assertEqual(reader.read()[1], {"holding": {1: 42}})
+                    # Failed polls leave the last good image alone.
+                    table.set_value(1, 43)
+                    mock_modbus().poll.side_effect = ModbusException("Failed")
+                    m.poll()
+                    self.assertEqual(reader.read_range("holding", 1, 1), [42])
+                    reader.close()
+                    m._shared_image.close()
+
+    def test_modbus_reconnect_backoff(self):
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    "./tests/test_type.yaml",
+                    MQTT_TOPIC_PREFIX,
+                )
+                m.connect()
+                self.assertEqual(self.connect_attempts, 1)
+                mock_modbus().poll.side_effect = ModbusException("Failed to connect")
+                m.poll()
+                self.assertEqual(mock_modbus().poll.call_count, 1)
+                self.assertEqual(
+                    m.modbus_connection_status,
+                    modbus4mqtt.ModbusConnectionStatus.Offline,
+                )
+                # The dead device isn't polled or reconnected on every tick.
+                mock_modbus().get_metrics.return_value = {}
+                m.metrics_interval = 0
+                m.poll()
+                self.assertEqual(mock_modbus().poll.call_count, 1)
+                self.assertEqual(self.connect_attempts, 1)
+                # But the metrics say it's being backed off from.
+                metrics = json.loads(mock_mqtt().publish.call_args_list[-1].args[1])
+                self.assertEqual(
+                    metrics["modbus_reconnect"], {"state": "backoff", "failures": 1}
+                )
+
+                # A reconnect that fails doesn't go on to poll.
+                m._reconnect.next_attempt = 0
+                mock_modbus().connect.side_effect = self.connect_failure
+                m.poll()
+                self.assertEqual(self.connect_attempts, 2)
+                self.assertEqual(mock_modbus().poll.call_count, 1)
+                self.assertEqual(m._reconnect.failures, 2)
+                metrics = json.loads(mock_mqtt().publish.call_args_list[-1].args[1])
+                self.assertEqual(metrics["modbus_reconnect"]["failures"], 2)
+                m.metrics_interval = None
+
+                # Once the wait is over, it reconnects and polls again.
+                mock_modbus().connect.side_effect = self.connect_success
+                m._reconnect.next_attempt = 0
+                mock_modbus().poll.side_effect = None
+                m.poll()
+                self.assertEqual(self.connect_attempts, 3)
+                self.assertEqual(mock_modbus().poll.call_count, 2)
+                self.assertEqual(m._reconnect.state, "closed")
+                self.assertEqual(
+                    m.modbus_connection_status,
+                    modbus4mqtt.ModbusConnectionStatus.Online,
+                )
+
+                # Between polls, the link is only checked when asked to.
+                m._check_modbus_link()
+                mock_modbus().check_link.assert_not_called()
+                m.idle_probe_interval = 10
+                m._check_modbus_link()
+                mock_modbus().check_link.assert_called_with(10)
+                # A dead link is handled like a failed poll.
+                mock_modbus().check_link.side_effect = ModbusException("Closed")
+                m._check_modbus_link()
+                self.assertEqual(m._reconnect.failures, 1)
+                self.assertEqual(
+                    m.modbus_connection_status,
+                    modbus4mqtt.ModbusConnectionStatus.Offline,
+                )
+                # It's left to the reconnect once it's failed.
+                m._check_modbus_link()
+                self.assertEqual(mock_modbus().check_link.call_count, 2)
+
+    def test_mqtt_reason_codes(self):
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_mqtt().subscribe.return_value = (0, 1)
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    "./tests/test_set_topics.yaml",
+                    MQTT_TOPIC_PREFIX,
+                    mqtt_version="5",
+                )
+                m.connect()
+                m._on_connect(None, None, None, reason_code=0, properties=None)
+                refused = ReasonCode(PacketTypes.SUBACK, identifier=0x87)
+                with self.assertLogs(level="ERROR") as logs:
+                    m._on_subscribe(None, None, 1, [refused], None)
+                self.assertIn("Not authorized", logs.output[0])
+
+                rejected = ReasonCode(PacketTypes.PUBACK, identifier=0x97)
+                with self.assertLogs(level="WARNING"):
+                    m._on_publish(None, None, 5, rejected, None)
+                accepted = ReasonCode(PacketTypes.PUBACK, identifier=0x10)
+                m._on_publish(None, None, 6, accepted, None)
+                self.assertEqual(m._publishes_rejected, 1)
+
+    def test_payload_codecs(self):
+        msgpack = pytest.importorskip("msgpack")
+        with patch("paho.mqtt.client.Client") as mock_mqtt:
+            with patch("modbus4mqtt.modbus_interface.modbus_interface") as mock_modbus:
+                mock_modbus().connect.side_effect = self.connect_success
+                mock_modbus().get_value.side_effect = self.read_modbus_register
+                m = modbus4mqtt.mqtt_interface(
+                    "kroopit",
+                    1885,
+                    "brengis",
+                    "pranto",
+                    "./tests/test_payload_codecs.yaml",
+                    MQTT_TOPIC_PREFIX,
+                )
+                m.connect()
+                for address in range(1, 5):
+                    self.modbus_tables["holding"][address] = address
+                m.poll()
+                published = {
+                    call.args[0]: call.args[1]
+                    for call in mock_mqtt().publish.call_args_list
+                }
+                self.assertEqual(published[MQTT_TOPIC_PREFIX + "/json"], "1")
+                self.assertEqual(
+                    msgpack.unpackb(published[MQTT_TOPIC_PREFIX + "/msgpack"]), 2
+                )
+                self.assertEqual(
+                    json.loads(
+                        zlib.decompress(published[MQTT_TOPIC_PREFIX + "/grouped"])
+                    ),
+                    {"a": 3, "b": 4},
+                )
+
+    def test_config_cache(self):
+        with patch("paho.mqtt.client.Client"):
+            with patch("modbus4mqtt.modbus_interface.modbus_interface"):
+                with tempfile.TemporaryDirectory() as cache:
+                    m = modbus4mqtt.mqtt_interface(
+                        "kroopit",
+                        1885,
+                        "brengis",
+                        "pranto",
+                        "./tests/test_type.yaml",
+                        MQTT_TOPIC_PREFIX,
+                        config_cache=cache,
+                    )
+                    self.assertEqual(len(os.listdir(cache)), 1)
+
+                    # The second load is served from the cache without parsing YAML.
+                    with patch("ruamel.yaml.YAML") as mock_yaml:
+                        mock_yaml.side_effect = AssertionError("YAML was parsed")
+                        cached = modbus4mqtt.mqtt_interface(
+                            "kroopit",
+                            1885,
+                            "brengis",
+                            "pranto",
+                            "./tests/test_type.yaml",
+                            MQTT_TOPIC_PREFIX,
+                            config_cache=cache,
+                        )
+                    self.assertEqual(cached.config, m.config)
+
+                    # A corrupt cache entry falls back to parsing the YAML.
+                    entry = os.path.join(cache, os.listdir(cache)[0])
+                    with open(entry, "wb") as f:
+                        f.write(b"garbage")
+                    recovered = modbus4mqtt.mqtt_interface(
+                        "kroopit",
+                        1885,
+                        "brengis",
+                        "pranto",
+                        "./tests/test_type.yaml",
+                        MQTT_TOPIC_PREFIX,
+                        config_cache=cache,
+                    )
+                    self.assertEqual(recovered.config, m.config)
+
+    def test_lazy_imports(self):
+        # The slow optional imports shouldn't be paid for just by loading the module.
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, modbus4mqtt.modbus4mqtt; "
+                "print('ruamel.yaml' in sys.modules, "
+                "'SungrowModbusTcpClient' in sys.modules)",
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        self.assertEqual(output.split(), ["False", "False"])
+
     def test_register_validation(self):
         valids = [
+            [  # Registers sharing a JSON set_topic
+                {
+                    "address": 13049,
+                    "json_key": "hours",
+                    "pub_topic": "schedule",
+                    "set_topic": "schedule/set",
+                },
+                {
+                    "address": 13050,
+                    "json_key": "minutes",
+                    "pub_topic": "schedule",
+                    "set_topic": "schedule/set",
+                },
+            ],
             [  # Different json_keys for same topic
                 {"address": 13049, "json_key": "a", "pub_topic": "ems/EMS_MODE"},
                 {"address": 13050, "json_key": "A", "pub_topic": "ems/EMS_MODE"},
@@ -687,6 +1891,10 @@ class MQTTTests(unittest.TestCase):
                 {"address": 13050, "pub_topic": "ems/EMS_MODEE", "type": "uint64"},
                 {"address": 13050, "pub_topic": "ems/EMS_MODEF", "type": "int64"},
             ],
+            [  # Write-only registers sharing a set_topic through json_key
+                {"address": 13050, "json_key": "A", "set_topic": "ems/set"},
+                {"address": 13051, "json_key": "B", "set_topic": "ems/set"},
+            ],
         ]
         invalids = [
             [  # Duplicate json_key for a topic
@@ -711,7 +1919,72 @@ class MQTTTests(unittest.TestCase):
                     "retain": False,
                 },
             ],
-            [  # set_topic and json_key both specified
+            [  # Payload codec specified twice and inconsistent
+                {
+                    "address": 13050,
+                    "json_key": "A",
+                    "pub_topic": "ems/EMS_MODE",
+                    "payload_codec": "json",
+                },
+                {
+                    "address": 13051,
+                    "json_key": "B",
+                    "pub_topic": "ems/EMS_MODE",
+                    "payload_codec": "cbor",
+                },
+            ],
+            [  # QoS that MQTT doesn't have
+                {
+                    "address": 13050,
+                    "pub_topic": "ems/EMS_MODE",
+                    "qos": 3,
+                },
+            ],
+            [  # device_address out of range
+                {
+                    "address": 13050,
+                    "pub_topic": "ems/EMS_MODE",
+                    "device_address": 248,
+                },
+            ],
+            [  # set_topic shared by registers with and without a json_key
+                {
+                    "address": 13050,
+                    "json_key": "A",
+                    "pub_topic": "ems/EMS_MODE",
+                    "set_topic": "ems/EMS_MODE/set",
+                },
+                {
+                    "address": 13051,
+                    "pub_topic": "ems/EMS_MODE_B",
+                    "set_topic": "ems/EMS_MODE/set",
+                },
+            ],
+            [  # set_topic shared by registers with the same json_key
+                {
+                    "address": 13050,
+                    "json_key": "A",
+                    "pub_topic": "ems/EMS_MODE",
+                    "set_topic": "ems/EMS_MODE/set",
+                },
+                {
+                    "address": 13051,
+                    "json_key": "A",
+                    "pub_topic": "ems/EMS_MODE_B",
+                    "set_topic": "ems/EMS_MODE/set",
+                },
+            ],
+            [  # Write-only registers sharing a set_topic with the same json_key
+                {"address": 13050, "json_key": "A", "set_topic": "ems/set"},
+                {"address": 13051, "json_key": "A", "set_topic": "ems/set"},
+            ],
+            [  # Write-only register with a json_key that isn't a string
+                {"address": 13050, "json_key": 5, "set_topic": "ems/set"},
+            ],
+            [  # Write-only register with an invalid type
+                {"address": 13050, "set_topic": "ems/set", "type": "float64"},
+            ],
+            [  # set_topic and json_key both specified, with conflicting retain settings
                 {
                     "address": 13050,
                     "json_key": "A",
@@ -745,6 +2018,29 @@ class MQTTTests(unittest.TestCase):
                 self.fail(
                     "Didn't throw an exception checking an invalid register configuration"
                 )
+        # Write-only registers are checked when the config is loaded.
+        with patch("paho.mqtt.client.Client"):
+            with patch("modbus4mqtt.modbus_interface.modbus_interface"):
+                with tempfile.TemporaryDirectory() as tmp:
+                    path = os.path.join(tmp, "config.yaml")
+                    with open(path, "w") as f:
+                        f.write(
+                            "ip: 192.168.1.90\n"
+                            "port: 502\n"
+                            "update_rate: 1\n"
+                            "registers:\n"
+                            "  - {address: 1, set_topic: set, json_key: a}\n"
+                            "  - {address: 2, set_topic: set, json_key: a}\n"
+                        )
+                    with self.assertRaises(ValueError):
+                        modbus4mqtt.mqtt_interface(
+                            "kroopit",
+                            1885,
+                            "brengis",
+                            "pranto",
+                            path,
+                            MQTT_TOPIC_PREFIX,
+                        )
 
     def assert_modbus_call(
         self, mock_modbus, word_order=modbus4mqtt.modbus_interface.WordOrder.HighLow
@@ -758,6 +2054,22 @@ class MQTTTests(unittest.TestCase):
             read_batching=None,
             write_batching=None,
             word_order=word_order,
+            state_file=None,
+            auto_batching=False,
+            min_read_batching=modbus4mqtt.modbus_interface.MIN_BATCHING,
+            target_read_latency=modbus4mqtt.modbus_interface.DEFAULT_TARGET_READ_LATENCY_S,
+            mask_write=False,
+            read_write_multiple=False,
+            timeout=modbus4mqtt.modbus_interface.DEFAULT_REQUEST_TIMEOUT_S,
+            retries=modbus4mqtt.modbus_interface.DEFAULT_REQUEST_RETRIES,
+            read_gap=0,
+            write_gap=0,
+            write_block_interval=0,
+            tcp_keepalive=None,
+            baudrate=modbus4mqtt.modbus_interface.DEFAULT_BAUDRATE,
+            bytesize=modbus4mqtt.modbus_interface.DEFAULT_BYTESIZE,
+            parity=modbus4mqtt.modbus_interface.DEFAULT_PARITY,
+            stopbits=modbus4mqtt.modbus_interface.DEFAULT_STOPBITS,
         )
 
     def test_word_order_setting(self):
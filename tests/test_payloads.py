@@ -0,0 +1,56 @@
+import zlib
+
+import pytest
+
+from modbus4mqtt.payloads import PayloadCodec
+
+
+def test_text():
+    codec = PayloadCodec()
+    # Plain values are left for paho to turn into text.
+    assert codec.encode(12.5) == 12.5
+    assert codec.encode("enabled") == "enabled"
+    assert codec.encode({"b": 1, "a": 2}) == '{"a": 2, "b": 1}'
+    assert codec.decode(b"12.5") == 12.5
+    assert codec.decode(b"enabled") == "enabled"
+
+
+def test_json():
+    codec = PayloadCodec("json")
+    assert codec.encode(12) == "12"
+    assert codec.encode("enabled") == '"enabled"'
+    assert codec.encode({"b": 1, "a": 2}) == '{"a":2,"b":1}'
+    assert codec.decode(b'"enabled"') == "enabled"
+
+
+@pytest.mark.parametrize("codec_name", ["cbor", "msgpack"])
+def test_binary(codec_name):
+    pytest.importorskip({"cbor": "cbor2", "msgpack": "msgpack"}[codec_name])
+    codec = PayloadCodec(codec_name)
+    for value in [1, 65535, -3, 0.5, "enabled", {"a": 1, "b": "x"}]:
+        payload = codec.encode(value)
+        assert isinstance(payload, bytes)
+        assert codec.decode(payload) == value
+    # Small values take fewer bytes than text.
+    assert len(codec.encode(65535)) <= 3
+    with pytest.raises(ValueError):
+        codec.decode(b"\xc1")
+
+
+def test_group_compression():
+    codec = PayloadCodec("json", "zlib")
+    group = {str(i): i for i in range(100)}
+    payload = codec.encode(group)
+    assert len(payload) < len(PayloadCodec("json").encode(group))
+    assert zlib.decompress(payload).startswith(b'{"0":0')
+    assert codec.decode(payload) == group
+    # Plain values aren't compressed.
+    assert codec.encode(5) == "5"
+    assert codec.decode(b"5") == 5
+
+
+def test_bad_settings():
+    with pytest.raises(ValueError):
+        PayloadCodec("yaml")
+    with pytest.raises(ValueError):
+        PayloadCodec("json", "lzma")
@@ -0,0 +1,63 @@
+from click.testing import CliRunner
+
+from modbus4mqtt import modbus4mqtt
+from modbus4mqtt import plan
+from modbus4mqtt.modbus_table import ModbusTable
+
+
+def test_build_plan():
+    holding = ModbusTable(4)
+    for addr in [1, 2, 3, 4, 5, 10]:
+        holding.add_register(addr)
+    registers = [
+        {"pub_topic": "a", "address": 1},
+        {"pub_topic": "b", "address": 2, "type": "uint32"},
+        {"pub_topic": "c", "address": 4, "type": "uint32"},
+        {"pub_topic": "d", "address": 10},
+        {"pub_topic": "e", "address": 10, "table": "input"},
+    ]
+    result = plan.build_plan({"holding": holding}, registers)
+    assert result["holding"]["batches"] == [(1, 4), (5, 1), (10, 1)]
+    assert result["holding"]["requests"] == 3
+    assert result["holding"]["words_read"] == 6
+    assert result["holding"]["words_wanted"] == 6
+    assert [register["pub_topic"] for register in result["holding"]["split"]] == ["c"]
+
+
+def test_estimate_wire_time():
+    batches = [(1, 4), (10, 1)]
+    assert plan.wire_bytes(batches) == (12 + 9 + 8) + (12 + 9 + 2)
+    assert plan.estimate_wire_time(batches, 0.01) == 0.02
+    assert plan.estimate_wire_time(batches, 0, 520) == 0.8
+
+
+def test_plan_command():
+    runner = CliRunner()
+    result = runner.invoke(
+        modbus4mqtt.main,
+        ["plan", "--config", "./tests/test_plan.yaml", "--latency", "5"],
+    )
+    assert result.exit_code == 0
+    assert "Table: holding\n  Requests per poll: 2\n" in result.output
+    assert "Read 4 registers from 1 to 4" in result.output
+    assert "Warning: uint32 split at 4 is split across reads" in result.output
+    assert "Total requests per poll: 3" in result.output
+    assert "Total estimated wire time: 15.0 ms" in result.output
+
+
+def test_plan_command_multi_drop():
+    runner = CliRunner()
+    result = runner.invoke(
+        modbus4mqtt.main,
+        ["plan", "--config", "./tests/test_multi_drop.yaml", "--latency", "5"],
+    )
+    assert result.exit_code == 0
+    assert (
+        "Table: holding@1\n  Requests per poll: 1\n  Words read: 1, words wanted: 1\n"
+        in result.output
+    )
+    assert (
+        "Table: holding@2\n  Requests per poll: 1\n  Words read: 2, words wanted: 2\n"
+        in result.output
+    )
+    assert "Read 2 registers from 20 to 21" in result.output
@@ -0,0 +1,120 @@
+from unittest.mock import patch
+
+import pytest
+from click.testing import CliRunner
+from pymodbus import ModbusException
+from pymodbus.exceptions import ModbusIOException
+
+from modbus4mqtt import modbus4mqtt, probe
+
+
+class FakeDevice:
+    # Answers reads for a fixed set of addresses and rejects reads bigger than max_read.
+    def __init__(self, readable: set[int], max_read: int = 125):
+        self.readable = readable
+        self.max_read = max_read
+        self.reads: list[tuple[int, int]] = []
+
+    def read(self, addr: int, count: int):
+        self.reads.append((addr, count))
+        if count > self.max_read:
+            raise ModbusException("Too many registers")
+        if any(addr + i not in self.readable for i in range(count)):
+            raise ModbusException("Illegal data address")
+        return list(range(addr, addr + count))
+
+
+def test_find_readable_blocks():
+    device = FakeDevice(set(range(10, 60)) | set(range(100, 103)) | {200})
+    blocks = probe.find_readable_blocks(device.read, 0, 256, 64)
+    assert blocks == [(10, 50), (100, 3), (200, 1)]
+
+
+def test_find_readable_blocks_all_readable():
+    device = FakeDevice(set(range(0, 300)))
+    assert probe.find_readable_blocks(device.read, 0, 300, 125) == [(0, 300)]
+    # Readable regions are found without splitting.
+    assert device.reads == [(0, 125), (125, 125), (250, 50)]
+
+
+def test_find_max_batch():
+    device = FakeDevice(set(range(0, 300)), max_read=77)
+    assert probe.find_max_batch(device.read, (0, 300), 125) == 77
+    # The search is limited by the size of the block.
+    assert probe.find_max_batch(device.read, (0, 20), 125) == 20
+
+
+def test_measure_latency():
+    device = FakeDevice(set(range(0, 300)))
+    latency = probe.measure_latency(device.read, 0, 40, samples=2)
+    assert list(latency.keys()) == [1, 2, 4, 8, 16, 32, 40]
+    assert all(value >= 0 for value in latency.values())
+
+
+def test_starter_config():
+    config = probe.starter_config(
+        "1.2.3.4", 502, 1, None, "input", [(10, 5), (100, 1)], 3
+    )
+    assert config["read_batching"] == 3
+    assert "variant" not in config
+    topics = [register["pub_topic"] for register in config["registers"]]
+    assert topics == [
+        "input/10-12",
+        "input/10-12",
+        "input/10-12",
+        "input/13-14",
+        "input/13-14",
+        "input/100-100",
+    ]
+    assert config["registers"][0] == {
+        "pub_topic": "input/10-12",
+        "table": "input",
+        "address": 10,
+        "json_key": "10",
+    }
+
+
+def test_find_readable_blocks_connection_failure():
+    def read(addr, count):
+        raise probe.ConnectionException("Failed to connect")
+
+    with pytest.raises(probe.ConnectionException):
+        probe.find_readable_blocks(read, 0, 10, 10)
+
+
+def test_find_readable_blocks_no_response():
+    device = FakeDevice(set(range(0, 256)))
+
+    def read(addr, count):
+        if 64 <= addr < 128:
+            device.reads.append((addr, count))
+            raise ModbusIOException("No response received")
+        return device.read(addr, count)
+
+    assert probe.find_readable_blocks(read, 0, 256, 64) == [(0, 64), (128, 128)]
+    # The silent batch is skipped, not split into more reads that would time out.
+    assert device.reads == [(0, 64), (64, 64), (128, 64), (192, 64)]
+
+
+def test_find_max_batch_no_response():
+    device = FakeDevice(set(range(0, 300)))
+
+    def read(addr, count):
+        if count > 40:
+            device.reads.append((addr, count))
+            raise ModbusIOException("No response received")
+        return device.read(addr, count)
+
+    assert probe.find_max_batch(read, (0, 300), 125) == 40
+    # Unanswered reads count as too big, so the search stays a binary search.
+    assert len(device.reads) == 7
+
+
+def test_probe_command_timeout():
+    with patch("modbus4mqtt.probe.probe", return_value={"blocks": []}) as mock_probe:
+        result = CliRunner().invoke(
+            modbus4mqtt.main,
+            ["probe", "--ip", "1.2.3.4", "--timeout", "0.2", "--retries", "0"],
+        )
+    assert result.exit_code == 0
+    assert mock_probe.call_args.kwargs == {"timeout": 0.2, "retries": 0}
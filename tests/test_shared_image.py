@@ -0,0 +1,120 @@
+import multiprocessing
+
+import pytest
+
+from modbus4mqtt import shared_image
+from modbus4mqtt.modbus_table import ModbusTable
+
+
+def make_table(values):
+    table = ModbusTable()
+    for addr, value in values.items():
+        table.add_register(addr)
+        table.set_value(addr, value)
+    return table
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "image")
+    image = shared_image.SharedImage(path)
+    holding = make_table({1: 10, 2: 20, 3: 30, 7: 70})
+    tables = {"holding": holding, "input": make_table({0: 5})}
+    image.update(tables, 1234.5)
+    reader = shared_image.SharedImageReader(path)
+    assert reader.layout["holding"][0][:2] == (1, 3)
+    assert reader.layout["holding"][1][:2] == (7, 1)
+    poll_time, values = reader.read()
+    assert poll_time == 1234.5
+    assert values == {"holding": {1: 10, 2: 20, 3: 30, 7: 70}, "input": {0: 5}}
+    assert reader.read_range("holding", 2, 2) == [20, 30]
+
+    # New values show up in the same mapping.
+    holding.set_value(2, 21)
+    image.update(tables, 1240.0)
+    assert reader.read_range("holding", 2, 2) == [21, 30]
+
+    # A layout change replaces the file, and the reader follows it.
+    holding.add_register(4)
+    holding.set_value(4, 40)
+    image.update(tables, 1245.0)
+    assert reader.read_range("holding", 1, 4) == [10, 21, 30, 40]
+    reader.close()
+    image.close()
+
+
+def test_new_image_waits_for_values(tmp_path):
+    path = str(tmp_path / "image")
+    image = shared_image.SharedImage(path)
+    tables = {"holding": make_table({1: 10})}
+    # Published, but not filled in yet.
+    image._create([("holding", [(1, 1)])])
+    with open(path, "rb") as f:
+        header = shared_image.HEADER.unpack(f.read(shared_image.HEADER.size))
+    assert header[3] % 2 == 1
+    image.update(tables, 1.0)
+    reader = shared_image.SharedImageReader(path)
+    assert reader.read() == (1.0, {"holding": {1: 10}})
+    reader.close()
+    image.close()
+
+
+def test_restart_supersedes(tmp_path):
+    path = str(tmp_path / "image")
+    tables = {"holding": make_table({1: 10})}
+    first = shared_image.SharedImage(path)
+    first.update(tables, 1.0)
+    reader = shared_image.SharedImageReader(path)
+    first.close()
+    tables["holding"].set_value(1, 11)
+    second = shared_image.SharedImage(path)
+    second.update(tables, 2.0)
+    assert reader.read() == (2.0, {"holding": {1: 11}})
+    second.close()
+
+
+def test_abandoned_write_times_out(tmp_path):
+    path = str(tmp_path / "image")
+    image = shared_image.SharedImage(path)
+    image.update({"holding": make_table({1: 10})}, 1.0)
+    reader = shared_image.SharedImageReader(path, timeout=0.05)
+    assert reader.read() == (1.0, {"holding": {1: 10}})
+    # The writer died part way through an update, leaving the sequence odd.
+    assert image._map is not None
+    shared_image.SEQUENCE.pack_into(image._map, shared_image.SEQUENCE_OFFSET, 3)
+    with pytest.raises(TimeoutError):
+        reader.read()
+    with pytest.raises(TimeoutError):
+        reader.read_range("holding", 1, 1)
+    reader.close()
+    image.close()
+
+
+def read_until(path, count, results):
+    # Checks every snapshot it reads is consistent: all words equal.
+    reader = shared_image.SharedImageReader(path)
+    torn = 0
+    for _ in range(count):
+        _, values = reader.read()
+        if len(set(values["holding"].values())) != 1:
+            torn += 1
+    results.put(torn)
+
+
+def test_consistent_snapshots(tmp_path):
+    path = str(tmp_path / "image")
+    image = shared_image.SharedImage(path)
+    table = make_table({addr: 0 for addr in range(100)})
+    tables = {"holding": table}
+    image.update(tables, 0.0)
+    results: multiprocessing.Queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=read_until, args=(path, 2000, results))
+    process.start()
+    value = 0
+    while process.is_alive():
+        value = (value + 1) & 0xFFFF
+        for addr in range(100):
+            table.set_value(addr, value)
+        image.update(tables, float(value))
+    process.join()
+    assert results.get() == 0
+    image.close()
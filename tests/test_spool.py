@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+from modbus4mqtt import spool
+
+
+def drain(s):
+    messages = []
+    while (message := s.pop()) is not None:
+        messages.append(message)
+    return messages
+
+
+def test_append_and_pop(tmp_path):
+    s = spool.Spool(str(tmp_path), 4096, 4)
+    assert s.pop() is None
+    s.append("a/b", b"1", False, 100.0)
+    s.append("c", b'{"x": 2}', True, 101.5)
+    assert len(s) == 2
+    assert drain(s) == [("a/b", b"1", False, 100.0), ("c", b'{"x": 2}', True, 101.5)]
+    assert len(s) == 0
+    assert s.pop() is None
+
+
+def test_ring_is_bounded(tmp_path):
+    s = spool.Spool(str(tmp_path), 4096, 4)
+    for i in range(1000):
+        s.append("topic", str(i).encode(), False, float(i))
+    # Disk use never grows past the configured size.
+    assert (
+        sum(os.path.getsize(tmp_path / name) for name in os.listdir(tmp_path)) == 4096
+    )
+    messages = drain(s)
+    # The oldest messages were dropped to make room, and the newest are intact.
+    assert len(messages) + s.dropped == 1000
+    assert s.dropped > 0
+    assert [float(m[1]) for m in messages] == list(range(s.dropped, 1000))
+
+
+def test_ring_wraps_after_partial_drain(tmp_path):
+    s = spool.Spool(str(tmp_path), 4096, 4)
+    appended = 0
+
+    def append(count):
+        nonlocal appended
+        for _ in range(count):
+            s.append("topic", str(appended).encode(), False, float(appended))
+            appended += 1
+
+    # Fill the first segment and start the second, then replay all of the first.
+    append(60)
+    popped = [m[3] for m in (s.pop() for _ in range(s._pending[0]))]
+    # Keep going until the writer has wrapped around onto the first segment.
+    append(150)
+    popped += [m[3] for m in drain(s)]
+    # Nothing is lost without being counted, and it all comes back in order.
+    assert len(popped) + s.dropped == appended
+    assert popped == sorted(popped)
+    assert popped[-1] == appended - 1
+    assert s.pop() is None
+
+
+def test_backlog_survives_restart(tmp_path):
+    s = spool.Spool(str(tmp_path), 4096, 4)
+    for i in range(100):
+        s.append("topic", str(i).encode(), False, float(i))
+    for _ in range(30):
+        s.pop()
+    s.close()
+
+    s = spool.Spool(str(tmp_path), 4096, 4)
+    assert len(s) == 70
+    assert [m[3] for m in drain(s)] == [float(i) for i in range(30, 100)]
+    s.append("topic", b"new", False, 1.0)
+    assert drain(s) == [("topic", b"new", False, 1.0)]
+
+
+def test_message_too_big(tmp_path):
+    s = spool.Spool(str(tmp_path), 4096, 4)
+    with pytest.raises(ValueError):
+        s.append("topic", bytes(2048), False, 0.0)